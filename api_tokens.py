@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import time
+
+from config import WILDBERRIES_API_KEYS, WILDBERRIES_RATE_LIMIT
+from ratelimit import TokenBucket
+
+UNAUTHORIZED_COOLDOWN = 3600  # Ключ отклонён (401): проверяем его снова через час, секунды
+RATE_LIMITED_COOLDOWN = 10  # Пауза ключа после 429 без Retry-After, секунды
+ACQUIRE_TIMEOUT = 5  # Сколько цикл опроса ждёт свободный ключ, прежде чем пропустить опрос, секунды
+
+
+# Ключ API со своим бюджетом запросов и паузой после отказа
+class ApiToken:
+    __slots__ = ('key', 'label', 'budget', 'cooldown_until', 'in_flight', 'requests', 'last_used')
+
+    def __init__(self, key: str, label: str, rate_limit: int):
+        self.key = key
+        self.label = label  # Имя ключа для логов и метрик (сам ключ не выводится)
+        self.budget = TokenBucket(rate_limit / 60, rate_limit)
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.requests = 0
+        self.last_used = 0.0
+
+
+# Пул ключей API: запрос получает ключ с доступным бюджетом, дольше всех простаивавший
+# (так ключи чередуются и их бюджеты восстанавливаются вразнобой, а не одновременно),
+# ключ, получивший 401 или 429, выводится из пула на время паузы
+class TokenPool:
+    def __init__(self, keys: list = WILDBERRIES_API_KEYS, rate_limit: int = WILDBERRIES_RATE_LIMIT):
+        self.tokens = [ApiToken(key, f"#{index + 1}", rate_limit) for index, key in enumerate(keys)]
+
+    def __len__(self):
+        return len(self.tokens)
+
+    # Число ключей, не выведенных из пула
+    def active(self) -> int:
+        now = time.monotonic()
+        return sum(1 for token in self.tokens if token.cooldown_until <= now)
+
+    # Взять ключ без ожидания: (ключ, 0) или (None, сколько секунд ждать)
+    def try_acquire(self) -> tuple:
+        now = time.monotonic()
+        best = None
+        delay = float("inf")
+        for token in self.tokens:
+            if token.cooldown_until > now:
+                delay = min(delay, token.cooldown_until - now)
+                continue
+            wait = token.budget.wait_time()
+            if wait:
+                delay = min(delay, wait)
+                continue
+            # Меньше запросов в работе, затем дольше не использовался
+            if best is None or (token.in_flight, token.last_used) < (best.in_flight, best.last_used):
+                best = token
+        if best is None:
+            return None, delay
+        best.budget.try_acquire()
+        best.in_flight += 1
+        best.requests += 1
+        best.last_used = now
+        return best, 0.0
+
+    # Ожидание ключа с доступным бюджетом; None, если ключ не освободился за timeout секунд
+    async def acquire(self, timeout: float = None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            token, delay = self.try_acquire()
+            if token is not None:
+                return token
+            if not self.active():
+                logging.warning(f"Все ключи API Wildberries на паузе, ближайший освободится через {delay:.0f} с.")
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if delay > remaining:
+                    return None
+            await asyncio.sleep(delay)
+
+    # Запрос с ключом завершён; status — HTTP-статус ответа (None при сетевой ошибке)
+    def release(self, token: ApiToken, status: int = None, retry_after: float = None):
+        token.in_flight -= 1
+        if status == 401:
+            token.cooldown_until = time.monotonic() + UNAUTHORIZED_COOLDOWN
+            logging.error(f"Ключ API {token.label} отклонён (401), выведен из пула на {UNAUTHORIZED_COOLDOWN} с.")
+        elif status == 429:
+            pause = retry_after if retry_after is not None else RATE_LIMITED_COOLDOWN
+            token.cooldown_until = time.monotonic() + pause
+            logging.warning(f"Ключ API {token.label} упёрся в лимит (429), выведен из пула на {pause:.0f} с.")
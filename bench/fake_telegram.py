@@ -0,0 +1,91 @@
+# Локальная замена Telegram Bot API, которая принимает вызовы бота и запоминает отправленные сообщения.
+#
+# Бот подключается к ней через собственный сервер API:
+#   session = AiohttpSession(api=TelegramAPIServer.from_base(url))
+#   bot = Bot(token=..., session=session)
+#
+# Запуск отдельно: python -m bench.fake_telegram --port 8082
+import argparse
+import itertools
+import random
+import time
+
+from aiohttp import web
+
+
+# Запись одного вызова API
+class SentMessage:
+    __slots__ = ('method', 'chat_id', 'text', 'sent_at')
+
+    def __init__(self, method: str, chat_id, text: str, sent_at: float):
+        self.method = method
+        self.chat_id = chat_id
+        self.text = text
+        self.sent_at = sent_at
+
+
+# aiohttp-приложение, отвечающее в формате Bot API. flood_rate — доля запросов, на которые отвечаем 429.
+def create_app(flood_rate: float = 0.0, retry_after: int = 1, seed: int = 1) -> web.Application:
+    app = web.Application()
+    app["sent"] = []
+    message_ids = itertools.count(1)
+    rng = random.Random(seed)
+
+    async def handle(request: web.Request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        if not data and request.can_read_body:
+            data = await request.json()
+
+        if flood_rate and method == "sendMessage" and rng.random() < flood_rate:
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {retry_after}",
+                "parameters": {"retry_after": retry_after},
+            })
+
+        chat_id = data.get("chat_id")
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method.startswith("send"):
+            app["sent"].append(SentMessage(method, chat_id, data.get("text", ""), time.monotonic()))
+            result = {
+                "message_id": next(message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"},
+                "text": data.get("text", ""),
+            }
+        else:
+            # editMessage*, deleteMessage, answerCallbackQuery, setWebhook и прочее
+            if method.startswith("edit"):
+                app["sent"].append(SentMessage(method, chat_id, data.get("text", ""), time.monotonic()))
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app.router.add_post("/bot{token}/{method}", handle)
+    return app
+
+
+# Запуск заглушки в текущем event loop; возвращает runner, приложение и базовый URL сервера
+async def start(host: str = "127.0.0.1", port: int = 0, flood_rate: float = 0.0):
+    app = create_app(flood_rate)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, app, f"http://{host}:{bound_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--flood-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    print(f"Заглушка Telegram Bot API: http://{args.host}:{args.port}")
+    web.run_app(create_app(args.flood_rate), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
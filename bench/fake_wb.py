@@ -0,0 +1,179 @@
+# Локальная замена API Wildberries (/acceptance/coefficients и /warehouses)
+# для воспроизведения записанных или синтетических ответов.
+#
+# Запуск заглушки:     python -m bench.fake_wb serve --warehouses 50 --rows 42 --port 8081
+# Воспроизведение:     python -m bench.fake_wb serve --replay bench/recordings --port 8081
+# Запись реального API: python -m bench.fake_wb record --warehouses 507,686 --count 10 --interval 10
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import random
+import time
+from datetime import date, timedelta
+
+from aiohttp import web
+
+BOX_TYPES = [(2, "Короба"), (5, "Монопаллеты"), (6, "Суперсейф")]
+API_PREFIX = "/api/v1"
+
+
+# Синтетические коэффициенты: warehouses складов, по rows строк (дни × типы поставки) на склад.
+# При каждом запросе доля change_rate коэффициентов меняется случайным образом.
+class SyntheticCoefficients:
+    def __init__(self, warehouses: int, rows: int, change_rate: float = 0.05, seed: int = 1):
+        self.random = random.Random(seed)
+        self.change_rate = change_rate
+        self.warehouse_ids = [1000 + index for index in range(warehouses)]
+        today = date.today()
+        self.rows = {}
+        for warehouse_id in self.warehouse_ids:
+            self.rows[warehouse_id] = [
+                {
+                    "date": f"{(today + timedelta(days=index // len(BOX_TYPES))).isoformat()}T00:00:00Z",
+                    "coefficient": self.random.randint(-1, 20),
+                    "warehouseID": warehouse_id,
+                    "warehouseName": f"Склад {warehouse_id}",
+                    "boxTypeName": BOX_TYPES[index % len(BOX_TYPES)][1],
+                    "boxTypeID": BOX_TYPES[index % len(BOX_TYPES)][0],
+                }
+                for index in range(rows)
+            ]
+
+    # Случайные изменения коэффициентов между опросами
+    def mutate(self):
+        for rows in self.rows.values():
+            for row in rows:
+                if self.random.random() < self.change_rate:
+                    row["coefficient"] = self.random.randint(-1, 20)
+
+    def payload(self, warehouse_ids: list) -> bytes:
+        self.mutate()
+        rows = []
+        for warehouse_id in warehouse_ids:
+            rows.extend(self.rows.get(warehouse_id, ()))
+        return json.dumps(rows, ensure_ascii=False).encode()
+
+    def warehouses(self) -> bytes:
+        return json.dumps([{"ID": warehouse_id, "name": f"Склад {warehouse_id}", "address": "", "workTime": "24/7",
+                            "acceptsQR": False} for warehouse_id in self.warehouse_ids], ensure_ascii=False).encode()
+
+
+# Воспроизведение записанных ответов по кругу
+class RecordedCoefficients:
+    def __init__(self, directory: str):
+        self.payloads = []
+        for path in sorted(glob.glob(os.path.join(directory, "coefficients_*.json"))):
+            with open(path, "rb") as file:
+                self.payloads.append(json.loads(file.read()))
+        if not self.payloads:
+            raise ValueError(f"В {directory} нет записанных ответов coefficients_*.json")
+        warehouses_path = os.path.join(directory, "warehouses.json")
+        self.warehouses_payload = b"[]"
+        if os.path.exists(warehouses_path):
+            with open(warehouses_path, "rb") as file:
+                self.warehouses_payload = file.read()
+        self.position = 0
+        self.warehouse_ids = sorted({row["warehouseID"] for rows in self.payloads for row in rows})
+
+    def payload(self, warehouse_ids: list) -> bytes:
+        rows = self.payloads[self.position % len(self.payloads)]
+        self.position += 1
+        wanted = set(warehouse_ids)
+        return json.dumps([row for row in rows if row["warehouseID"] in wanted], ensure_ascii=False).encode()
+
+    def warehouses(self) -> bytes:
+        return self.warehouses_payload
+
+
+# aiohttp-приложение с теми же путями, что и у supplies-api.wildberries.ru
+def create_app(source) -> web.Application:
+    app = web.Application()
+    app["requests"] = 0
+
+    async def coefficients(request: web.Request):
+        app["requests"] += 1
+        ids = request.query.get("warehouseIDs", "")
+        warehouse_ids = [int(value) for value in ids.split(",") if value]
+        return web.Response(body=source.payload(warehouse_ids), content_type="application/json")
+
+    async def warehouses(request: web.Request):
+        body = source.warehouses()
+        etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    app.router.add_get(f"{API_PREFIX}/acceptance/coefficients", coefficients)
+    app.router.add_get(f"{API_PREFIX}/warehouses", warehouses)
+    return app
+
+
+# Запуск заглушки в текущем event loop; возвращает runner для остановки
+async def start(source, host: str = "127.0.0.1", port: int = 0):
+    runner = web.AppRunner(create_app(source))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}{API_PREFIX}"
+
+
+# Запись ответов реального API для последующего воспроизведения
+async def record(warehouse_ids: list, count: int, interval: float, directory: str):
+    from wb_client import WildberriesClient
+
+    os.makedirs(directory, exist_ok=True)
+    client = WildberriesClient()
+    try:
+        warehouses = await client.get_warehouses()
+        if warehouses is not None:
+            with open(os.path.join(directory, "warehouses.json"), "w", encoding="utf-8") as file:
+                json.dump(warehouses, file, ensure_ascii=False)
+        for index in range(count):
+            payload = await client.get_acceptance_coefficients_payload(warehouse_ids)
+            if payload is not None:
+                path = os.path.join(directory, f"coefficients_{int(time.time())}_{index:04d}.json")
+                with open(path, "wb") as file:
+                    file.write(payload)
+                print(f"Записан {path}")
+            if index < count - 1:
+                await asyncio.sleep(interval)
+    finally:
+        await client.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка API Wildberries")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8081)
+    serve.add_argument("--replay", help="Каталог с записанными ответами")
+    serve.add_argument("--warehouses", type=int, default=50)
+    serve.add_argument("--rows", type=int, default=42)
+    serve.add_argument("--change-rate", type=float, default=0.05)
+
+    record_parser = commands.add_parser("record")
+    record_parser.add_argument("--warehouses", required=True, help="ID складов через запятую")
+    record_parser.add_argument("--count", type=int, default=10)
+    record_parser.add_argument("--interval", type=float, default=10)
+    record_parser.add_argument("--out", default=os.path.join("bench", "recordings"))
+
+    args = parser.parse_args()
+    if args.command == "record":
+        asyncio.run(record([int(value) for value in args.warehouses.split(",")], args.count, args.interval,
+                           args.out))
+        return
+
+    source = (RecordedCoefficients(args.replay) if args.replay
+              else SyntheticCoefficients(args.warehouses, args.rows, args.change_rate))
+    print(f"Заглушка API Wildberries: http://{args.host}:{args.port}{API_PREFIX}")
+    web.run_app(create_app(source), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# Бенчмарк конвейера опрос → вычисление изменений → рассылка на локальных заглушках API.
+#
+#   python -m bench.run_bench --users 1000 --warehouses 50 --rows 42 --ticks 20
+#   python -m bench.run_bench --users 1000 --json bench/baseline.json
+#   python -m bench.run_bench --users 1000 --baseline bench/baseline.json --max-regression 0.2
+#
+# Отчёт: задержка цикла (опрос+изменения+постановка в очередь) и время до доставки всех сообщений,
+# отправок в секунду, выделения памяти за цикл (tracemalloc) и пиковая память процесса.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from bench import fake_telegram, fake_wb
+from keyboards import coefficient_mask, mask_coefficients
+from memory import peak_rss
+
+
+def percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Заполнение user_data и индекса подписок синтетическими пользователями
+def populate_users(app, warehouse_ids: list, users: int, warehouses_per_user: int, coefficients_per_user: int,
+                   seed: int = 1):
+    rng = random.Random(seed)
+    for chat_id in range(1, users + 1):
+        selected_warehouses = rng.sample(warehouse_ids, min(warehouses_per_user, len(warehouse_ids)))
+        selected_coefficients = {
+            warehouse_id: coefficient_mask(rng.sample(app.COEFFICIENTS, coefficients_per_user))
+            for warehouse_id in selected_warehouses
+        }
+        app.user_data[chat_id] = {
+            'selected_warehouses': selected_warehouses,
+            'selected_coefficients': selected_coefficients,
+            'last_message_id': None,
+            'last_keyboard': None,
+            'current_warehouse_index': 0,
+            'setup_complete': True,
+            'selected_box_types': 0,
+            'rules': []
+        }
+        for warehouse_id in selected_warehouses:
+            app.subscriptions.add_warehouse(chat_id, warehouse_id)
+            for coefficient in mask_coefficients(selected_coefficients[warehouse_id]):
+                app.subscriptions.add_coefficient(chat_id, warehouse_id, coefficient)
+
+
+async def run(args) -> dict:
+    import bot as app
+    import notifier as notifier_module
+    from api_tokens import TokenPool
+    from ratelimit import TokenBucket
+    from snapshotfile import SnapshotFile
+    from storage import StateStore
+    from wb_client import wb_client
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    source = (fake_wb.RecordedCoefficients(args.replay) if args.replay
+              else fake_wb.SyntheticCoefficients(args.warehouses, args.rows, args.change_rate))
+    wb_runner, wb_url = await fake_wb.start(source)
+    tg_runner, tg_app, tg_url = await fake_telegram.start(flood_rate=args.flood_rate)
+
+    wb_client.api_url = wb_url
+    # Заглушка API не ограничивает запросы: лимит ключа не должен растягивать циклы
+    wb_client.tokens = TokenPool(["bench"], rate_limit=10 ** 9)
+    fake_bot = Bot(token="42:bench", session=AiohttpSession(api=TelegramAPIServer.from_base(tg_url)))
+    app.notifier.bot = fake_bot
+    if args.unlimited:
+        # Снимаем лимиты Telegram, чтобы измерить собственную пропускную способность конвейера
+        app.notifier.global_bucket = TokenBucket(1e9, 1e9)
+        notifier_module.CHAT_RATE = notifier_module.CHAT_BURST = 1e9
+
+    workdir = tempfile.mkdtemp(prefix="wb_bench_")
+    app.store = StateStore(os.path.join(workdir, "users.db"))
+    app.snapshot_file = SnapshotFile(os.path.join(workdir, "snapshot.bin"))
+    app.snapshot_file.open()
+    app.store.open()
+    app.notifier.start()
+
+    populate_users(app, source.warehouse_ids, args.users, args.warehouses_per_user, args.coefficients_per_user)
+    warehouse_ids = app.subscriptions.warehouse_ids()
+
+    tracemalloc.start()
+    ticks = []
+    started_at = time.perf_counter()
+    try:
+        for tick in range(args.ticks + 1):
+            sent_before = len(tg_app["sent"])
+            tracemalloc.reset_peak()
+            memory_before, _ = tracemalloc.get_traced_memory()
+            blocks_before = sys.getallocatedblocks()
+
+            tick_started = time.perf_counter()
+            await app.poll_warehouses(warehouse_ids)
+            poll_finished = time.perf_counter()
+            _, memory_peak = tracemalloc.get_traced_memory()
+            blocks_after = sys.getallocatedblocks()
+            await app.notifier.drain()
+            delivered = time.perf_counter()
+
+            if tick == 0:
+                # Первый цикл рассылает все ячейки как новые — это прогрев, в статистику не идёт
+                continue
+            ticks.append({
+                "poll": poll_finished - tick_started,
+                "deliver": delivered - tick_started,
+                "sends": len(tg_app["sent"]) - sent_before,
+                "alloc_peak": memory_peak - memory_before,
+                "alloc_blocks": blocks_after - blocks_before,
+            })
+            await app.store.flush(app.user_data)
+    finally:
+        elapsed = time.perf_counter() - started_at
+        tracemalloc.stop()
+        await app.notifier.stop()
+        await fake_bot.session.close()
+        await wb_client.close()
+        app.store.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+        await wb_runner.cleanup()
+        await tg_runner.cleanup()
+
+    total_sends = sum(tick["sends"] for tick in ticks)
+    deliver_time = sum(tick["deliver"] for tick in ticks)
+    polls = [tick["poll"] for tick in ticks]
+    delivers = [tick["deliver"] for tick in ticks]
+    return {
+        "users": args.users,
+        "warehouses": len(warehouse_ids),
+        "rows": args.rows,
+        "ticks": len(ticks),
+        "tick_p50_ms": statistics.median(polls) * 1000,
+        "tick_p95_ms": percentile(polls, 0.95) * 1000,
+        "tick_max_ms": max(polls) * 1000,
+        "deliver_p50_ms": statistics.median(delivers) * 1000,
+        "deliver_p95_ms": percentile(delivers, 0.95) * 1000,
+        "sends_total": total_sends,
+        "sends_per_second": total_sends / deliver_time if deliver_time else 0.0,
+        "alloc_peak_kb_p50": statistics.median(tick["alloc_peak"] for tick in ticks) / 1024,
+        "alloc_blocks_p50": statistics.median(tick["alloc_blocks"] for tick in ticks),
+        "peak_rss_mb": (peak_rss() or 0) / 1024 / 1024,
+        "elapsed_s": elapsed,
+    }
+
+
+# Метрики, по которым проверяется регрессия (чем меньше, тем лучше)
+GATED_METRICS = ("tick_p50_ms", "tick_p95_ms", "deliver_p50_ms", "alloc_peak_kb_p50")
+
+
+def check_regression(report: dict, baseline: dict, max_regression: float) -> list:
+    failures = []
+    for metric in GATED_METRICS:
+        previous = baseline.get(metric)
+        if previous and report[metric] > previous * (1 + max_regression):
+            failures.append(f"{metric}: {report[metric]:.2f} > {previous:.2f} (+{max_regression:.0%})")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк конвейера опроса и рассылки")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--warehouses", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=42, help="Строк коэффициентов на склад (дни × типы)")
+    parser.add_argument("--ticks", type=int, default=20)
+    parser.add_argument("--change-rate", type=float, default=0.05)
+    parser.add_argument("--warehouses-per-user", type=int, default=3)
+    parser.add_argument("--coefficients-per-user", type=int, default=3)
+    parser.add_argument("--replay", help="Каталог с записанными ответами вместо синтетических")
+    parser.add_argument("--unlimited", action="store_true", help="Отключить лимиты Telegram в рассыльщике")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="Доля ответов 429 от заглушки Telegram")
+    parser.add_argument("--json", help="Сохранить отчёт в JSON")
+    parser.add_argument("--baseline", help="JSON-отчёт, с которым сравнивать")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    for key, value in report.items():
+        print(f"{key:>20}: {value:.2f}" if isinstance(value, float) else f"{key:>20}: {value}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            failures = check_regression(report, json.load(file), args.max_regression)
+        if failures:
+            print("Регрессия производительности:\n" + "\n".join(failures))
+            sys.exit(1)
+        print("Регрессий нет.")
+
+
+if __name__ == "__main__":
+    main()
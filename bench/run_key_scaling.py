@@ -0,0 +1,83 @@
+# Моделирование цикла опроса на поддельных часах: сколько раз в минуту опрашивается склад при разном числе
+# ключей API. Используются настоящие TokenPool и PollScheduler, сеть и event loop не нужны.
+#
+#   python -m bench.run_key_scaling --keys 1 2 3 6 --warehouses 6 --minutes 20
+#   python -m bench.run_key_scaling --check   # код возврата 1, если частота опроса не растёт с числом ключей
+import argparse
+import sys
+import time
+
+from api_tokens import ACQUIRE_TIMEOUT, TokenPool
+from scheduler import PollScheduler
+
+
+# Поддельные часы вместо time.monotonic
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+# Один прогон: тот же порядок действий, что в periodic_check; changing — склады меняются при каждом опросе
+def simulate(keys: int, warehouses: int, minutes: float, changing: bool = True) -> dict:
+    clock = FakeClock()
+    monotonic = time.monotonic
+    time.monotonic = clock
+    try:
+        pool = TokenPool([f"key{index}" for index in range(keys)])
+        scheduler = PollScheduler()
+        warehouse_ids = list(range(1, warehouses + 1))
+        finish = clock.now + minutes * 60
+        polls = requests = skipped = 0
+        while clock.now < finish:
+            scheduler.sync(warehouse_ids)
+            scheduler.scale(pool.active())
+            due = scheduler.due()
+            if due:
+                token, delay = pool.try_acquire()
+                if token is None and delay <= ACQUIRE_TIMEOUT:
+                    clock.now += delay
+                    token, _ = pool.try_acquire()
+                if token is None:
+                    skipped += 1
+                else:
+                    pool.release(token, 200)
+                    requests += 1
+                    polls += len(due)
+                    scheduler.report(due, set(due) if changing else set())
+            clock.now += scheduler.sleep_time()
+    finally:
+        time.monotonic = monotonic
+    return {
+        "keys": keys,
+        "polls_per_warehouse_per_minute": polls / warehouses / minutes,
+        "requests": requests,
+        "skipped": skipped,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Частота опроса складов в зависимости от числа ключей API")
+    parser.add_argument("--keys", type=int, nargs="+", default=[1, 2, 3, 6])
+    parser.add_argument("--warehouses", type=int, default=6)
+    parser.add_argument("--minutes", type=float, default=20)
+    parser.add_argument("--check", action="store_true", help="Проверить, что частота растёт с числом ключей")
+    args = parser.parse_args()
+
+    reports = [simulate(keys, args.warehouses, args.minutes) for keys in sorted(args.keys)]
+    for report in reports:
+        print(f"ключей: {report['keys']:>2}  опросов склада в минуту: {report['polls_per_warehouse_per_minute']:6.2f}"
+              f"  запросов: {report['requests']:>5}  пропущено циклов: {report['skipped']:>4}")
+
+    if args.check:
+        rates = [report["polls_per_warehouse_per_minute"] for report in reports]
+        if any(later <= earlier * 1.2 for earlier, later in zip(rates, rates[1:])):
+            print("Частота опроса не растёт с числом ключей.")
+            sys.exit(1)
+        print("Частота опроса растёт с числом ключей.")
+
+
+if __name__ == "__main__":
+    main()
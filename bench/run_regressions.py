@@ -0,0 +1,162 @@
+# Сценарии регрессий конвейера опроса на синтетических данных (без сети и Telegram).
+#
+#   python -m bench.run_regressions   # код возврата 1, если хотя бы один сценарий не прошёл
+import asyncio
+import json
+import random
+import sys
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import notifier as notifier_module
+from changes import CoefficientSnapshot
+from notifier import NotificationDispatcher
+from rules import AlertRule, RuleIndex
+
+
+def payload(rows: list) -> bytes:
+    return json.dumps([{"warehouseID": warehouse_id, "date": "2030-01-01T00:00:00Z", "coefficient": coefficient,
+                        "boxTypeID": 2, "boxTypeName": "Короба"} for warehouse_id, coefficient in rows]).encode()
+
+
+def poll(snapshot: CoefficientSnapshot, warehouse_ids: list, body: bytes):
+    fingerprint = snapshot.fingerprint(body)
+    if snapshot.is_unchanged(fingerprint, warehouse_ids):
+        return None
+    return snapshot.apply(snapshot.parse(body, warehouse_ids), fingerprint, warehouse_ids)
+
+
+# Группы складов пересекаются: ответ для {1, 2}, байт-в-байт совпадающий с прежним, после того как склад 1
+# изменился в опросе группы {1}, должен быть разобран, а не пропущен по отпечатку
+def overlapping_groups() -> list:
+    snapshot = CoefficientSnapshot()
+    first = payload([(1, 5), (2, 3)])
+    poll(snapshot, [1, 2], first)
+    poll(snapshot, [1], payload([(1, 0)]))
+    changeset = poll(snapshot, [1, 2], first)
+    failures = []
+    if changeset is None:
+        failures.append("повторный ответ группы {1, 2} пропущен по устаревшему отпечатку")
+    elif [(key[0], old, new) for key, old, new, _ in changeset.changed] != [(1, 0, 5)]:
+        failures.append(f"неожиданные изменения: {changeset.changed}")
+    if snapshot.cells[(1, "2030-01-01", 2)][0] != 5:
+        failures.append("снимок расходится с ответом API")
+    changeset = poll(snapshot, [1], payload([(1, 0)]))
+    if changeset is None or not changeset.changed:
+        failures.append("падение коэффициента 5 → 0 не дало изменения")
+    return failures
+
+
+# Бот-заглушка для рассыльщика: запоминает отправленные части, первую отправку в чат отклоняет по flood control
+class FloodOnceBot:
+    def __init__(self):
+        self.session = self
+        self.sent = []
+        self.flooded = set()
+
+    def middleware(self, middleware):
+        pass
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        await asyncio.sleep(0)
+        if chat_id not in self.flooded:
+            self.flooded.add(chat_id)
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), "Too Many Requests", 0)
+        self.sent.append((chat_id, text))
+
+
+# Сообщения одного чата приходят в порядке постановки, даже если первое отложено по RetryAfter,
+# длинное разбито на части, а лимит чата откладывает остальные
+def chat_order() -> list:
+    async def run() -> list:
+        bot = FloodOnceBot()
+        dispatcher = NotificationDispatcher(bot, max_message_length=10)
+        dispatcher.start()
+        expected = {}
+        for chat_id in (1, 2):
+            texts = [f"{chat_id}:{index}" for index in range(6)]
+            dispatcher.enqueue(chat_id, texts[0] + "\n" + "x" * 8)
+            expected[chat_id] = [texts[0], "x" * 8] + texts[1:]
+            for text in texts[1:]:
+                dispatcher.enqueue(chat_id, text)
+        await asyncio.wait_for(dispatcher.drain(), 10)
+        await dispatcher.stop()
+        failures = []
+        for chat_id, texts in expected.items():
+            sent = [text for sent_chat_id, text in bot.sent if sent_chat_id == chat_id]
+            if sent != texts:
+                failures.append(f"чат {chat_id}: порядок {sent} вместо {texts}")
+        if dispatcher.chat_queues or dispatcher.depth:
+            failures.append("после рассылки в очереди остались сообщения")
+        return failures
+
+    chat_rate = notifier_module.CHAT_RATE
+    notifier_module.CHAT_RATE = 50  # Лимит чата срабатывает, но не растягивает прогон
+    try:
+        return asyncio.run(run())
+    finally:
+        notifier_module.CHAT_RATE = chat_rate
+
+
+# Индекс правил отвечает так же, как полный перебор, в том числе после замены правил и при повторяющихся
+# правилах одного чата
+def rule_index() -> list:
+    rng = random.Random(1)
+
+    def random_rule() -> AlertRule:
+        low = rng.randint(0, 6)
+        lead_min, lead_max = rng.choice([(0, None), (0, None), (0, 3), (2, 7), (rng.randint(0, 10), None)])
+        return AlertRule(rng.choice([1, 1, 1, 2]), low, low + rng.randint(0, 4), lead_min, lead_max,
+                         rng.choice([0, 0, 1 << 2, 1 << 2 | 1 << 5]))
+
+    def matches(rule: AlertRule, warehouse_id, coefficient, box_type_id, lead_days) -> bool:
+        return (rule.warehouse_id == warehouse_id and rule.coefficient_min <= coefficient <= rule.coefficient_max
+                and rule.lead_min <= lead_days and (rule.lead_max is None or lead_days <= rule.lead_max)
+                and (not rule.box_types or rule.box_types >> box_type_id & 1))
+
+    index = RuleIndex()
+    rules_by_chat = {}
+    for chat_id in range(300):
+        rules = [random_rule() for _ in range(rng.randint(1, 4))]
+        rules.append(rules[0])
+        rules_by_chat[chat_id] = rules
+        index.set_rules(chat_id, rules)
+    for chat_id in range(0, 300, 3):
+        rules_by_chat[chat_id] = [random_rule()] if chat_id % 2 else []
+        index.set_rules(chat_id, rules_by_chat[chat_id])
+
+    failures = []
+    for warehouse_id in (1, 2, 3):
+        for coefficient in range(0, 12):
+            for box_type_id in (2, 5, 6):
+                for lead_days in range(0, 14):
+                    expected = {chat_id for chat_id, rules in rules_by_chat.items()
+                                if any(matches(rule, warehouse_id, coefficient, box_type_id, lead_days)
+                                       for rule in rules)}
+                    found = index.match(warehouse_id, coefficient, box_type_id, lead_days)
+                    if found != expected and len(failures) < 3:
+                        failures.append(f"склад {warehouse_id}, коэффициент {coefficient}, тип {box_type_id}, "
+                                        f"срок {lead_days}: лишние {found - expected}, пропущены {expected - found}")
+    for chat_id in list(rules_by_chat):
+        index.remove_chat(chat_id)
+    if index._buckets or len(index):
+        failures.append("после удаления всех правил индекс не пуст")
+    return failures
+
+
+SCENARIOS = [overlapping_groups, chat_order, rule_index]
+
+
+def main():
+    failed = False
+    for scenario in SCENARIOS:
+        failures = scenario()
+        print(f"{scenario.__name__}: {'ok' if not failures else '; '.join(failures)}")
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
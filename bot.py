@@ -1,28 +1,45 @@
 import logging
 import asyncio
+import os
+import sys
 import time
 import traceback
+from collections import Counter
+from datetime import date as date_type, datetime
+from functools import lru_cache
 
 from aiogram import Bot, Dispatcher, types, BaseMiddleware
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.utils.keyboard import InlineKeyboardBuilder
-
-from config import TELEGRAM_BOT_TOKEN
-from utils import get_acceptance_coefficients
-
-# Логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    handlers=[
-        logging.FileHandler("bot_errors.log", encoding="utf-8"),
-        logging.StreamHandler()
-    ]
-)
+from aiogram.filters import Command, CommandObject
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+
+from config import TELEGRAM_BOT_TOKEN, METRICS_HOST, METRICS_PORT, BOT_MODE, SHARD_WORKERS, POLL_LEASE, LOG_FILE
+import logsetup
+import memory
+import metrics
+import keyboards
+from api_tokens import ACQUIRE_TIMEOUT
+from leadership import LeaseLost, PollLease
+from keyboards import KeyboardEditDebouncer, KeyboardTemplates, decode_callback, mask_coefficients
+from catalog import WarehouseCatalog
+from changes import CoefficientSnapshot
+from notifier import NotificationDispatcher, GLOBAL_RATE, GLOBAL_BURST, PRIORITY_DIGEST, PRIORITY_URGENT, split_html
+from ratelimit import TokenBucket
+from resilience import supervise
+from rules import AlertRule, RuleIndex, MAX_COEFFICIENT, MAX_RULES_PER_CHAT, parse_range
+from scheduler import PollScheduler
+import sharding
+from sharding import HashRing, ShardRouterMiddleware, ShardSupervisor
+from snapshotfile import SnapshotFile
+from storage import StateStore
+from utils import get_acceptance_coefficients_payload
+from subscriptions import SubscriptionIndex
+from wb_client import wb_client
+from webhook import WebhookServer
+
+# Логирование: запись в файл и консоль идёт в фоновом потоке
+logsetup.setup_logging()
 
 # Инициализация бота
 bot = Bot(token=TELEGRAM_BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -31,9 +48,22 @@ dp = Dispatcher()
 # Максимальная длина сообщения в Telegram (безопасный лимит)
 MAX_MESSAGE_LENGTH = 4000
 
+# Сколько сообщений максимум отправлять в ответ на /history
+HISTORY_MAX_MESSAGES = 5
+
+# Очередь исходящих уведомлений с лимитами Telegram
+notifier = NotificationDispatcher(bot, MAX_MESSAGE_LENGTH)
+
 # Список коэффициентов для выбора
 COEFFICIENTS = list(range(0, 21))  # От 0 до 20 включительно
 
+# Типы поставки для фильтра подписки (boxTypeID в ответе API)
+BOX_TYPES = {
+    2: "Короба",
+    5: "Монопаллеты",
+    6: "Суперсейф",
+}
+
 # Разрешённые ID пользователей
 ALLOWED_USERS = [
     1391599879,
@@ -43,7 +73,7 @@ ALLOWED_USERS = [
     893576709,
 ]  # Добавьте сюда разрешённые ID пользователей
 
-# Список складов с информацией
+# Запасной список складов — пока каталог ещё ни разу не загружен из API
 WAREHOUSES = [
     {
         "ID": 2737, "name": "Санкт-Петербург (Уткина Заводь)",
@@ -63,9 +93,43 @@ WAREHOUSES = [
      "workTime": "24/7", "acceptsQR": True}
 ]
 
+# Каталог складов: загружается из базы при запуске и обновляется из /warehouses в фоне
+catalog = WarehouseCatalog(WAREHOUSES)
+
 # Словарь для хранения данных пользователей
 user_data = {}
 
+# Индекс подписок (склад, коэффициент) -> пользователи, обновляется при каждом выборе
+subscriptions = SubscriptionIndex()
+
+# Счётчики текущего цикла опроса: вместо строки лога на каждое событие — одна итоговая строка за цикл
+tick_counts = Counter()
+
+# Скомпилированные правила уведомлений с диапазонами (дополняют выбор отдельных коэффициентов)
+rules = RuleIndex()
+
+# Общий снимок коэффициентов с предыдущего опроса API
+snapshot = CoefficientSnapshot()
+snapshot_file = SnapshotFile()
+
+# Хранилище состояния в SQLite (запись пакетами в фоне)
+store = StateStore()
+
+# Адаптивный планировщик опроса складов
+scheduler = PollScheduler()
+
+# Объединение быстрых нажатий на инлайн-кнопки в одно редактирование сообщения
+keyboard_editor = KeyboardEditDebouncer()
+
+# Заранее собранные кнопки выбора складов и коэффициентов
+keyboard_templates = KeyboardTemplates(catalog, COEFFICIENTS, BOX_TYPES)
+
+# Супервизор воркеров шардов (только в процессе-поллере при SHARD_WORKERS > 1)
+shard_supervisor = None
+
+# Состояние опроса, присланное супервизором (только в процессе-воркере шарда)
+shard_poll_status = None
+
 
 class AuthorizationMiddleware(BaseMiddleware):
     async def __call__(self, handler, event, data):
@@ -89,20 +153,36 @@ class AuthorizationMiddleware(BaseMiddleware):
 # Регистрируем middleware авторизации
 dp.update.middleware.register(AuthorizationMiddleware())
 
+# Замер времени обработки по хендлерам (хендлер известен только на уровне конкретного типа апдейта)
+dp.message.middleware.register(metrics.TimingMiddleware())
+dp.callback_query.middleware.register(metrics.TimingMiddleware())
+
 
 # Стартовая команда для запроса складов
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     chat_id = message.chat.id
+    subscriptions.remove_chat(chat_id)
+    previous = user_data.get(chat_id, {})
     user_data[chat_id] = {
         'selected_warehouses': [],
         'selected_coefficients': {},
-        'known_coeffs': {},
         'last_message_id': None,
         'last_keyboard': None,
+        'last_text': None,
+        'warehouse_page': None,
+        'warehouse_query': None,
         'current_warehouse_index': 0,
-        'setup_complete': False  # Инициализируем флаг настройки
+        'setup_complete': False,  # Инициализируем флаг настройки
+        # Настройки сводок и типов поставки переживают повторный /start
+        'digest': previous.get('digest', True),
+        'selected_box_types': previous.get('selected_box_types', 0),
+        'rules': previous.get('rules', []),
+        # Пары (склад, коэффициент), по которым текущие слоты уже отправлены при прошлом подтверждении
+        'notified_coefficients': previous.get('notified_coefficients', {})
     }
+    subscriptions.set_box_types(chat_id, user_data[chat_id]['selected_box_types'])
+    store.mark_user(chat_id)
 
     # Отправляем сообщение с инлайн-кнопками для выбора складов
     await send_warehouse_selection(chat_id, message)
@@ -117,24 +197,23 @@ async def cmd_start(message: types.Message):
 
 # Функция для отправки инлайн-кнопок для выбора складов
 async def send_warehouse_selection(chat_id: int, message: types.Message):
-    keyboard_builder = InlineKeyboardBuilder()
-
-    for warehouse in WAREHOUSES:
-        action_text = "❌ Удалить" if warehouse['ID'] in user_data[chat_id]['selected_warehouses'] else "✅ Добавить"
-        keyboard_builder.button(
-            text=f"{action_text} {warehouse['name']}",
-            callback_data=f"toggle_warehouse_{warehouse['ID']}"
-        )
-
-    # Организуем кнопки в столбик
-    keyboard_builder.adjust(1)
-
-    inline_keyboard = keyboard_builder.as_markup()
+    # Открытый экран выбора складов отмечен номером страницы; текст в чате на этом экране — поиск
+    if user_data[chat_id].get('warehouse_page') is None:
+        user_data[chat_id]['warehouse_page'] = 0
+    inline_keyboard = keyboard_templates.warehouse_keyboard(user_data[chat_id]['selected_warehouses'],
+                                                            user_data[chat_id]['warehouse_page'],
+                                                            user_data[chat_id].get('warehouse_query'))
 
     if user_data[chat_id]['last_message_id'] is None:
-        sent_message = await message.answer("🛒 Выберите склады для отслеживания:", reply_markup=inline_keyboard)
+        sent_message = await message.answer(
+            "🛒 Выберите склады для отслеживания (для поиска напишите часть названия):",
+            reply_markup=inline_keyboard)
         user_data[chat_id]['last_message_id'] = sent_message.message_id
+        store.mark_user(chat_id)
         user_data[chat_id]['last_keyboard'] = inline_keyboard
+    elif inline_keyboard == user_data[chat_id]['last_keyboard']:
+        # Клавиатура не изменилась — лишний запрос к Telegram не нужен
+        return
     else:
         try:
             await bot.edit_message_reply_markup(
@@ -148,23 +227,42 @@ async def send_warehouse_selection(chat_id: int, message: types.Message):
 
 
 # Обработка выбора склада через инлайн-кнопки
-@dp.callback_query(lambda call: call.data.startswith("toggle_warehouse_"))
-async def process_inline_warehouse_selection(callback_query: types.CallbackQuery):
+async def process_inline_warehouse_selection(callback_query: types.CallbackQuery, warehouse_id: int):
     chat_id = callback_query.message.chat.id
-    warehouse_id = int(callback_query.data.split("_")[2])
+    if catalog.get(warehouse_id) is None and warehouse_id not in user_data[chat_id]['selected_warehouses']:
+        await callback_query.answer("Склад не найден в каталоге.", show_alert=True)
+        return
 
     # Добавляем или удаляем склад из выбранных
     if warehouse_id not in user_data[chat_id]['selected_warehouses']:
         user_data[chat_id]['selected_warehouses'].append(warehouse_id)
+        subscriptions.add_warehouse(chat_id, warehouse_id)
         await callback_query.answer(f"📦 Склад добавлен в отслеживаемые.")
     else:
         user_data[chat_id]['selected_warehouses'].remove(warehouse_id)
         # Удаляем выбранные коэффициенты для этого склада
         user_data[chat_id]['selected_coefficients'].pop(warehouse_id, None)
+        subscriptions.remove_warehouse(chat_id, warehouse_id)
         await callback_query.answer(f"📦 Склад удален из отслеживаемых.")
+    store.mark_user(chat_id)
 
-    # Обновляем инлайн-кнопки с актуальным состоянием
+    # Обновляем инлайн-кнопки после паузы, применяя только последнее состояние
+    keyboard_editor.schedule(chat_id, lambda: send_warehouse_selection(chat_id, callback_query.message))
+
+
+# Листание каталога складов (сбрасывает поиск)
+async def process_warehouse_page(callback_query: types.CallbackQuery, page: int):
+    chat_id = callback_query.message.chat.id
+    keyboard_editor.cancel(chat_id)
+    user_data[chat_id]['warehouse_page'] = max(page, 0)
+    user_data[chat_id]['warehouse_query'] = None
     await send_warehouse_selection(chat_id, callback_query.message)
+    await callback_query.answer()
+
+
+# Кнопка без действия (номер страницы)
+async def process_noop(callback_query: types.CallbackQuery):
+    await callback_query.answer()
 
 
 # Подтверждение выбора складов
@@ -172,10 +270,14 @@ async def process_inline_warehouse_selection(callback_query: types.CallbackQuery
 async def confirm_warehouse_selection(message: types.Message):
     chat_id = message.chat.id
     selected_warehouses_ids = user_data[chat_id]['selected_warehouses']
+    keyboard_editor.cancel(chat_id)
 
     if selected_warehouses_ids:
         # Переходим к выбору коэффициентов для каждого склада
         user_data[chat_id]['current_warehouse_index'] = 0  # Сбрасываем индекс склада
+        user_data[chat_id]['warehouse_page'] = None
+        user_data[chat_id]['warehouse_query'] = None
+        store.mark_user(chat_id)
         await send_coefficient_selection(chat_id, message)
     else:
         await message.answer("Вы не выбрали ни одного склада.")
@@ -188,65 +290,33 @@ async def send_coefficient_selection(chat_id: int, message: types.Message):
         selected_warehouses = user_data[chat_id]['selected_warehouses']
 
         warehouse_id = selected_warehouses[warehouse_index]
-        warehouse = next((w for w in WAREHOUSES if w['ID'] == warehouse_id), {})
-        warehouse_name = warehouse.get('name', 'Неизвестный склад')
-
-        keyboard_builder = InlineKeyboardBuilder()
-
-        for coeff in COEFFICIENTS:
-            action_text = "❌" if coeff in user_data[chat_id].get('selected_coefficients', {}).get(warehouse_id,
-                                                                                                  []) else "✅"
-            keyboard_builder.button(
-                text=f"{action_text} {coeff}",
-                callback_data=f"toggle_coefficient_{warehouse_id}_{coeff}"
-            )
-
-        # Организуем кнопки в два столбца
-        keyboard_builder.adjust(2)
-
-        # Навигационные кнопки
-        navigation_buttons = []
+        warehouse_name = catalog.name(warehouse_id)
 
-        if warehouse_index > 0:
-            back_button = InlineKeyboardButton(text="⬅️ Назад", callback_data="prev_warehouse")
-            navigation_buttons.append(back_button)
-
-        if warehouse_index < len(selected_warehouses) - 1:
-            next_button = InlineKeyboardButton(text="➡️ Далее", callback_data="next_warehouse")
-            navigation_buttons.append(next_button)
-        else:
-            confirm_button = InlineKeyboardButton(
-                text="✅ Подтвердить выбор коэффициентов",
-                callback_data="confirm_coefficients"
-            )
-            navigation_buttons.append(confirm_button)
-
-        # Добавляем дополнительные кнопки "Главное Меню"
-        main_menu_button = InlineKeyboardButton(text="🏠 Главное Меню", callback_data="main_menu")
-        navigation_buttons.append(main_menu_button)
-
-        # Добавляем навигационные кнопки в клавиатуру
-        keyboard_builder.row(*navigation_buttons)
-
-        inline_keyboard = keyboard_builder.as_markup()
+        mask = user_data[chat_id]['selected_coefficients'].get(warehouse_id, 0)
+        inline_keyboard = keyboard_templates.coefficient_keyboard(
+            warehouse_id, mask, warehouse_index > 0, warehouse_index == len(selected_warehouses) - 1)
+        text = f"🔢 Выберите коэффициенты для склада <b>{warehouse_name}</b>:"
 
         # Отправляем или обновляем сообщение
         if user_data[chat_id]['last_message_id'] is None:
-            sent_message = await message.answer(
-                f"🔢 Выберите коэффициенты для склада <b>{warehouse_name}</b>:",
-                reply_markup=inline_keyboard
-            )
+            sent_message = await message.answer(text, reply_markup=inline_keyboard)
             user_data[chat_id]['last_message_id'] = sent_message.message_id
             user_data[chat_id]['last_keyboard'] = inline_keyboard
+            user_data[chat_id]['last_text'] = text
+            store.mark_user(chat_id)
+        elif inline_keyboard == user_data[chat_id]['last_keyboard'] and text == user_data[chat_id].get('last_text'):
+            # Ни текст, ни клавиатура не изменились — лишний запрос к Telegram не нужен
+            return
         else:
             try:
                 await bot.edit_message_text(
                     chat_id=chat_id,
                     message_id=user_data[chat_id]['last_message_id'],
-                    text=f"🔢 Выберите коэффициенты для склада <b>{warehouse_name}</b>:",
+                    text=text,
                     reply_markup=inline_keyboard
                 )
                 user_data[chat_id]['last_keyboard'] = inline_keyboard
+                user_data[chat_id]['last_text'] = text
             except Exception as e:
                 logging.error(f"Ошибка при обновлении инлайн-кнопок коэффициентов: {e}")
     except Exception as e:
@@ -255,73 +325,84 @@ async def send_coefficient_selection(chat_id: int, message: types.Message):
 
 
 # Обработка выбора коэффициентов через инлайн-кнопки
-@dp.callback_query(lambda call: call.data.startswith("toggle_coefficient_"))
-async def process_inline_coefficient_selection(callback_query: types.CallbackQuery):
+async def process_inline_coefficient_selection(callback_query: types.CallbackQuery, warehouse_id: int,
+                                               coefficient: int):
     chat_id = callback_query.message.chat.id
-    data_parts = callback_query.data.split("_")
-    warehouse_id = int(data_parts[2])
-    coefficient = int(data_parts[3])
-
-    # Добавляем или удаляем коэффициент из выбранных для данного склада
-    selected_coeffs = user_data[chat_id].setdefault('selected_coefficients', {}).setdefault(warehouse_id, [])
-    if coefficient not in selected_coeffs:
-        selected_coeffs.append(coefficient)
+    if coefficient not in COEFFICIENTS:
+        await callback_query.answer()
+        return
+
+    # Добавляем или удаляем коэффициент из выбранных для данного склада (бит в маске)
+    selected_coefficients = user_data[chat_id]['selected_coefficients']
+    mask = selected_coefficients.get(warehouse_id, 0) ^ (1 << coefficient)
+    if mask:
+        selected_coefficients[warehouse_id] = mask
+    else:
+        selected_coefficients.pop(warehouse_id, None)
+    if mask >> coefficient & 1:
+        subscriptions.add_coefficient(chat_id, warehouse_id, coefficient)
         await callback_query.answer(f"➕ Коэффициент {coefficient} добавлен.")
     else:
-        selected_coeffs.remove(coefficient)
+        subscriptions.remove_coefficient(chat_id, warehouse_id, coefficient)
         await callback_query.answer(f"➖ Коэффициент {coefficient} удален.")
+    store.mark_user(chat_id)
 
-    # Обновляем инлайн-кнопки с актуальным состоянием
-    await send_coefficient_selection(chat_id, callback_query.message)
+    # Обновляем инлайн-кнопки после паузы, применяя только последнее состояние
+    keyboard_editor.schedule(chat_id, lambda: send_coefficient_selection(chat_id, callback_query.message))
 
 
-# Обработка навигационных кнопок
-@dp.callback_query(lambda call: call.data in ["next_warehouse", "prev_warehouse", "main_menu"])
-async def process_navigation(callback_query: types.CallbackQuery):
+# Переход к следующему складу
+async def process_next_warehouse(callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
-    action = callback_query.data
+    keyboard_editor.cancel(chat_id)
+    warehouse_index = user_data[chat_id]['current_warehouse_index']
+    selected_warehouses = user_data[chat_id]['selected_warehouses']
+    warehouse_id = selected_warehouses[warehouse_index]
 
-    if action == "next_warehouse":
-        warehouse_index = user_data[chat_id]['current_warehouse_index']
-        selected_warehouses = user_data[chat_id]['selected_warehouses']
-        warehouse_id = selected_warehouses[warehouse_index]
+    # Проверяем, выбраны ли коэффициенты для текущего склада
+    if not user_data[chat_id]['selected_coefficients'].get(warehouse_id, 0):
+        await callback_query.answer("❗️ Пожалуйста, выберите хотя бы один коэффициент.", show_alert=True)
+        return
 
-        # Проверяем, выбраны ли коэффициенты для текущего склада
-        selected_coeffs = user_data[chat_id]['selected_coefficients'].get(warehouse_id, [])
-        if not selected_coeffs:
-            await callback_query.answer("❗️ Пожалуйста, выберите хотя бы один коэффициент.", show_alert=True)
-            return
+    # Увеличиваем индекс только если не на последнем складе
+    if warehouse_index < len(selected_warehouses) - 1:
+        user_data[chat_id]['current_warehouse_index'] += 1  # Переходим к следующему складу
+        store.mark_user(chat_id)
+        await send_coefficient_selection(chat_id, callback_query.message)
+    else:
+        await callback_query.answer("Вы на последнем складе.", show_alert=True)
 
-        # Увеличиваем индекс только если не на последнем складе
-        if warehouse_index < len(selected_warehouses) - 1:
-            user_data[chat_id]['current_warehouse_index'] += 1  # Переходим к следующему складу
-            await send_coefficient_selection(chat_id, callback_query.message)
-        else:
-            await callback_query.answer("Вы на последнем складе.", show_alert=True)
 
-    elif action == "prev_warehouse":
-        if user_data[chat_id]['current_warehouse_index'] > 0:
-            user_data[chat_id]['current_warehouse_index'] -= 1  # Переходим к предыдущему складу
-            await send_coefficient_selection(chat_id, callback_query.message)
-        else:
-            await callback_query.answer("Вы на первом складе.", show_alert=True)
+# Возврат к предыдущему складу
+async def process_prev_warehouse(callback_query: types.CallbackQuery):
+    chat_id = callback_query.message.chat.id
+    keyboard_editor.cancel(chat_id)
+    if user_data[chat_id]['current_warehouse_index'] > 0:
+        user_data[chat_id]['current_warehouse_index'] -= 1  # Переходим к предыдущему складу
+        store.mark_user(chat_id)
+        await send_coefficient_selection(chat_id, callback_query.message)
+    else:
+        await callback_query.answer("Вы на первом складе.", show_alert=True)
+
 
-    elif action == "main_menu":
-        await send_main_menu(chat_id, callback_query.message)
-        await callback_query.answer("Перешли в Главное Меню.")
+# Обработка кнопки "Главное Меню" под инлайн-клавиатурой
+async def process_main_menu(callback_query: types.CallbackQuery):
+    chat_id = callback_query.message.chat.id
+    keyboard_editor.cancel(chat_id)
+    await send_main_menu(chat_id, callback_query.message)
+    await callback_query.answer("Перешли в Главное Меню.")
 
 
 # Обработка нажатия кнопки "✅ Подтвердить выбор коэффициентов"
-@dp.callback_query(lambda call: call.data == "confirm_coefficients")
 async def process_confirm_coefficients(callback_query: types.CallbackQuery):
     chat_id = callback_query.message.chat.id
+    keyboard_editor.cancel(chat_id)
     warehouse_index = user_data[chat_id]['current_warehouse_index']
     selected_warehouses = user_data[chat_id]['selected_warehouses']
     warehouse_id = selected_warehouses[warehouse_index]
 
     # Проверяем, выбраны ли коэффициенты для текущего склада
-    selected_coeffs = user_data[chat_id]['selected_coefficients'].get(warehouse_id, [])
-    if not selected_coeffs:
+    if not user_data[chat_id]['selected_coefficients'].get(warehouse_id, 0):
         await callback_query.answer("❗️ Пожалуйста, выберите хотя бы один коэффициент.", show_alert=True)
         return
 
@@ -331,6 +412,7 @@ async def process_confirm_coefficients(callback_query: types.CallbackQuery):
     else:
         # Перейти к следующему складу, если он не последний
         user_data[chat_id]['current_warehouse_index'] += 1
+        store.mark_user(chat_id)
         await send_coefficient_selection(chat_id, callback_query.message)
 
 
@@ -342,9 +424,8 @@ async def finalize_selection(chat_id: int, message: types.Message):
     # Формируем сообщение с итоговым выбором
     response_message = "✅ <b>Ваш выбор:</b>\n"
     for warehouse_id in selected_warehouses_ids:
-        warehouse = next((w for w in WAREHOUSES if w['ID'] == warehouse_id), {})
-        warehouse_name = warehouse.get('name', 'Неизвестный склад')
-        coeffs = selected_coefficients.get(warehouse_id, [])
+        warehouse_name = catalog.name(warehouse_id)
+        coeffs = mask_coefficients(selected_coefficients.get(warehouse_id, 0))
         coeffs_text = ", ".join(map(str, coeffs)) if coeffs else "Нет выбранных коэффициентов"
         response_message += f"\n🏢 <b>{warehouse_name}</b>\n🔢 <b>Коэффициенты:</b> {coeffs_text}\n"
 
@@ -352,6 +433,16 @@ async def finalize_selection(chat_id: int, message: types.Message):
 
     # Устанавливаем флаг, что настройка завершена
     user_data[chat_id]['setup_complete'] = True
+    store.mark_user(chat_id)
+
+    # Сообщаем о подходящих коэффициентах, которые уже есть в снимке, только по парам (склад, коэффициент),
+    # добавленным с прошлого подтверждения: по остальным пользователь уже получил и слоты, и их изменения
+    notified_coefficients = user_data[chat_id].get('notified_coefficients', {})
+    notify_current_coefficients(chat_id, {
+        warehouse_id: mask & ~notified_coefficients.get(warehouse_id, 0)
+        for warehouse_id, mask in selected_coefficients.items()
+    })
+    user_data[chat_id]['notified_coefficients'] = dict(selected_coefficients)
 
     # Удаляем сообщение с инлайн-кнопками
     if user_data[chat_id]['last_message_id']:
@@ -359,7 +450,9 @@ async def finalize_selection(chat_id: int, message: types.Message):
             await bot.delete_message(chat_id, user_data[chat_id]['last_message_id'])
             user_data[chat_id]['last_message_id'] = None
             user_data[chat_id]['last_keyboard'] = None
+            user_data[chat_id]['last_text'] = None
             user_data[chat_id]['current_warehouse_index'] = 0
+            store.mark_user(chat_id)
         except Exception as e:
             logging.error(f"Ошибка при удалении сообщения: {e}")
 
@@ -379,8 +472,10 @@ async def change_warehouse_selection(message: types.Message):
 
     # Сбрасываем выбор коэффициентов и флаг завершения настройки
     user_data[chat_id]['selected_coefficients'] = {}
+    subscriptions.clear_coefficients(chat_id)
     user_data[chat_id]['current_warehouse_index'] = 0
     user_data[chat_id]['setup_complete'] = False  # Сбрасываем флаг настройки
+    store.mark_user(chat_id)
 
     # Отправляем инлайн-кнопки для редактирования выбранных складов
     await send_warehouse_selection(chat_id, message)
@@ -406,127 +501,350 @@ async def send_main_menu(chat_id: int, message: types.Message):
     await bot.send_message(chat_id, "🏠 Главное Меню:", reply_markup=main_menu_keyboard)
 
 
-# Функция для обработки коэффициентов для каждого пользователя
-async def process_coefficients_for_user(chat_id: int, data: dict, coefficients: list):
-    # Проверяем, завершил ли пользователь настройку
-    if not data.get('setup_complete', False):
-        return  # Если нет, не обрабатываем коэффициенты
-
-    selected_warehouses = data.get('selected_warehouses', [])
-    selected_coefficients = data.get('selected_coefficients', {})
-    known_coeffs = data.setdefault('known_coeffs', {})
-
-    new_or_changed_coeffs_found = False
-
-    for coefficient in coefficients:
-        warehouse_id = coefficient['warehouseID']
-        date = coefficient['date'].split("T")[0]
-        coeff_value = coefficient['coefficient']
-
-        if warehouse_id in selected_warehouses:
-            if coeff_value in selected_coefficients.get(warehouse_id, []):
-                # Проверяем, что этот коэффициент новый или изменился для пользователя
-                known_coeffs_warehouse = known_coeffs.setdefault(warehouse_id, {})
-                previous_coeff_value = known_coeffs_warehouse.get(date)
-
-                if previous_coeff_value is None:
-                    # Новый коэффициент
-                    warehouse = next((w for w in WAREHOUSES if w['ID'] == warehouse_id), {})
-                    message_text = (
-                        f"📢 <b>Новый коэффициент!</b>\n"
-                        f"🏢 <b>Склад:</b> {warehouse.get('name', 'Неизвестный склад')}\n"
-                        f"📅 <b>Дата:</b> {date}\n"
-                        f"📊 <b>Коэффициент:</b> {coeff_value}\n"
-                        f"📦 <b>Тип поставки:</b> {coefficient['boxTypeName']}\n\n"
-                    )
-
-                    # Отправляем сообщение о новом коэффициенте
-                    await send_long_message(chat_id, message_text)
-
-                    # Сохраняем коэффициент
-                    known_coeffs_warehouse[date] = coeff_value
-                    new_or_changed_coeffs_found = True
-
-                elif previous_coeff_value != coeff_value:
-                    # Коэффициент изменился
-                    warehouse = next((w for w in WAREHOUSES if w['ID'] == warehouse_id), {})
-                    message_text = (
-                        f"🔄 <b>Изменение коэффициента!</b>\n"
-                        f"🏢 <b>Склад:</b> {warehouse.get('name', 'Неизвестный склад')}\n"
-                        f"📅 <b>Дата:</b> {date}\n"
-                        f"📊 <b>Старый коэффициент:</b> {previous_coeff_value}\n"
-                        f"📊 <b>Новый коэффициент:</b> {coeff_value}\n"
-                        f"📦 <b>Тип поставки:</b> {coefficient['boxTypeName']}\n\n"
-                    )
-
-                    # Отправляем сообщение об изменении коэффициента
-                    await send_long_message(chat_id, message_text)
-
-                    # Обновляем коэффициент
-                    known_coeffs_warehouse[date] = coeff_value
-                    new_or_changed_coeffs_found = True
-
-    if not new_or_changed_coeffs_found:
-        logging.info(f"No new or changed coefficients for chat {chat_id}.")
+# Формирование сообщения о новом коэффициенте (текст кэшируется и переиспользуется для всех получателей)
+@lru_cache(maxsize=4096)
+def format_new_coefficient(warehouse_id: int, date: str, coeff_value: int, box_type_name: str) -> str:
+    return (
+        f"📢 <b>Новый коэффициент!</b>\n"
+        f"🏢 <b>Склад:</b> {catalog.name(warehouse_id)}\n"
+        f"📅 <b>Дата:</b> {date}\n"
+        f"📊 <b>Коэффициент:</b> {coeff_value}\n"
+        f"📦 <b>Тип поставки:</b> {box_type_name}\n\n"
+    )
+
+
+# Формирование сообщения об изменении коэффициента
+@lru_cache(maxsize=4096)
+def format_changed_coefficient(warehouse_id: int, date: str, previous_coeff_value: int, coeff_value: int,
+                               box_type_name: str) -> str:
+    return (
+        f"🔄 <b>Изменение коэффициента!</b>\n"
+        f"🏢 <b>Склад:</b> {catalog.name(warehouse_id)}\n"
+        f"📅 <b>Дата:</b> {date}\n"
+        f"📊 <b>Старый коэффициент:</b> {previous_coeff_value}\n"
+        f"📊 <b>Новый коэффициент:</b> {coeff_value}\n"
+        f"📦 <b>Тип поставки:</b> {box_type_name}\n\n"
+    )
+
+
+# Заголовок сводки из нескольких событий одного опроса
+def format_digest(urgent: bool, count: int) -> str:
+    if urgent:
+        return f"🆓 <b>Бесплатная приёмка: {count}</b>\n\n"
+    return f"📬 <b>Сводка изменений: {count}</b>\n\n"
+
+
+# Событие в очереди рассылки одного опроса: (срочные тексты, обычные тексты) по chat_id
+def add_pending(pending: dict, chat_id: int, coeff_value: int, message_text: str):
+    lanes = pending.get(chat_id)
+    if lanes is None:
+        lanes = pending[chat_id] = ([], [])
+    lanes[0 if coeff_value == 0 else 1].append(message_text)
+
+
+# Постановка собранных событий в очередь: бесплатные слоты — в срочную полосу, остальное — в обычную.
+# Со включённой сводкой все события полосы уходят одним сообщением (длинное делится по границам абзацев).
+def enqueue_pending(pending: dict):
+    for chat_id, lanes in pending.items():
+        digest = user_data[chat_id].get('digest', True)
+        for priority, texts in zip((PRIORITY_URGENT, PRIORITY_DIGEST), lanes):
+            if not texts:
+                continue
+            if not digest:
+                for message_text in texts:
+                    notifier.enqueue(chat_id, message_text, priority)
+            elif len(texts) == 1:
+                notifier.enqueue(chat_id, texts[0], priority)
+            else:
+                notifier.enqueue(chat_id, format_digest(priority == PRIORITY_URGENT, len(texts)) + "".join(texts),
+                                 priority)
+
+
+# Получатели ячейки: выбравшие этот коэффициент склада (после завершения настройки)
+# и те, чьи правила под неё подходят (правила действуют и без настройки, и пока она повторяется через /start)
+def match_recipients(warehouse_id: int, date: str, coeff_value: int, box_type_id: int, days: dict):
+    chat_ids = {chat_id for chat_id in subscriptions.match(warehouse_id, coeff_value, box_type_id)
+                if user_data[chat_id].get('setup_complete', False)}
+    if rules.tracks(warehouse_id):
+        day = days.get(date)
+        if day is None:
+            day = days[date] = date_type.fromisoformat(date).toordinal()
+        rule_chat_ids = rules.match(warehouse_id, coeff_value, box_type_id, day - days['today'])
+        if rule_chat_ids:
+            return rule_chat_ids.union(chat_ids)
+    return chat_ids
+
+
+# Рассылка набора изменений: каждое изменение затрагивает только подписанных на него пользователей
+def process_changeset(changeset):
+    pending = {}
+    days = {'today': date_type.today().toordinal()}  # Дата -> порядковый номер дня (для сроков в правилах)
+
+    for (warehouse_id, date, box_type_id), coeff_value, box_type_name in changeset.inserted:
+        chat_ids = match_recipients(warehouse_id, date, coeff_value, box_type_id, days)
+        if not chat_ids:
+            continue
+        # Текст формируется один раз на событие, а не на каждого получателя
+        message_text = format_new_coefficient(warehouse_id, date, coeff_value, box_type_name)
+        for chat_id in chat_ids:
+            add_pending(pending, chat_id, coeff_value, message_text)
+
+    for (warehouse_id, date, box_type_id), previous_coeff_value, coeff_value, box_type_name in changeset.changed:
+        chat_ids = match_recipients(warehouse_id, date, coeff_value, box_type_id, days)
+        if not chat_ids:
+            continue
+        message_text = format_changed_coefficient(warehouse_id, date, previous_coeff_value, coeff_value,
+                                                  box_type_name)
+        for chat_id in chat_ids:
+            add_pending(pending, chat_id, coeff_value, message_text)
+
+    if pending:
+        enqueue_pending(pending)
+        tick_counts['notified_chats'] += len(pending)
+
+
+# Отправка пользователю коэффициентов из текущего снимка по выбранным парам (склад -> маска коэффициентов)
+# с учётом его фильтра типов поставки (после завершения настройки)
+def notify_current_coefficients(chat_id: int, coefficients: dict):
+    if not any(coefficients.values()):
+        return
+    pending = {}
+    box_types = user_data[chat_id].get('selected_box_types', 0)
+    for (warehouse_id, date, box_type_id), (coeff_value, box_type_name) in list(snapshot.cells.items()):
+        if (coeff_value >= 0 and coefficients.get(warehouse_id, 0) >> coeff_value & 1
+                and (not box_types or box_types >> box_type_id & 1)):
+            add_pending(pending, chat_id, coeff_value,
+                        format_new_coefficient(warehouse_id, date, coeff_value, box_type_name))
+    enqueue_pending(pending)
+
+
+# Один цикл опроса: запрос к API, вычисление изменений и рассылка; возвращает склады, где что-то изменилось
+async def poll_warehouses(warehouse_ids: list, token=None) -> set:
+    # Получаем коэффициенты из API для складов, которые пора опросить
+    with metrics.registry.timer("bot_poll_stage_seconds", stage="fetch"):
+        payload = await get_acceptance_coefficients_payload(warehouse_ids, token)
+    if payload is None:
+        logging.error("Не удалось получить коэффициенты из API.")
+        tick_counts['failed'] += 1
+        return set()
+
+    # Супервизор шардов не знает подписок воркеров, поэтому типы поставки фильтруются только без шардов
+    box_type_ids = tracked_box_type_ids() if shard_supervisor is None else None
+    fingerprint = snapshot.fingerprint(payload)
+    if snapshot.is_unchanged(fingerprint, warehouse_ids, box_type_ids):
+        tick_counts['unchanged'] += 1
+        return set()
+
+    # Вычисляем изменения один раз и рассылаем их подписанным пользователям
+    with metrics.registry.timer("bot_poll_stage_seconds", stage="parse"):
+        columns = snapshot.parse(payload, warehouse_ids, box_type_ids)
+    if not columns:
+        # Пустой ответ не означает, что все слоты пропали: снимок не трогаем
+        logging.warning("API вернуло пустой список коэффициентов.")
+        tick_counts['empty'] += 1
+        return set()
+    with metrics.registry.timer("bot_poll_stage_seconds", stage="diff"):
+        changeset = snapshot.apply(columns, fingerprint, warehouse_ids, box_type_ids)
+        store.record_changeset(changeset)
+    # Снимок сохраняется до рассылки: после падения и перезапуска эти изменения не будут разосланы повторно
+    await snapshot_file.save(snapshot)
+    with metrics.registry.timer("bot_poll_stage_seconds", stage="fanout"):
+        if shard_supervisor is not None:
+            # Рассылкой занимаются воркеры, каждый — по своим чатам
+            shard_supervisor.publish(changeset)
+        else:
+            process_changeset(changeset)
+    metrics.registry.increment("bot_changes_total", len(changeset.inserted), kind="inserted")
+    metrics.registry.increment("bot_changes_total", len(changeset.changed), kind="changed")
+    metrics.registry.increment("bot_changes_total", len(changeset.removed), kind="removed")
+    tick_counts['inserted'] += len(changeset.inserted)
+    tick_counts['changed'] += len(changeset.changed)
+    tick_counts['removed'] += len(changeset.removed)
+    return changeset.warehouse_ids()
+
+
+# Итоговая строка лога за цикл опроса (счётчики цикла и переданные поля, в JSON — отдельным объектом tick)
+def log_tick_summary(**fields):
+    counts = dict(tick_counts, **fields)
+    tick_counts.clear()
+    logging.info("Цикл опроса: " + ", ".join(f"{name}={value}" for name, value in counts.items()),
+                 extra={'tick': counts})
+
+
+# Склады, которые нужны подпискам или правилам этого процесса
+def tracked_warehouse_ids() -> set:
+    return set(subscriptions.warehouse_ids()).union(rules.warehouse_ids())
+
+
+# Типы поставки, которые нужны подпискам и правилам; None — нужны все
+def tracked_box_type_ids():
+    sources = []
+    if subscriptions.warehouse_ids():
+        sources.append(subscriptions.box_type_ids())
+    if rules.warehouse_ids():
+        sources.append(rules.box_type_ids())
+    if not sources or None in sources:
+        return None
+    return set().union(*sources)
+
+
+# Вытеснение из снимка прошедших дат (раз в сутки, при смене даты); удалённые ячейки уходят и из базы
+def evict_past_dates(today: str):
+    changeset = snapshot.evict_before(today)
+    if changeset:
+        store.record_changeset(changeset)
+        if shard_supervisor is not None:
+            shard_supervisor.publish(changeset)
+    logging.info(f"Из снимка вытеснено ячеек прошедших дат: {len(changeset)}, осталось: {len(snapshot.cells)}")
+    for name, size, items, per_item in memory.accounting.report():
+        logging.info(f"Память {name}: {size} байт, элементов: {items}, на элемент: {per_item:.1f} байт")
 
 
 # Периодическая проверка новых коэффициентов
 async def periodic_check():
+    idle_logged = False  # Сообщение об отсутствии складов пишется один раз, а не каждый цикл
     while True:
-        # Собираем все уникальные ID складов
-        all_warehouse_ids = set()
-        for data in user_data.values():
-            all_warehouse_ids.update(data.get('selected_warehouses', []))
-
-        if all_warehouse_ids:
-            try:
-                # Получаем коэффициенты из API для всех складов
-                coefficients = get_acceptance_coefficients(list(all_warehouse_ids))
-                if coefficients:
-                    # Обрабатываем результаты для каждого пользователя
-                    for chat_id, data in user_data.items():
-                        await process_coefficients_for_user(chat_id, data, coefficients)
-                else:
-                    logging.error("Не удалось получить коэффициенты из API.")
-            except Exception as e:
-                logging.error(f"Ошибка при запросе к API: {e}")
-        else:
+        today = date_type.today().isoformat()
+        if snapshot.window_start != today:
+            evict_past_dates(today)
+
+        # Все уникальные ID складов берём из индексов подписок и правил (при шардировании — из отчётов воркеров)
+        scheduler.sync(shard_supervisor.warehouse_ids() if shard_supervisor is not None
+                       else tracked_warehouse_ids())
+        scheduler.scale(wb_client.tokens.active())
+        warehouse_ids = scheduler.due()
+
+        if warehouse_ids and not wb_client.breaker.available():
+            # API недоступно: не тратим лимит, пока выключатель не разрешит пробный запрос
+            logging.warning("API Wildberries недоступно, опрос отложен.")
+            scheduler.defer(warehouse_ids, wb_client.breaker.opened_until - time.monotonic())
+        elif warehouse_ids:
+            # Не выходим за лимиты ключей API: один запрос за цикл с ключом, дольше всех простаивавшим.
+            # Ключи чередуются, а планировщик сокращает интервал пропорционально их числу (scale),
+            # поэтому каждый ключ добавляет опросов. Если свободного ключа нет за ACQUIRE_TIMEOUT,
+            # опрос пропускается, чтобы не задерживать вытеснение дат и статус для воркеров.
+            token = await wb_client.tokens.acquire(ACQUIRE_TIMEOUT)
+            if token is None:
+                logging.warning("Нет свободного ключа API Wildberries, опрос пропущен.")
+            else:
+                changed_warehouse_ids = set()
+                try:
+                    changed_warehouse_ids = await poll_warehouses(warehouse_ids, token)
+                except Exception as e:
+                    logging.error(f"Ошибка при запросе к API: {e}")
+                scheduler.report(warehouse_ids, changed_warehouse_ids)
+                log_tick_summary(warehouses=len(warehouse_ids), queue=notifier.depth)
+        elif not scheduler.warehouses and not idle_logged:
             logging.info("Нет отслеживаемых складов.")
-
-        await asyncio.sleep(10)  # Ждем 10 секунд перед следующим запросом
+        idle_logged = not scheduler.warehouses
+
+        if shard_supervisor is not None:
+            shard_supervisor.publish_status(poll_status())
+        await asyncio.sleep(scheduler.sleep_time())
+
+
+# Состояние опроса для /status: интервалы складов, число запросов и состояние API
+def poll_status() -> dict:
+    if shard_poll_status is not None:
+        return shard_poll_status
+    return {
+        'intervals': sorted(scheduler.intervals().items(), key=lambda item: item[1]),
+        'requests': scheduler.requests,
+        'saved': scheduler.saved_requests(),
+        'breaker': wb_client.breaker.state,
+        'tokens': [wb_client.tokens.active(), len(wb_client.tokens)],
+    }
 
 
 # Функция для отправки сообщений по частям, если длина превышает лимит
 async def send_long_message(chat_id: int, text: str):
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML)
-    else:
-        # Разбиваем сообщение на части
-        for i in range(0, len(text), MAX_MESSAGE_LENGTH):
-            await bot.send_message(chat_id, text[i:i + MAX_MESSAGE_LENGTH], parse_mode=ParseMode.HTML)
+    # Разбиваем сообщение на части по границам строк, чтобы не разрезать HTML-теги
+    while text:
+        part, text = split_html(text, MAX_MESSAGE_LENGTH)
+        await bot.send_message(chat_id, part, parse_mode=ParseMode.HTML)
+
+
+# Разбор аргументов /history: [ID склада] [дата с] [дата по], даты в формате ГГГГ-ММ-ДД
+def parse_history_args(args: str, selected_warehouses: list):
+    warehouse_ids = list(selected_warehouses)
+    date_from = date_type.today().isoformat()
+    date_to = None
+
+    dates = []
+    for arg in (args or "").split():
+        if arg.isdigit():
+            warehouse_ids = [int(arg)]
+        else:
+            dates.append(date_type.fromisoformat(arg).isoformat())
+
+    if dates:
+        date_from = dates[0]
+    if len(dates) > 1:
+        date_to = dates[1]
+
+    return warehouse_ids, date_from, date_to
 
 
 # Команда /history для отображения истории коэффициентов
 @dp.message(Command("history"))
-async def show_history(message: types.Message):
+async def show_history(message: types.Message, command: CommandObject = None):
     chat_id = message.chat.id
-    history = user_data.get(chat_id, {}).get('known_coeffs', {})
+    selected_warehouses = user_data.get(chat_id, {}).get('selected_warehouses', [])
 
-    if not history:
+    try:
+        warehouse_ids, date_from, date_to = parse_history_args(command.args if command else None,
+                                                               selected_warehouses)
+    except ValueError:
+        await message.answer("❗️ Формат: /history [ID склада] [дата с] [дата по], даты в формате ГГГГ-ММ-ДД.")
+        return
+
+    # Читаем архив постранично и отправляем сообщения по мере заполнения, не собирая всю историю в памяти
+    parts = ["📜 <b>История коэффициентов:</b>\n"]
+    length = len(parts[0])
+    sent_messages = 0
+    found = False
+    current_warehouse_id = None
+
+    async for warehouse_id, date, box_type_name, observed_at, coeff_value in store.iter_history(
+            warehouse_ids, date_from, date_to):
+        found = True
+        lines = []
+        if warehouse_id != current_warehouse_id:
+            current_warehouse_id = warehouse_id
+            lines.append(f"\n🏢 <b>{catalog.name(warehouse_id)}</b>\n")
+        observed = datetime.fromtimestamp(observed_at).strftime('%d.%m %H:%M')
+        lines.append(f"📅 <b>{date}</b> | 📊 {coeff_value} | 📦 {box_type_name} | 🕒 {observed}\n")
+        chunk = "".join(lines)
+
+        if length + len(chunk) > MAX_MESSAGE_LENGTH:
+            await send_long_message(chat_id, "".join(parts))
+            sent_messages += 1
+            parts, length = [], 0
+            if sent_messages >= HISTORY_MAX_MESSAGES:
+                await message.answer("✂️ История слишком длинная, уточните склад или период.")
+                return
+
+        parts.append(chunk)
+        length += len(chunk)
+
+    if not found:
         await message.answer("🔍 История коэффициентов пуста.")
         return
 
-    response_message = "📜 <b>История коэффициентов:</b>\n\n"
-    for warehouse_id, dates in history.items():
-        warehouse = next((w for w in WAREHOUSES if w['ID'] == warehouse_id), {})
-        warehouse_name = warehouse.get('name', 'Неизвестный склад')
+    await send_long_message(chat_id, "".join(parts))
 
-        response_message += f"🏢 <b>{warehouse_name}</b>\n"
-        for date, coeff_value in dates.items():
-            response_message += f"📅 <b>Дата:</b> {date} | 📊 <b>Коэффициент:</b> {coeff_value}\n"
-        response_message += "\n"
 
-    await send_long_message(chat_id, response_message)
+# Команда /status для отображения текущих интервалов опроса складов
+@dp.message(Command("status"))
+async def show_status(message: types.Message):
+    status = poll_status()
+    lines = ["⏱ <b>Интервалы опроса складов:</b>\n"]
+    for warehouse_id, interval in status['intervals']:
+        lines.append(f"🏢 {catalog.name(warehouse_id, warehouse_id)}: {interval:.0f} с.")
+    lines.append(f"\n📉 Запросов к API: {status['requests']}, сэкономлено: {status['saved']}")
+    lines.append(f"🔌 Состояние API: {status['breaker']}")
+    lines.append(f"🔑 Ключей API в работе: {status['tokens'][0]} из {status['tokens'][1]}")
+    await message.answer("\n".join(lines))
 
 
 # Команда /help для отображения списка команд
@@ -535,13 +853,170 @@ async def show_help(message: types.Message):
     response_message = (
         "ℹ️ <b>Доступные команды:</b>\n\n"
         "🟢 /start - начать выбор складов для отслеживания.\n"
-        "📜 /history - показать историю коэффициентов.\n"
+        "📜 /history [ID склада] [дата с] [дата по] - показать историю коэффициентов.\n"
+        "⏱ /status - показать интервалы опроса складов.\n"
+        "📐 /rule ID склада коэффициент [дни] [тип поставки] - добавить правило, например "
+        "<code>/rule 507 &lt;=1 3-10 Короба</code>.\n"
+        "📋 /rules - показать правила, /unrule N - удалить правило.\n"
+        "📦 /boxtypes - выбрать типы поставки для уведомлений.\n"
+        "📬 /digest - включить или выключить сводки (все изменения одного опроса одним сообщением).\n"
         "❓ /help - показать информацию о командах.\n"
     )
     # Отправляем сообщение с командами без дополнительной клавиатуры
     await message.answer(response_message, parse_mode=ParseMode.HTML)
 
 
+# Команда /digest: переключение между сводками и отдельным сообщением на каждое изменение
+@dp.message(Command("digest"))
+async def toggle_digest(message: types.Message):
+    chat_id = message.chat.id
+    if chat_id not in user_data:
+        await message.answer("Отправьте /start, чтобы начать настройку.")
+        return
+    digest = user_data[chat_id]['digest'] = not user_data[chat_id].get('digest', True)
+    store.mark_user(chat_id)
+    if digest:
+        await message.answer("📬 Сводки включены: изменения одного опроса приходят одним сообщением.")
+    else:
+        await message.answer("✉️ Сводки выключены: каждое изменение приходит отдельным сообщением.")
+
+
+# Описание правила для списка /rules
+def format_rule(rule: AlertRule) -> str:
+    coefficients = (str(rule.coefficient_min) if rule.coefficient_min == rule.coefficient_max
+                    else f"{rule.coefficient_min}–{rule.coefficient_max}")
+    if rule.lead_max is None:
+        lead = f"через {rule.lead_min}+ дн." if rule.lead_min else "любая дата"
+    else:
+        lead = f"через {rule.lead_min}–{rule.lead_max} дн."
+    box_types = ", ".join(name for box_type_id, name in BOX_TYPES.items()
+                          if rule.box_types >> box_type_id & 1) or "любой тип"
+    return f"🏢 {catalog.name(rule.warehouse_id)}: коэффициент {coefficients}, {lead}, {box_types}"
+
+
+# Разбор аргументов /rule: ID склада, диапазон коэффициента, диапазон срока в днях, названия типов поставки
+def parse_rule_args(args: str) -> AlertRule:
+    tokens = (args or "").split()
+    if len(tokens) < 2 or not tokens[0].isdigit():
+        raise ValueError("Укажите ID склада и коэффициент")
+    warehouse_id = int(tokens[0])
+    if catalog.get(warehouse_id) is None:
+        raise ValueError(f"Склад {warehouse_id} не найден")
+    coefficient_min, coefficient_max = parse_range(tokens[1], MAX_COEFFICIENT)
+    lead_min, lead_max = 0, None
+    rest = tokens[2:]
+    if rest and rest[0][:1] in "0123456789<>≤≥":
+        lead_min, lead_max = parse_range(rest.pop(0))
+
+    box_types = 0
+    names = " ".join(rest).casefold()
+    for box_type_id, name in BOX_TYPES.items():
+        if name.casefold() in names:
+            box_types |= 1 << box_type_id
+            names = names.replace(name.casefold(), "")
+    if names.strip(" ,"):
+        raise ValueError(f"Неизвестный тип поставки: {names.strip(' ,')}")
+    return AlertRule(warehouse_id, coefficient_min, coefficient_max, lead_min, lead_max, box_types)
+
+
+# Команда /rule: добавление правила уведомлений
+@dp.message(Command("rule"))
+async def add_rule(message: types.Message, command: CommandObject):
+    chat_id = message.chat.id
+    if chat_id not in user_data:
+        await message.answer("Отправьте /start, чтобы начать настройку.")
+        return
+    chat_rules = user_data[chat_id]['rules']
+    if len(chat_rules) >= MAX_RULES_PER_CHAT:
+        await message.answer(f"⚠️ Можно задать не больше {MAX_RULES_PER_CHAT} правил, удалите лишние через /unrule.")
+        return
+    try:
+        rule = parse_rule_args(command.args)
+    except ValueError as e:
+        await message.answer(f"⚠️ {e}.\nПример: <code>/rule 507 &lt;=1 3-10 Короба</code>", parse_mode=ParseMode.HTML)
+        return
+
+    user_data[chat_id]['rules'] = chat_rules = chat_rules + [rule]
+    rules.set_rules(chat_id, chat_rules)
+    store.mark_user(chat_id)
+    await message.answer(f"✅ Правило добавлено:\n{format_rule(rule)}")
+
+
+# Команда /rules: список правил пользователя
+@dp.message(Command("rules"))
+async def show_rules(message: types.Message):
+    chat_rules = user_data.get(message.chat.id, {}).get('rules')
+    if not chat_rules:
+        await message.answer("📋 Правил нет. Добавьте правило командой /rule, подробнее — в /help.")
+        return
+    lines = ["📋 Правила уведомлений:\n"]
+    lines.extend(f"{number}. {format_rule(rule)}" for number, rule in enumerate(chat_rules, 1))
+    await message.answer("\n".join(lines))
+
+
+# Команда /unrule N: удаление правила по номеру из /rules
+@dp.message(Command("unrule"))
+async def delete_rule(message: types.Message, command: CommandObject):
+    chat_id = message.chat.id
+    chat_rules = user_data.get(chat_id, {}).get('rules', [])
+    args = (command.args or "").strip()
+    if not args.isdigit() or not 1 <= int(args) <= len(chat_rules):
+        await message.answer("⚠️ Укажите номер правила из /rules, например: /unrule 1")
+        return
+    rule = chat_rules[int(args) - 1]
+    user_data[chat_id]['rules'] = chat_rules = chat_rules[:int(args) - 1] + chat_rules[int(args):]
+    rules.set_rules(chat_id, chat_rules)
+    store.mark_user(chat_id)
+    await message.answer(f"🗑 Правило удалено:\n{format_rule(rule)}")
+
+
+# Текст экрана выбора типов поставки
+def box_types_text(mask: int) -> str:
+    if not mask:
+        return "📦 Уведомления приходят по всем типам поставки. Выберите типы, чтобы получать только их:"
+    names = ", ".join(name for box_type_id, name in BOX_TYPES.items() if mask >> box_type_id & 1)
+    return f"📦 Уведомления приходят только по типам: {names}."
+
+
+# Команда /boxtypes: фильтр уведомлений по типам поставки
+@dp.message(Command("boxtypes"))
+async def show_box_types(message: types.Message):
+    chat_id = message.chat.id
+    if chat_id not in user_data:
+        await message.answer("Отправьте /start, чтобы начать настройку.")
+        return
+    mask = user_data[chat_id]['selected_box_types']
+    await message.answer(box_types_text(mask), reply_markup=keyboard_templates.box_type_keyboard(mask))
+
+
+# Применение нового фильтра по типам поставки и обновление экрана выбора
+async def update_box_types(callback_query: types.CallbackQuery, mask: int):
+    chat_id = callback_query.message.chat.id
+    user_data[chat_id]['selected_box_types'] = mask
+    subscriptions.set_box_types(chat_id, mask)
+    store.mark_user(chat_id)
+    await callback_query.answer()
+    try:
+        await callback_query.message.edit_text(box_types_text(mask),
+                                               reply_markup=keyboard_templates.box_type_keyboard(mask))
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении инлайн-кнопок типов поставки: {e}")
+
+
+# Выбор типа поставки через инлайн-кнопки
+async def process_box_type_selection(callback_query: types.CallbackQuery, box_type_id: int):
+    if box_type_id not in BOX_TYPES:
+        await callback_query.answer()
+        return
+    chat_id = callback_query.message.chat.id
+    await update_box_types(callback_query, user_data[chat_id]['selected_box_types'] ^ (1 << box_type_id))
+
+
+# Сброс фильтра: уведомления по всем типам поставки
+async def process_all_box_types(callback_query: types.CallbackQuery):
+    await update_box_types(callback_query, 0)
+
+
 # Обработка кнопок Главного Меню
 @dp.message(lambda message: message.text == "📜 История коэффициентов")
 async def history_button(message: types.Message):
@@ -553,33 +1028,299 @@ async def help_button(message: types.Message):
     await show_help(message)
 
 
-# Обработка кнопки "Главное Меню" через Callback Query
-@dp.callback_query(lambda call: call.data == "main_menu")
-async def handle_main_menu(callback_query: types.CallbackQuery):
-    chat_id = callback_query.message.chat.id
-    await send_main_menu(chat_id, callback_query.message)
-    await callback_query.answer("Перешли в Главное Меню.")
+# Хендлеры инлайн-кнопок по коду действия из callback_data
+CALLBACK_HANDLERS = {
+    keyboards.TOGGLE_WAREHOUSE: process_inline_warehouse_selection,
+    keyboards.TOGGLE_COEFFICIENT: process_inline_coefficient_selection,
+    keyboards.NEXT_WAREHOUSE: process_next_warehouse,
+    keyboards.PREV_WAREHOUSE: process_prev_warehouse,
+    keyboards.MAIN_MENU: process_main_menu,
+    keyboards.CONFIRM_COEFFICIENTS: process_confirm_coefficients,
+    keyboards.WAREHOUSE_PAGE: process_warehouse_page,
+    keyboards.NOOP: process_noop,
+    keyboards.TOGGLE_BOX_TYPE: process_box_type_selection,
+    keyboards.ALL_BOX_TYPES: process_all_box_types,
+}
+
+
+# Единая точка входа для инлайн-кнопок: разбор callback_data и выбор хендлера по словарю
+@dp.callback_query()
+async def dispatch_callback(callback_query: types.CallbackQuery):
+    try:
+        action, args = decode_callback(callback_query.data or "")
+        handler = CALLBACK_HANDLERS[action]
+    except (ValueError, KeyError):
+        await callback_query.answer("Кнопка устарела, откройте меню заново.", show_alert=True)
+        return
+    if callback_query.message is None or callback_query.message.chat.id not in user_data:
+        await callback_query.answer("Отправьте /start, чтобы начать настройку.", show_alert=True)
+        return
+    await handler(callback_query, *args)
+
+
+# Поиск склада: любой текст, пока открыт экран выбора складов (регистрируется последним,
+# чтобы кнопки меню и команды обрабатывались своими хендлерами)
+@dp.message(lambda message: bool(message.text) and not message.text.startswith("/")
+            and user_data.get(message.chat.id, {}).get('warehouse_page') is not None)
+async def search_warehouses(message: types.Message):
+    chat_id = message.chat.id
+    keyboard_editor.cancel(chat_id)
+    if not catalog.search(message.text, 1):
+        # Прежний запрос (или постраничный список) остаётся: клавиатура без складов бесполезна
+        await message.answer("🔍 Склады не найдены, попробуйте другое название.")
+        return
+    user_data[chat_id]['warehouse_query'] = message.text
+    await send_warehouse_selection(chat_id, message)
+
+
+# Каталог складов изменился: сбрасываем тексты уведомлений с прежними названиями
+def on_catalog_change():
+    format_new_coefficient.cache_clear()
+    format_changed_coefficient.cache_clear()
+
+
+# Загрузка сохранённого состояния и восстановление индекса подписок.
+# При шардировании воркер загружает только свои чаты, а супервизору пользователи не нужны.
+def load_state(ring: HashRing = None, shard_index: int = None):
+    store.open()
+    catalog.load(store)
+    user_data.clear()
+    subscriptions.clear()
+    rules.clear()
+    if ring is None or shard_index is not None:
+        user_data.update((chat_id, data) for chat_id, data in store.load_users().items()
+                         if ring is None or ring.shard_for(chat_id) == shard_index)
+    for chat_id, data in user_data.items():
+        # До перезапуска по подтверждённому выбору уже отправлены текущие слоты
+        data['notified_coefficients'] = dict(data['selected_coefficients']) if data['setup_complete'] else {}
+        subscriptions.set_box_types(chat_id, data['selected_box_types'])
+        rules.set_rules(chat_id, data['rules'])
+        for warehouse_id in data['selected_warehouses']:
+            subscriptions.add_warehouse(chat_id, warehouse_id)
+        for warehouse_id, mask in data['selected_coefficients'].items():
+            for coefficient in mask_coefficients(mask):
+                subscriptions.add_coefficient(chat_id, warehouse_id, coefficient)
+    # Процесс, который опрашивает API, берёт снимок из файла: он сохраняется до рассылки и свежее базы,
+    # куда изменения пишутся с задержкой. Воркеры шардов получают снимок от супервизора.
+    snapshot_file.open()
+    saved = snapshot_file.load() if shard_index is None else None
+    if saved is not None:
+        cells, window_start, _ = saved
+        snapshot.load(cells)
+        snapshot.window_start = window_start
+    else:
+        snapshot.load(store.load_snapshot())
+    logging.info(f"Загружено пользователей: {len(user_data)}, ячеек снимка: {len(snapshot.cells)}, "
+                 f"складов в каталоге: {len(catalog)}")
+
+
+# Показатели состояния процесса для /metrics
+metrics.registry.gauge("bot_notification_queue_depth", lambda: notifier.depth)
+metrics.registry.gauge("bot_users", lambda: len(user_data))
+metrics.registry.gauge("bot_tracked_warehouses", lambda: len(scheduler.warehouses))
+metrics.registry.gauge("bot_snapshot_cells", lambda: len(snapshot.cells))
+metrics.registry.gauge("bot_catalog_warehouses", lambda: len(catalog))
+metrics.registry.gauge("bot_api_tokens_active", lambda: wb_client.tokens.active())
+
+# Учёт памяти для /memory (общие шаблоны кнопок и каталог считаются раньше, чтобы не попасть в долю пользователей)
+memory.accounting.register("catalog", lambda: catalog, lambda: len(catalog))
+memory.accounting.register("keyboard_templates", lambda: keyboard_templates)
+memory.accounting.register("snapshot", lambda: snapshot, lambda: len(snapshot.cells))
+memory.accounting.register("subscriptions", lambda: subscriptions, lambda: len(user_data))
+memory.accounting.register("rules", lambda: rules, lambda: len(rules))
+memory.accounting.register("users", lambda: user_data, lambda: len(user_data))
+
+
+# Учёт перезапусков компонентов после падений
+def count_restart(name: str):
+    metrics.registry.increment("bot_component_restarts_total", component=name)
 
 
 async def main():
+    global shard_supervisor
     logging.info("Запуск бота...")
-    asyncio.create_task(periodic_check())
+    lease = None
+    if POLL_LEASE:
+        # Резервная копия ждёт здесь, не опрашивая API и не принимая апдейты
+        lease = PollLease()
+        lease.open()
+        await lease.acquire()
+    # Пользователи и снимок, сохранённые предыдущим лидером: первый опрос сравнивается с ними,
+    # поэтому уже разосланные изменения повторно не уходят
+    ring = HashRing(SHARD_WORKERS) if SHARD_WORKERS > 1 else None
+    load_state(ring)
+    metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    store_task = asyncio.create_task(store.run(user_data))
+    router = None
+    if ring is not None:
+        # Этот процесс только опрашивает API и принимает апдейты; чаты обслуживают воркеры
+        shard_supervisor = ShardSupervisor([sys.executable, os.path.abspath(__file__), sharding.SHARD_WORKER_FLAG],
+                                           ring, snapshot)
+        await shard_supervisor.start()
+        router = ShardRouterMiddleware(shard_supervisor)
+        dp.update.outer_middleware.register(router)
+    else:
+        notifier.start()
+    # Опрос, приём апдейтов, каталог и файл снимка перезапускаются по отдельности: падение одного
+    # не останавливает остальные, а состояние (снимок, пользователи, очередь рассылки) остаётся в памяти
+    check_task = asyncio.create_task(supervise("poller", periodic_check, (LeaseLost,),
+                                               on_restart=count_restart))
+    # Каталог складов обновляется в фоне: запуск не ждёт сети
+    catalog_task = asyncio.create_task(supervise("catalog", lambda: catalog.run(store, on_catalog_change),
+                                                 on_restart=count_restart))
+    snapshot_task = asyncio.create_task(supervise("snapshot", lambda: snapshot_file.run(snapshot),
+                                                  on_restart=count_restart))
+    lease_task = asyncio.create_task(lease.keep()) if lease is not None else None
+    webhook_server = None
+    serve_task = None
     try:
-        await dp.start_polling(bot, skip_updates=False)
+        if BOT_MODE == "webhook":
+            webhook_server = WebhookServer(bot, dp)
+            await webhook_server.start()
+            serve_task = asyncio.create_task(asyncio.Event().wait())  # Работаем до отмены (Ctrl+C / SIGTERM)
+        else:
+            serve_task = asyncio.create_task(supervise(
+                "dispatcher", lambda: dp.start_polling(bot, skip_updates=False, close_bot_session=False),
+                on_restart=count_restart))
+        # Работаем, пока не остановлен приём апдейтов или не потеряна аренда опроса
+        done, _ = await asyncio.wait([task for task in (serve_task, check_task, lease_task) if task is not None],
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    except LeaseLost:
+        raise
     except Exception as e:
         logging.error(f"Ошибка в процессе работы бота: {e}")
         logging.error("Traceback:\n%s", traceback.format_exc())  # Записываем стек вызовов в файл
+    finally:
+        if serve_task is not None:
+            serve_task.cancel()
+            await asyncio.gather(serve_task, return_exceptions=True)
+        # Дообрабатываем уже принятые через webhook обновления
+        if webhook_server is not None:
+            await webhook_server.stop()
+        # Останавливаем периодическую проверку и закрываем пул соединений с API Wildberries
+        check_task.cancel()
+        catalog_task.cancel()
+        # Последнее сохранение файла снимка перед выходом
+        snapshot_task.cancel()
+        await asyncio.gather(snapshot_task, return_exceptions=True)
+        if lease_task is not None:
+            lease_task.cancel()
+        if shard_supervisor is not None:
+            dp.update.outer_middleware.unregister(router)
+            await shard_supervisor.stop()
+            shard_supervisor = None
+        await notifier.stop()
+        # Сессию бота закрываем сами: перезапускаемый приём апдейтов её не закрывает, она нужна рассылке
+        await bot.session.close()
+        await wb_client.close()
+        # Сохраняем накопленные изменения и закрываем базу данных
+        store_task.cancel()
+        await asyncio.gather(store_task, return_exceptions=True)
+        store.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        if lease is not None:
+            # Аренда освобождается только после сохранения состояния, чтобы следующий лидер его увидел
+            if lease_task is not None and not lease_task.done():
+                lease.release()
+            lease.close()
+
+
+# Воркер шарда: обслуживает чаты своей доли (хендлеры, подписки, рассылка),
+# получая апдейты и наборы изменений от супервизора через stdin
+async def run_shard_worker(shard_index: int, shard_count: int):
+    global shard_poll_status
+    # У каждого воркера свой файл журнала: ротировать один файл из нескольких процессов нельзя
+    log_root, log_extension = os.path.splitext(LOG_FILE)
+    logsetup.setup_logging(f"{log_root}.shard{shard_index}{log_extension}")
+    logging.info(f"Запуск воркера шарда {shard_index} из {shard_count}...")
+    load_state(HashRing(shard_count), shard_index)
+    metrics_port = METRICS_PORT + 1 + shard_index if METRICS_PORT else 0
+    metrics_runner = await metrics.start_server(METRICS_HOST, metrics_port) if metrics_port else None
+    store_task = asyncio.create_task(store.run(user_data))
+    # Лимит Telegram общий на бота, поэтому каждому воркеру достаётся его доля
+    notifier.global_bucket = TokenBucket(GLOBAL_RATE / shard_count, max(1.0, GLOBAL_BURST / shard_count))
+    notifier.start()
+    # Каталог обновляет супервизор; воркер подхватывает его из общей базы
+    catalog_task = asyncio.create_task(catalog.follow(store, on_catalog_change))
+    snapshot_sequence = 0
+    replay_sequence = 0  # Наборы изменений после этого номера и до snapshot_sequence — пропущенные при перезапуске
+    reported_warehouse_ids = None
+    update_tasks = set()
+
+    # Сообщаем супервизору, какие склады опрашивать для чатов этого шарда (только при изменении набора)
+    def report_warehouses(_=None):
+        nonlocal reported_warehouse_ids
+        warehouse_ids = tracked_warehouse_ids()
+        if warehouse_ids != reported_warehouse_ids:
+            reported_warehouse_ids = warehouse_ids
+            sharding.send_to_parent("warehouses", ids=sorted(warehouse_ids))
+
+    try:
+        reader = await sharding.connect_parent()
+        async for message in sharding.read_messages(reader):
+            kind = message['kind']
+            if kind == "update":
+                update = types.Update.model_validate(message['update'], context={"bot": bot})
+                task = asyncio.create_task(dp.feed_update(bot, update))
+                update_tasks.add(task)
+                task.add_done_callback(update_tasks.discard)
+                task.add_done_callback(report_warehouses)
+            elif kind == "changeset":
+                sequence = message['seq']
+                if sequence > snapshot_sequence:
+                    changeset = sharding.decode_changeset(message)
+                    snapshot.merge(changeset)
+                    process_changeset(changeset)
+                    log_tick_summary(seq=sequence, events=len(changeset), queue=notifier.depth)
+                elif sequence > replay_sequence:
+                    # Изменения, пропущенные, пока воркер перезапускался: снимок их уже учитывает,
+                    # но чатам шарда они ещё не разосланы
+                    changeset = sharding.decode_changeset(message)
+                    process_changeset(changeset)
+                    log_tick_summary(seq=sequence, events=len(changeset), queue=notifier.depth, replayed=True)
+                # Подтверждение: после перезапуска этот набор повторять не нужно
+                sharding.send_to_parent("ack", seq=sequence)
+            elif kind == "snapshot":
+                snapshot.load(sharding.decode_snapshot(message))
+                snapshot_sequence = message['seq']
+                replay_sequence = message['base']
+            elif kind == "status":
+                shard_poll_status = message
+            report_warehouses()
+    finally:
+        # stdin закрыт — супервизор останавливается; доделываем начатое и сохраняем состояние
+        await asyncio.gather(*update_tasks, return_exceptions=True)
+        catalog_task.cancel()
+        await notifier.stop()
+        await bot.session.close()
+        store_task.cancel()
+        await asyncio.gather(store_task, return_exceptions=True)
+        store.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == sharding.SHARD_WORKER_FLAG:
+        # Упавший воркер перезапускает супервизор, собственный цикл перезапуска не нужен
+        asyncio.run(run_shard_worker(int(sys.argv[2]), int(sys.argv[3])))
+        sys.exit(0)
     while True:
         try:
             asyncio.run(main())
+        except LeaseLost as lease_e:
+            # Другой экземпляр уже опрашивает API: возвращаемся в режим ожидания аренды
+            logging.warning(f"{lease_e} Переход в режим ожидания.")
+            continue
         except Exception as main_e:
             logging.error(f"Критическая ошибка, бот упал: {main_e}")
             logging.error("Traceback:\n%s", traceback.format_exc())  # Записываем стек вызовов в файл
-            # Ждём 5 секунд перед повторной попыткой перезапуска
-            time.sleep(5)
+            # Компоненты перезапускаются внутри main; сюда попадают только сбои запуска и остановки.
+            # Состояние восстанавливается из файла снимка и базы, поэтому долгая пауза не нужна
+            time.sleep(1)
             logging.info("Повторный запуск бота...")
             continue
         # Если main завершился без исключений, выходим из цикла
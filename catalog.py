@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+
+from config import WAREHOUSE_CATALOG_TTL
+from utils import fetch_warehouses
+
+CATALOG_RETRY_INTERVAL = 300  # Пауза перед повтором после неудачного обновления каталога, секунды
+CATALOG_FOLLOW_INTERVAL = 60  # Как часто процесс без опроса API проверяет, не обновил ли каталог другой, секунды
+UNKNOWN_WAREHOUSE = "Неизвестный склад"
+
+
+# Каталог складов с индексами по ID и названию. Заполняется из базы при запуске
+# и обновляется из /warehouses в фоне (условным запросом по ETag и сравнением хеша содержимого).
+class WarehouseCatalog:
+    def __init__(self, warehouses: list, ttl: float = WAREHOUSE_CATALOG_TTL):
+        self.ttl = ttl
+        self.etag = None
+        self.content_hash = b""
+        self.refreshed_at = 0.0  # Время последней успешной проверки (секунды Unix)
+        self.version = 0  # Растёт при каждой замене содержимого (для сброса кэшей кнопок и текстов)
+        self.warehouses = []  # Склады, отсортированные по названию
+        self.by_id = {}
+        self.by_name = {}  # название в нижнем регистре -> склад
+        self._search_names = []  # (название в нижнем регистре, склад) в порядке каталога
+        self.replace(warehouses)
+
+    def __len__(self):
+        return len(self.warehouses)
+
+    # Замена содержимого каталога и перестроение индексов
+    def replace(self, warehouses: list):
+        self.warehouses = sorted((warehouse for warehouse in warehouses if warehouse.get('name')),
+                                 key=lambda warehouse: warehouse['name'].casefold())
+        self.by_id = {warehouse['ID']: warehouse for warehouse in self.warehouses}
+        self._search_names = [(warehouse['name'].casefold(), warehouse) for warehouse in self.warehouses]
+        self.by_name = dict(self._search_names)
+        self.version += 1
+
+    def get(self, warehouse_id: int):
+        return self.by_id.get(warehouse_id)
+
+    def name(self, warehouse_id: int, default: str = UNKNOWN_WAREHOUSE) -> str:
+        warehouse = self.by_id.get(warehouse_id)
+        return warehouse['name'] if warehouse is not None else default
+
+    # Страница каталога: (склады страницы, число страниц)
+    def page(self, index: int, size: int) -> tuple:
+        pages = max(1, -(-len(self.warehouses) // size))
+        index = min(max(index, 0), pages - 1)
+        return self.warehouses[index * size:(index + 1) * size], pages
+
+    # Поиск по ID или по словам из названия (все слова должны входить в название)
+    def search(self, query: str, limit: int) -> list:
+        query = query.strip()
+        if query.isdigit() and int(query) in self.by_id:
+            return [self.by_id[int(query)]]
+        words = query.casefold().split()
+        exact = self.by_name.get(query.casefold())
+        results = [exact] if exact is not None else []
+        for name, warehouse in self._search_names:
+            if len(results) >= limit:
+                break
+            if warehouse is not exact and all(word in name for word in words):
+                results.append(warehouse)
+        return results
+
+    # Загрузка сохранённого каталога (если его ещё нет, остаётся запасной список)
+    def load(self, store):
+        state = store.load_warehouse_catalog()
+        if state is None:
+            return
+        warehouses, self.etag, self.content_hash, self.refreshed_at = state
+        if warehouses:
+            self.replace(warehouses)
+
+    # Проверка каталога в API; True, если содержимое изменилось
+    async def refresh(self, store) -> bool:
+        result = await fetch_warehouses(self.etag)
+        if result is None:
+            raise ConnectionError("API Wildberries не вернуло список складов")
+
+        now = time.time()
+        content_hash = (hashlib.blake2b(result.payload, digest_size=16).digest() if result.payload is not None
+                        else self.content_hash)
+        if content_hash == self.content_hash:
+            # 304 или тот же ответ: разбирать и перестраивать индексы не нужно
+            self.etag = result.etag or self.etag
+            self.refreshed_at = now
+            await store.save_warehouse_catalog(None, self.etag, self.content_hash, now)
+            return False
+
+        warehouses = [warehouse for warehouse in json.loads(result.payload)
+                      if isinstance(warehouse, dict) and 'ID' in warehouse and warehouse.get('name')]
+        if not warehouses:
+            raise ValueError("API Wildberries вернуло пустой список складов")
+        self.replace(warehouses)
+        self.etag = result.etag
+        self.content_hash = content_hash
+        self.refreshed_at = now
+        await store.save_warehouse_catalog(self.warehouses, self.etag, content_hash, now)
+        logging.info(f"Каталог складов обновлён: {len(self.warehouses)} складов.")
+        return True
+
+    # Фоновое обновление каталога по истечении TTL; on_change вызывается после замены содержимого
+    async def run(self, store, on_change=None):
+        while True:
+            await asyncio.sleep(max(0.0, self.refreshed_at + self.ttl - time.time()))
+            try:
+                if await self.refresh(store) and on_change is not None:
+                    on_change()
+            except Exception as e:
+                logging.error(f"Ошибка при обновлении каталога складов: {e}")
+                await asyncio.sleep(CATALOG_RETRY_INTERVAL)
+
+    # Подхват каталога, обновлённого другим процессом через общую базу (воркеры шардов)
+    async def follow(self, store, on_change=None):
+        while True:
+            await asyncio.sleep(CATALOG_FOLLOW_INTERVAL)
+            if store.warehouse_catalog_refreshed_at() == self.refreshed_at:
+                continue
+            content_hash = self.content_hash
+            self.load(store)
+            if self.content_hash != content_hash and on_change is not None:
+                on_change()
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import sys
+from array import array
+from datetime import date as date_type
+
+try:
+    import orjson
+except ImportError:  # Без orjson разбор работает на стандартном json, только медленнее
+    orjson = None
+
+MAX_FINGERPRINTS = 256  # Сколько наборов складов помнить для проверки неизменного ответа
+MAX_CACHED_DATES = 1024  # Сколько разных строк дат из ответа API помнить
+
+# Строка даты из API ("2024-09-04T00:00:00Z") -> (порядковый номер дня, интернированная дата ГГГГ-ММ-ДД)
+_dates = {}
+
+_loads = orjson.loads if orjson is not None else json.loads
+
+
+# Ответ /acceptance/coefficients в виде столбцов: строка i — (склад, день, тип поставки, коэффициент).
+# Даты хранятся порядковыми номерами дней, строка даты и название типа поставки — по одной на значение.
+class CoefficientColumns:
+    __slots__ = ('warehouse_ids', 'days', 'box_type_ids', 'coefficients', 'dates', 'box_type_names')
+
+    def __init__(self):
+        self.warehouse_ids = array('q')
+        self.days = array('l')
+        self.box_type_ids = array('l')
+        self.coefficients = array('l')
+        self.dates = {}  # номер дня -> интернированная дата ГГГГ-ММ-ДД
+        self.box_type_names = {}  # ID типа поставки -> интернированное название
+
+    def __len__(self):
+        return len(self.coefficients)
+
+
+# Номер дня и интернированная дата для строки даты из API
+def _parse_date(value: str) -> tuple:
+    parsed = _dates.get(value)
+    if parsed is None:
+        if len(_dates) > MAX_CACHED_DATES:
+            _dates.clear()
+        date = sys.intern(value[:10])
+        parsed = _dates[value] = (date_type.fromisoformat(date).toordinal(), date)
+    return parsed
+
+
+# Разбор ответа API одним проходом сразу в столбцы. Строки складов вне warehouse_ids, типов поставки
+# вне box_type_ids (None — любые) и дат раньше window_start в столбцы не попадают.
+def parse_coefficients(payload: bytes, warehouse_ids=None, box_type_ids=None,
+                       window_start: str = "") -> CoefficientColumns:
+    columns = CoefficientColumns()
+    wanted = set(warehouse_ids) if warehouse_ids is not None else None
+    first_day = date_type.fromisoformat(window_start).toordinal() if window_start else 0
+    dates = columns.dates
+    box_type_names = columns.box_type_names
+
+    for row in _loads(payload):
+        warehouse_id = row['warehouseID']
+        if wanted is not None and warehouse_id not in wanted:
+            continue
+        box_type_id = row.get('boxTypeID') or 0
+        if box_type_ids is not None and box_type_id not in box_type_ids:
+            continue
+        day, date = _parse_date(row['date'])
+        if day < first_day:
+            # Прошедшие даты не храним и не рассылаем
+            continue
+        columns.warehouse_ids.append(warehouse_id)
+        columns.days.append(day)
+        columns.box_type_ids.append(box_type_id)
+        columns.coefficients.append(row['coefficient'])
+        dates[day] = date
+        if box_type_id not in box_type_names:
+            box_type_name = row.get('boxTypeName')
+            box_type_names[box_type_id] = sys.intern(box_type_name) if box_type_name is not None else None
+    return columns
+
+
+# Набор изменений коэффициентов за один опрос API
+class Changeset:
+    __slots__ = ('inserted', 'changed', 'removed')
+
+    def __init__(self):
+        self.inserted = []  # (ключ, коэффициент, тип поставки)
+        self.changed = []  # (ключ, старый коэффициент, новый коэффициент, тип поставки)
+        self.removed = []  # (ключ, старый коэффициент)
+
+    def __bool__(self):
+        return bool(self.inserted or self.changed or self.removed)
+
+    # Склады, у которых что-то изменилось
+    def warehouse_ids(self) -> set:
+        return {key[0] for key, *_ in self.inserted + self.changed + self.removed}
+
+    def __len__(self):
+        return len(self.inserted) + len(self.changed) + len(self.removed)
+
+
+# Общий снимок предыдущего опроса: (ID склада, дата, ID типа поставки) -> (коэффициент, тип поставки).
+# Строки дат и типов поставки интернируются: одна дата — один объект str на все ячейки.
+class CoefficientSnapshot:
+    def __init__(self):
+        self.cells = {}
+        self.window_start = ""  # Первая хранимая дата (ГГГГ-ММ-ДД); ячейки более ранних дат вытеснены
+        self.version = 0  # Растёт при каждом изменении ячеек (по нему сохраняется файл снимка)
+        self._fingerprints = {}  # набор опрошенных складов -> отпечаток последнего ответа
+        self._box_type_ids = None  # Типы поставки, отслеживаемые при прошлом применении (None — все)
+
+    # Дешёвый отпечаток сырого ответа API
+    @staticmethod
+    def fingerprint(payload: bytes) -> bytes:
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    # Проверка, что ответ API для этого набора складов (и тех же отслеживаемых типов поставки)
+    # не изменился с прошлого опроса
+    def is_unchanged(self, fingerprint: bytes, warehouse_ids=None, box_type_ids=None) -> bool:
+        return fingerprint == self._fingerprints.get(self._group_key(warehouse_ids, box_type_ids))
+
+    # Разбор ответа API для этого снимка (даты раньше начала окна отбрасываются сразу)
+    def parse(self, payload: bytes, warehouse_ids=None, box_type_ids=None) -> CoefficientColumns:
+        return parse_coefficients(payload, warehouse_ids, box_type_ids, self.window_start)
+
+    # Применение разобранного ответа API к снимку и вычисление изменений.
+    # Пропавшими считаются только ячейки складов, которые есть в ответе: склад, пропавший из ответа целиком
+    # (пустой или неполный ответ), сохраняет свои ячейки, иначе при следующем опросе они разошлись бы заново.
+    # Если передан box_type_ids — только ячейки этих типов поставки (остальные в ответе отброшены при разборе),
+    # а при сужении набора типов ячейки переставших отслеживаться типов удаляются по всем складам:
+    # иначе, когда тип снова начнут отслеживать, они дали бы изменения с устаревшим старым значением.
+    def apply(self, columns: CoefficientColumns, fingerprint: bytes = None, warehouse_ids=None,
+              box_type_ids=None) -> Changeset:
+        changeset = Changeset()
+        cells = self.cells
+        seen = set()
+        dates = columns.dates
+        box_type_names = columns.box_type_names
+
+        for warehouse_id, day, box_type_id, coeff_value in zip(columns.warehouse_ids, columns.days,
+                                                               columns.box_type_ids, columns.coefficients):
+            key = (warehouse_id, dates[day], box_type_id)
+            box_type_name = box_type_names[box_type_id]
+            seen.add(key)
+
+            previous_cell = cells.get(key)
+            cells[key] = (coeff_value, box_type_name)
+            if previous_cell is None:
+                changeset.inserted.append((key, coeff_value, box_type_name))
+            elif previous_cell[0] != coeff_value:
+                changeset.changed.append((key, previous_cell[0], coeff_value, box_type_name))
+
+        # Ячейки складов из ответа, которых в нём нет, пропали
+        responded = set(columns.warehouse_ids)
+        untracked = box_type_ids is not None and self._box_type_ids != box_type_ids
+        removed_keys = [key for key in cells if key not in seen and (
+            key[0] in responded and (box_type_ids is None or key[2] in box_type_ids)
+            or untracked and key[2] not in box_type_ids)]
+        self._box_type_ids = frozenset(box_type_ids) if box_type_ids is not None else None
+        for key in removed_keys:
+            changeset.removed.append((key, cells.pop(key)[0]))
+
+        if changeset:
+            self.version += 1
+            # Ячейки общие для всех групп: отпечаток другой группы с этими складами больше не описывает снимок,
+            # и байт-в-байт прежний ответ для неё нужно разобрать заново
+            changed_warehouse_ids = changeset.warehouse_ids()
+            for group_key in [group_key for group_key in self._fingerprints
+                              if group_key[0] is None or not changed_warehouse_ids.isdisjoint(group_key[0])]:
+                del self._fingerprints[group_key]
+        # После удаления ячеек отброшенных типов прежние отпечатки с этими типами больше не описывают снимок
+        if untracked or len(self._fingerprints) > MAX_FINGERPRINTS:
+            self._fingerprints.clear()
+        self._fingerprints[self._group_key(warehouse_ids, box_type_ids)] = fingerprint
+        return changeset
+
+    # Вытеснение ячеек прошедших дат (даты в ISO-формате сравниваются как строки).
+    # Возвращает набор изменений с удалёнными ячейками, чтобы удалить их и из базы.
+    def evict_before(self, window_start: str) -> Changeset:
+        self.window_start = window_start
+        changeset = Changeset()
+        expired_keys = [key for key in self.cells if key[1] < window_start]
+        for key in expired_keys:
+            changeset.removed.append((key, self.cells.pop(key)[0]))
+        if changeset:
+            self.version += 1
+        return changeset
+
+    # Загрузка ячеек (из базы или от супервизора) с интернированием строк
+    def load(self, cells: dict):
+        intern = sys.intern
+        self.cells = {
+            (warehouse_id, intern(date), box_type_id): (coeff_value,
+                                                       intern(box_type_name) if box_type_name is not None else None)
+            for (warehouse_id, date, box_type_id), (coeff_value, box_type_name) in cells.items()
+        }
+        self._fingerprints.clear()
+        self.version += 1
+
+    # Применение готового набора изменений (снимок в процессе, который сам не опрашивает API)
+    def merge(self, changeset: Changeset):
+        cells = self.cells
+        intern = sys.intern
+        for (warehouse_id, date, box_type_id), coeff_value, box_type_name in changeset.inserted:
+            cells[(warehouse_id, intern(date), box_type_id)] = (coeff_value, box_type_name)
+        for (warehouse_id, date, box_type_id), _, coeff_value, box_type_name in changeset.changed:
+            cells[(warehouse_id, intern(date), box_type_id)] = (coeff_value, box_type_name)
+        for key, _ in changeset.removed:
+            cells.pop(key, None)
+        self.version += 1
+
+    @staticmethod
+    def _group_key(warehouse_ids, box_type_ids=None):
+        return (frozenset(warehouse_ids) if warehouse_ids is not None else None,
+                frozenset(box_type_ids) if box_type_ids is not None else None)
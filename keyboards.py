@@ -0,0 +1,206 @@
+import asyncio
+import logging
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+KEYBOARD_EDIT_DEBOUNCE = 0.4  # Окно объединения быстрых нажатий перед обновлением клавиатуры, секунды
+COEFFICIENT_COLUMNS = 2  # Кнопки коэффициентов выводятся в два столбца
+WAREHOUSE_PAGE_SIZE = 8  # Складов на одной странице клавиатуры выбора (и результатов поиска)
+
+# Коды действий в callback_data: "<код>" или "<код>:<число>:<число>", не длиннее 64 байт
+CALLBACK_SEPARATOR = ":"
+TOGGLE_WAREHOUSE = "w"
+TOGGLE_COEFFICIENT = "c"
+NEXT_WAREHOUSE = "n"
+PREV_WAREHOUSE = "p"
+MAIN_MENU = "m"
+CONFIRM_COEFFICIENTS = "f"
+WAREHOUSE_PAGE = "g"  # Страница каталога складов (сбрасывает поиск)
+NOOP = "x"  # Кнопка без действия (номер страницы)
+TOGGLE_BOX_TYPE = "t"
+ALL_BOX_TYPES = "a"  # Сброс фильтра по типам поставки
+
+# Старый формат callback_data у кнопок в сообщениях, отправленных до перехода на коды
+LEGACY_CALLBACKS = {
+    "next_warehouse": NEXT_WAREHOUSE,
+    "prev_warehouse": PREV_WAREHOUSE,
+    "main_menu": MAIN_MENU,
+    "confirm_coefficients": CONFIRM_COEFFICIENTS,
+}
+LEGACY_PREFIXES = (
+    ("toggle_warehouse_", TOGGLE_WAREHOUSE),
+    ("toggle_coefficient_", TOGGLE_COEFFICIENT),
+)
+
+
+# Кодирование callback_data: действие и целочисленные аргументы
+def encode_callback(action: str, *args: int) -> str:
+    return CALLBACK_SEPARATOR.join((action, *map(str, args)))
+
+
+# Разбор callback_data в (действие, аргументы); ValueError, если формат не распознан
+def decode_callback(data: str) -> tuple:
+    action, _, rest = data.partition(CALLBACK_SEPARATOR)
+    if len(action) != 1:
+        legacy = LEGACY_CALLBACKS.get(data)
+        if legacy is not None:
+            return legacy, ()
+        for prefix, legacy in LEGACY_PREFIXES:
+            if data.startswith(prefix):
+                return legacy, tuple(int(arg) for arg in data[len(prefix):].split("_"))
+        raise ValueError(f"Неизвестный формат callback_data: {data!r}")
+    return action, tuple(int(arg) for arg in rest.split(CALLBACK_SEPARATOR)) if rest else ()
+
+
+# Выбранные коэффициенты хранятся битовой маской: бит N установлен, если выбран коэффициент N
+def coefficient_mask(coefficients) -> int:
+    mask = 0
+    for coefficient in coefficients:
+        mask |= 1 << coefficient
+    return mask
+
+
+def mask_coefficients(mask: int) -> list:
+    coefficients = []
+    coefficient = 0
+    while mask:
+        if mask & 1:
+            coefficients.append(coefficient)
+        mask >>= 1
+        coefficient += 1
+    return coefficients
+
+
+# Заранее собранные клавиатуры: кнопки для обоих состояний создаются один раз,
+# при отрисовке подставляется только нужный вариант по биту выбора
+class KeyboardTemplates:
+    def __init__(self, catalog, coefficients: list, box_types: dict):
+        self.catalog = catalog
+        self.coefficients = coefficients
+        self.box_types = box_types  # ID типа поставки -> название
+        self._warehouse_buttons = {}  # ID склада -> (кнопка "добавить", кнопка "удалить")
+        self._catalog_version = catalog.version
+        self._coefficient_buttons = {}  # ID склада -> [(кнопка "не выбран", кнопка "выбран"), ...]
+
+        back_button = InlineKeyboardButton(text="⬅️ Назад", callback_data=PREV_WAREHOUSE)
+        next_button = InlineKeyboardButton(text="➡️ Далее", callback_data=NEXT_WAREHOUSE)
+        confirm_button = InlineKeyboardButton(text="✅ Подтвердить выбор коэффициентов",
+                                              callback_data=CONFIRM_COEFFICIENTS)
+        main_menu_button = InlineKeyboardButton(text="🏠 Главное Меню", callback_data=MAIN_MENU)
+        # (есть предыдущий склад, это последний склад) -> ряд навигации
+        self.navigation_rows = {
+            (has_prev, is_last): ([back_button] if has_prev else []) + [confirm_button if is_last else next_button,
+                                                                         main_menu_button]
+            for has_prev in (False, True) for is_last in (False, True)
+        }
+        self._box_type_buttons = [
+            (box_type_id, (InlineKeyboardButton(text=f"❌ {name}", callback_data=callback_data),
+                           InlineKeyboardButton(text=f"✅ {name}", callback_data=callback_data)))
+            for box_type_id, name in box_types.items()
+            for callback_data in (encode_callback(TOGGLE_BOX_TYPE, box_type_id),)
+        ]
+        self._all_box_types_buttons = (
+            InlineKeyboardButton(text="📦 Все типы поставки", callback_data=ALL_BOX_TYPES),
+            InlineKeyboardButton(text="✅ Все типы поставки", callback_data=ALL_BOX_TYPES),
+        )
+        self.search_reset_row = [InlineKeyboardButton(text="✖️ Сбросить поиск",
+                                                      callback_data=encode_callback(WAREHOUSE_PAGE, 0))]
+
+    # Клавиатура выбора складов: страница каталога или результаты поиска, кнопки в столбик
+    def warehouse_keyboard(self, selected_warehouses, page: int = 0, query: str = None) -> InlineKeyboardMarkup:
+        if query:
+            warehouses = self.catalog.search(query, WAREHOUSE_PAGE_SIZE)
+            navigation = self.search_reset_row
+        else:
+            warehouses, pages = self.catalog.page(page, WAREHOUSE_PAGE_SIZE)
+            navigation = self._page_row(min(max(page, 0), pages - 1), pages)
+
+        rows = [[self._warehouse_button_pair(warehouse)[warehouse['ID'] in selected_warehouses]]
+                for warehouse in warehouses]
+        if navigation:
+            rows.append(navigation)
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    def _warehouse_button_pair(self, warehouse: dict) -> tuple:
+        if self._catalog_version != self.catalog.version:
+            # Каталог обновился: названия могли измениться
+            self._warehouse_buttons.clear()
+            self._catalog_version = self.catalog.version
+        buttons = self._warehouse_buttons.get(warehouse['ID'])
+        if buttons is None:
+            callback_data = encode_callback(TOGGLE_WAREHOUSE, warehouse['ID'])
+            buttons = self._warehouse_buttons[warehouse['ID']] = (
+                InlineKeyboardButton(text=f"✅ Добавить {warehouse['name']}", callback_data=callback_data),
+                InlineKeyboardButton(text=f"❌ Удалить {warehouse['name']}", callback_data=callback_data),
+            )
+        return buttons
+
+    # Ряд листания каталога: ◀️ N/M ▶️ (для одной страницы не нужен)
+    @staticmethod
+    def _page_row(page: int, pages: int) -> list:
+        if pages <= 1:
+            return []
+        row = []
+        if page > 0:
+            row.append(InlineKeyboardButton(text="◀️", callback_data=encode_callback(WAREHOUSE_PAGE, page - 1)))
+        row.append(InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data=NOOP))
+        if page < pages - 1:
+            row.append(InlineKeyboardButton(text="▶️", callback_data=encode_callback(WAREHOUSE_PAGE, page + 1)))
+        return row
+
+    # Клавиатура выбора коэффициентов склада по битовой маске выбранных
+    def coefficient_keyboard(self, warehouse_id: int, mask: int, has_prev: bool,
+                             is_last: bool) -> InlineKeyboardMarkup:
+        buttons = self._coefficient_buttons.get(warehouse_id)
+        if buttons is None:
+            buttons = self._coefficient_buttons[warehouse_id] = [
+                self._coefficient_button_pair(warehouse_id, coefficient) for coefficient in self.coefficients
+            ]
+
+        row_buttons = [pair[mask >> coefficient & 1] for coefficient, pair in zip(self.coefficients, buttons)]
+        rows = [row_buttons[index:index + COEFFICIENT_COLUMNS]
+                for index in range(0, len(row_buttons), COEFFICIENT_COLUMNS)]
+        rows.append(self.navigation_rows[(has_prev, is_last)])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    # Клавиатура фильтра по типам поставки (маска 0 — отслеживаются все типы)
+    def box_type_keyboard(self, mask: int) -> InlineKeyboardMarkup:
+        rows = [[pair[mask >> box_type_id & 1]] for box_type_id, pair in self._box_type_buttons]
+        rows.append([self._all_box_types_buttons[not mask]])
+        return InlineKeyboardMarkup(inline_keyboard=rows)
+
+    @staticmethod
+    def _coefficient_button_pair(warehouse_id: int, coefficient: int) -> tuple:
+        callback_data = encode_callback(TOGGLE_COEFFICIENT, warehouse_id, coefficient)
+        return (
+            InlineKeyboardButton(text=f"✅ {coefficient}", callback_data=callback_data),
+            InlineKeyboardButton(text=f"❌ {coefficient}", callback_data=callback_data),
+        )
+
+
+# Отложенное обновление инлайн-клавиатур: серия быстрых нажатий в одном чате
+# превращается в одно редактирование с последним состоянием
+class KeyboardEditDebouncer:
+    def __init__(self, delay: float = KEYBOARD_EDIT_DEBOUNCE):
+        self.delay = delay
+        self._pending = {}  # chat_id -> asyncio.Task
+
+    # Запланировать обновление; предыдущее ещё не выполненное обновление этого чата отменяется
+    def schedule(self, chat_id: int, render):
+        self.cancel(chat_id)
+        self._pending[chat_id] = asyncio.create_task(self._run(chat_id, render))
+
+    # Отменить запланированное обновление (например, перед немедленной перерисовкой)
+    def cancel(self, chat_id: int):
+        task = self._pending.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _run(self, chat_id: int, render):
+        await asyncio.sleep(self.delay)
+        # Снимаем задачу до начала редактирования, чтобы новое нажатие не отменило уже идущий запрос
+        self._pending.pop(chat_id, None)
+        try:
+            await render()
+        except Exception as e:
+            logging.error(f"Ошибка при отложенном обновлении клавиатуры для чата {chat_id}: {e}")
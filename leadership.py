@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from config import DATABASE_URL, POLL_LEASE_TTL
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+# Аренда лидерства потеряна (другой экземпляр перехватил её, пока этот не продлевал)
+class LeaseLost(Exception):
+    pass
+
+
+# Аренда в общей базе SQLite: опрашивает API только её держатель, продлевающий её каждые ttl/3 секунды.
+# Если держатель перестал продлевать, через ttl секунд аренду забирает следующий экземпляр.
+class PollLease:
+    def __init__(self, path: str = DATABASE_URL, name: str = "poller", ttl: float = POLL_LEASE_TTL):
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._connection = None
+
+    def open(self):
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Захват или продление аренды одним атомарным запросом; True, если аренда наша
+    def try_acquire(self) -> bool:
+        now = time.time()
+        cursor = self._connection.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (self.name, self.holder, now + self.ttl, now))
+        return cursor.rowcount == 1
+
+    # Освобождение аренды при штатной остановке, чтобы резервный экземпляр не ждал истечения
+    def release(self):
+        self._connection.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.holder))
+
+    # Ожидание лидерства (резервный экземпляр проверяет аренду с тем же периодом, что и держатель её продлевает)
+    async def acquire(self):
+        logging.info(f"Ожидание аренды опроса ({self.holder})...")
+        while not await asyncio.to_thread(self.try_acquire):
+            await asyncio.sleep(self.ttl / 3)
+        logging.info(f"Аренда опроса получена ({self.holder}).")
+
+    # Продление аренды, пока экземпляр работает; LeaseLost, если продлить не удалось
+    async def keep(self):
+        renewed_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                renewed = await asyncio.to_thread(self.try_acquire)
+            except sqlite3.Error as e:
+                # База временно занята: аренда ещё действует, попробуем на следующем шаге
+                logging.error(f"Ошибка при продлении аренды опроса: {e}")
+                if time.monotonic() - renewed_at < self.ttl:
+                    continue
+                renewed = False
+            if not renewed:
+                raise LeaseLost(f"Аренда опроса потеряна ({self.holder}).")
+            renewed_at = time.monotonic()
@@ -0,0 +1,123 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from datetime import datetime, timezone
+
+from config import LOG_FILE, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_INTERVAL
+
+CONSOLE_FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+CONSOLE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Поля LogRecord, которые не переносятся в JSON как дополнительные (extra)
+RESERVED_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+
+# Запись лога одной строкой JSON: время, уровень, логгер, сообщение и поля из extra=...
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RESERVED_ATTRIBUTES and not name.startswith('_'):
+                entry[name] = value
+        # Из очереди запись приходит с уже отформатированным исключением в exc_text (см. QueueRecordHandler)
+        exception = self.formatException(record.exc_info) if record.exc_info else record.exc_text
+        if exception:
+            entry['exception'] = exception
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Постановка записи в очередь. Стандартный QueueHandler.prepare склеивает traceback с сообщением и
+# обнуляет exc_info и exc_text; здесь сообщение остаётся без traceback, а исключение форматируется
+# в exc_text в потоке, где оно возникло (сам объект исключения в другой поток не передаётся)
+class QueueRecordHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        exception = record.exc_text
+        if record.exc_info and not exception:
+            exception = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exception
+        return record
+
+
+# Файл с ротацией и по размеру, и по времени: новый файл начинается, когда текущий превысил max_bytes
+# или с начала файла прошло interval секунд (старые файлы нумеруются .1, .2, ...)
+class SizeTimeRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, interval: float):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True)
+        self.interval = interval
+        self.rollover_at = self._next_rollover()
+
+    # Срок ротации считается от начала текущего файла — времени его первой записи (mtime не подходит:
+    # он обновляется каждой записью, и при постоянном логировании файл никогда бы не устарел)
+    def _next_rollover(self) -> float:
+        return self._started_at() + self.interval
+
+    def _started_at(self) -> float:
+        try:
+            with open(self.baseFilename, encoding="utf-8") as file:
+                first_line = file.readline()
+            return datetime.fromisoformat(json.loads(first_line)['ts']).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            # Файла ещё нет (или он не в формате JSON): он начинается сейчас
+            return time.time()
+
+    def shouldRollover(self, record) -> bool:
+        if self.interval and time.time() >= self.rollover_at and os.path.exists(self.baseFilename):
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.interval
+
+
+# Логирование без записи на диск в event loop: корневой логгер кладёт записи в очередь,
+# а файл (JSON) и консоль пишет фоновый поток QueueListener. Повторный вызов заменяет прежнюю настройку
+# (воркеры шардов переключаются на свой файл, чтобы процессы не ротировали один и тот же).
+def setup_logging(path: str = LOG_FILE, level: int = logging.INFO):
+    global _listener
+    stop_logging()
+
+    file_handler = SizeTimeRotatingFileHandler(path, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_ROTATE_INTERVAL)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT, CONSOLE_DATE_FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueRecordHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+
+
+# Дописать оставшиеся в очереди записи и остановить фоновый поток
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop_logging)
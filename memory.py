@@ -0,0 +1,78 @@
+import sys
+from types import FunctionType, MethodType, ModuleType
+
+try:
+    import resource
+except ImportError:  # Модуля нет на Windows: пиковая память процесса в отчёт не попадает
+    resource = None
+
+# Объекты этих типов не относятся к данным компонента и не обходятся
+SKIPPED_TYPES = (type, ModuleType, FunctionType, MethodType)
+
+
+# Пиковая память процесса (RSS) в байтах; None, если платформа её не сообщает
+def peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Приблизительный «глубокий» размер объекта: сумма sys.getsizeof по всем достижимым контейнерам и объектам.
+# Уже посчитанные объекты (общие строки, кнопки из шаблонов) второй раз не учитываются.
+def deep_sizeof(root, seen: set = None) -> int:
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, SKIPPED_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+            continue
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(vars(obj))
+            for slot in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return total
+
+
+# Учёт памяти по компонентам процесса: (имя, функция, возвращающая объект, функция числа элементов)
+class MemoryAccounting:
+    def __init__(self):
+        self.components = []
+
+    def register(self, name: str, getter, count=None):
+        self.components.append((name, getter, count))
+
+    # Строки отчёта: (компонент, байт, элементов, байт на элемент). Компоненты считаются по порядку
+    # регистрации, общие объекты относятся к первому компоненту, который на них ссылается.
+    def report(self) -> list:
+        seen = set()
+        rows = []
+        for name, getter, count in self.components:
+            size = deep_sizeof(getter(), seen)
+            items = count() if count is not None else 0
+            rows.append((name, size, items, size / items if items else 0.0))
+        return rows
+
+    def render(self) -> str:
+        lines = [f"{'component':<24}{'bytes':>14}{'items':>10}{'bytes/item':>14}"]
+        for name, size, items, per_item in self.report():
+            lines.append(f"{name:<24}{size:>14}{items:>10}{per_item:>14.1f}")
+        rss = peak_rss()
+        if rss is not None:
+            lines.append(f"{'peak_rss':<24}{rss:>14}")
+        return "\n".join(lines) + "\n"
+
+
+# Общий учёт для всего процесса
+accounting = MemoryAccounting()
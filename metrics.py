@@ -0,0 +1,240 @@
+import logging
+import math
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from aiogram import BaseMiddleware
+from aiohttp import web
+
+import memory
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PROFILE_MAX_DEPTH = 64  # Максимальная глубина стека в сэмплах профилировщика
+PROFILE_MIN_INTERVAL = 0.001  # Допустимый интервал сэмплирования, секунды (меньше — поток крутится вхолостую)
+PROFILE_MAX_INTERVAL = 1.0
+
+
+# Гистограмма в стиле Prometheus (накопительные корзины, сумма и количество)
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+
+
+# Реестр метрик процесса
+class MetricsRegistry:
+    def __init__(self):
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.counters = Counter()  # (имя, метки) -> значение
+        self.gauges = {}  # имя -> функция, возвращающая текущее значение
+        self.descriptions = {}
+
+    def describe(self, name: str, description: str):
+        self.descriptions[name] = description
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def gauge(self, name: str, function):
+        self.gauges[name] = function
+
+    # Замер длительности блока кода
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    # Текстовый формат экспозиции Prometheus
+    def render(self) -> str:
+        lines = []
+        described = set()
+
+        def header(name: str, kind: str):
+            if name not in described:
+                described.add(name)
+                if name in self.descriptions:
+                    lines.append(f"# HELP {name} {self.descriptions[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+
+        for name, function in sorted(self.gauges.items()):
+            try:
+                value = function()
+            except Exception as e:
+                logging.error(f"Ошибка при вычислении метрики {name}: {e}")
+                continue
+            header(name, "gauge")
+            lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Общий реестр для всего процесса
+registry = MetricsRegistry()
+registry.describe("bot_handler_seconds", "Время обработки апдейта хендлером")
+registry.describe("bot_poll_stage_seconds", "Время стадий цикла опроса (fetch, parse, diff, fanout)")
+registry.describe("bot_send_seconds", "Время отправки одного уведомления в Telegram")
+
+
+# Префикс callback_data без параметров: c:507:3 -> c, toggle_coefficient_507_3 -> toggle_coefficient
+def callback_prefix(data: str) -> str:
+    return re.sub(r"([:_]-?\d+)+$", "", data or "")
+
+
+# Middleware, замеряющая время обработки по хендлеру и префиксу callback_data
+class TimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        callback = getattr(handler_object, 'callback', None)
+        name = getattr(callback, '__name__', 'unknown')
+        prefix = callback_prefix(event.data) if isinstance(getattr(event, 'data', None), str) else ""
+
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            registry.observe("bot_handler_seconds", time.perf_counter() - started, handler=name, prefix=prefix)
+
+
+# Сэмплирующий профилировщик: фоновый поток периодически снимает стек потока event loop
+# и копит «свёрнутые» стеки (формат flamegraph.pl / speedscope)
+class SamplingProfiler:
+    def __init__(self):
+        self.samples = Counter()
+        self.interval = 0.005
+        self._thread = None
+        self._stop = threading.Event()
+        self._target_thread_id = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = 0.005):
+        if self.running:
+            return
+        self.interval = interval
+        self.samples.clear()
+        self._target_thread_id = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logging.info(f"Профилировщик запущен, интервал {interval * 1000:.1f} мс.")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        logging.info("Профилировщик остановлен.")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target_thread_id)
+            stack = []
+            while frame is not None and len(stack) < PROFILE_MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+profiler = SamplingProfiler()
+
+
+# HTTP-сервер метрик: /metrics, /memory, /profile/start, /profile/stop, /profile
+def create_app() -> web.Application:
+    app = web.Application()
+
+    async def metrics(request: web.Request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def memory_report(request: web.Request):
+        return web.Response(text=memory.accounting.render(), content_type="text/plain", charset="utf-8")
+
+    async def profile_start(request: web.Request):
+        try:
+            interval = float(request.query.get("interval", "0.005"))
+        except ValueError:
+            interval = math.nan
+        if not math.isfinite(interval):
+            return web.Response(status=400, text="interval must be a number of seconds\n")
+        profiler.start(min(max(interval, PROFILE_MIN_INTERVAL), PROFILE_MAX_INTERVAL))
+        return web.Response(text="started\n")
+
+    async def profile_stop(request: web.Request):
+        profiler.stop()
+        return web.Response(text="stopped\n")
+
+    async def profile(request: web.Request):
+        return web.Response(text=profiler.collapsed(), content_type="text/plain", charset="utf-8")
+
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/memory", memory_report)
+    app.router.add_post("/profile/start", profile_start)
+    app.router.add_post("/profile/stop", profile_stop)
+    app.router.add_get("/profile", profile)
+    return app
+
+
+# Запуск сервера метрик в текущем event loop; возвращает runner для остановки
+async def start_server(host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
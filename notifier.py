@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from metrics import registry
+from ratelimit import TokenBucket
+
+# Лимиты Telegram Bot API
+GLOBAL_RATE = 30  # Сообщений в секунду на бота
+GLOBAL_BURST = 30
+CHAT_RATE = 1  # Сообщений в секунду в один чат
+CHAT_BURST = 3
+SEND_WORKERS = 8  # Количество одновременных отправителей
+CHAT_BUCKET_IDLE_TTL = 60  # Через сколько секунд простоя забывать корзину чата
+DRAIN_TIMEOUT = 10  # Сколько секунд при остановке дорассылать уже поставленные в очередь уведомления
+
+# Полосы приоритета очереди (меньше — раньше)
+PRIORITY_URGENT = 0  # Бесплатная приёмка (коэффициент 0)
+PRIORITY_DIGEST = 1  # Обычные уведомления и сводки
+LANE_NAMES = {PRIORITY_URGENT: "urgent", PRIORITY_DIGEST: "digest"}
+
+# Методы API, отправляющие сообщения от имени бота (учитываются в общем лимите)
+SEND_METHOD_PREFIXES = ("send", "edit", "copy", "forward")
+
+# Выставляется в задачах отправителей, чтобы отличать их запросы от интерактивных ответов
+_notifier_send = contextvars.ContextVar("notifier_send", default=False)
+
+
+# Разбиение HTML-текста на части не длиннее limit: по границе абзаца, затем строки,
+# и только в крайнем случае посреди строки (но не внутри тега)
+def split_html(text: str, limit: int) -> tuple:
+    if len(text) <= limit:
+        return text, ""
+    cut = text.rfind("\n\n", 0, limit + 1)
+    if cut <= 0:
+        cut = text.rfind("\n", 0, limit + 1)
+    if cut <= 0:
+        cut = limit
+        tag_start = text.rfind("<", 0, cut)
+        if tag_start > text.rfind(">", 0, cut) and tag_start > 0:
+            cut = tag_start
+    return text[:cut].rstrip("\n"), text[cut:].lstrip("\n")
+
+
+# Очередь исходящих уведомлений с пулом отправителей и лимитами Telegram.
+# Очередь приоритетная: бесплатные слоты обгоняют сводки, а интерактивные ответы бота
+# берут токен общего лимита вне очереди (см. InteractivePriorityMiddleware).
+# Сообщения одного чата уходят по порядку: в очереди (или среди отложенных) не больше одного сообщения чата,
+# остальные ждут в его собственной куче, пока текущее не будет отправлено целиком.
+class NotificationDispatcher:
+    def __init__(self, bot: Bot, max_message_length: int, workers: int = SEND_WORKERS):
+        self.bot = bot
+        self.max_message_length = max_message_length
+        self.workers = workers
+        self.queue = None
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = {}  # chat_id -> TokenBucket
+        self.delayed = 0  # Сообщения, отложенные до освобождения лимита
+        self.waiting = 0  # Сообщения, ждущие отправки предыдущего сообщения своего чата
+        self.chat_queues = {}  # chat_id -> куча (приоритет, номер, текст); ключ есть, пока у чата есть сообщение в работе
+        self._sequence = itertools.count()  # Порядок сообщений внутри одной полосы
+        self._tasks = []
+        bot.session.middleware(InteractivePriorityMiddleware(self))
+
+    # Текущая глубина очереди (включая отложенные сообщения)
+    @property
+    def depth(self) -> int:
+        return (self.queue.qsize() if self.queue is not None else 0) + self.delayed + self.waiting
+
+    # Постановка сообщения в очередь (не блокирует вызывающего)
+    def enqueue(self, chat_id: int, text: str, priority: int = PRIORITY_DIGEST):
+        sequence = next(self._sequence)
+        chat_queue = self.chat_queues.get(chat_id)
+        if chat_queue is None:
+            self.chat_queues[chat_id] = []
+            self.queue.put_nowait((priority, sequence, chat_id, text))
+        else:
+            heapq.heappush(chat_queue, (priority, sequence, text))
+            self.waiting += 1
+
+    # Текущее сообщение чата отправлено (или отброшено): в очередь встаёт следующее сообщение этого чата
+    def _next_in_chat(self, chat_id: int):
+        chat_queue = self.chat_queues.get(chat_id)
+        if not chat_queue:
+            self.chat_queues.pop(chat_id, None)
+            return
+        priority, sequence, text = heapq.heappop(chat_queue)
+        self.waiting -= 1
+        self.queue.put_nowait((priority, sequence, chat_id, text))
+
+    # Запуск отправителей (очередь создаётся внутри работающего event loop)
+    def start(self):
+        if not self._tasks:
+            self.queue = asyncio.PriorityQueue()
+            self.delayed = 0
+            self.waiting = 0
+            self.chat_queues = {}
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    # Ожидание, пока очередь (включая отложенные сообщения) не опустеет
+    async def drain(self):
+        while True:
+            await self.queue.join()
+            if not self.delayed and not self.waiting:
+                return
+            await asyncio.sleep(0.05)
+
+    # Остановка отправителей. Уведомления в очереди — единственная их копия (снимок уже сохранён),
+    # поэтому сначала очередь дорассылается, но не дольше drain_timeout секунд.
+    async def stop(self, drain_timeout: float = DRAIN_TIMEOUT):
+        if self._tasks and drain_timeout:
+            try:
+                await asyncio.wait_for(self.drain(), drain_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Рассылка остановлена до опустошения очереди, в очереди осталось: {self.depth}")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Отложенная постановка сообщения обратно в очередь с прежним номером (оно остаётся текущим для своего чата)
+    def _reschedule(self, delay: float, priority: int, sequence: int, chat_id: int, text: str):
+        self.delayed += 1
+
+        def put_back():
+            self.delayed -= 1
+            self.queue.put_nowait((priority, sequence, chat_id, text))
+
+        asyncio.get_running_loop().call_later(delay, put_back)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 1000:
+                self._prune_chat_buckets()
+            bucket = self.chat_buckets[chat_id] = TokenBucket(CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    # Удаление корзин давно неактивных чатов
+    def _prune_chat_buckets(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self.chat_buckets.items()):
+            if now - bucket.updated_at > CHAT_BUCKET_IDLE_TTL:
+                del self.chat_buckets[chat_id]
+
+    async def _worker(self):
+        _notifier_send.set(True)
+        while True:
+            priority, sequence, chat_id, text = await self.queue.get()
+            finished = True
+            try:
+                finished = await self._deliver(priority, sequence, chat_id, text)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке уведомления в чат {chat_id}: {e}")
+            finally:
+                if finished:
+                    self._next_in_chat(chat_id)
+                self.queue.task_done()
+
+    # Отправка очередной части сообщения; False, если сообщение (или его остаток) ещё вернётся в очередь
+    async def _deliver(self, priority: int, sequence: int, chat_id: int, text: str) -> bool:
+        # Если лимит чата исчерпан, не занимаем отправителя, а откладываем сообщение
+        delay = self._chat_bucket(chat_id).try_acquire()
+        if delay:
+            self._reschedule(delay, priority, sequence, chat_id, text)
+            return False
+
+        await self.global_bucket.acquire()
+        lane = LANE_NAMES.get(priority, str(priority))
+        part, rest = split_html(text, self.max_message_length)
+        started = time.perf_counter()
+        try:
+            await self.bot.send_message(chat_id, part, parse_mode=ParseMode.HTML)
+            registry.observe("bot_send_seconds", time.perf_counter() - started)
+            registry.increment("bot_sends_total", result="ok", lane=lane)
+        except TelegramRetryAfter as e:
+            registry.increment("bot_sends_total", result="retry_after", lane=lane)
+            logging.warning(f"Flood control для чата {chat_id}, повтор через {e.retry_after} с.")
+            self._reschedule(e.retry_after, priority, sequence, chat_id, text)
+            return False
+        except TelegramAPIError as e:
+            registry.increment("bot_sends_total", result="error", lane=lane)
+            logging.error(f"Не удалось отправить уведомление в чат {chat_id}: {e}")
+            return True
+
+        # Остаток длинного сообщения отправляется следующей частью с тем же номером, раньше других сообщений чата
+        if rest:
+            self.queue.put_nowait((priority, sequence, chat_id, rest))
+            return False
+        return True
+
+
+# Интерактивные ответы (команды, нажатия кнопок) не стоят в очереди уведомлений:
+# они списывают токен общего лимита сразу, а отправители уведомлений ждут, пока долг погасится.
+class InteractivePriorityMiddleware(BaseRequestMiddleware):
+    def __init__(self, notifier: NotificationDispatcher):
+        self.notifier = notifier
+
+    async def __call__(self, make_request, bot, method):
+        if not _notifier_send.get() and method.__api_method__.startswith(SEND_METHOD_PREFIXES):
+            self.notifier.global_bucket.take()
+            registry.increment("bot_interactive_sends_total")
+        return await make_request(bot, method)
@@ -0,0 +1,41 @@
+import asyncio
+import time
+
+
+# Корзина токенов: rate токенов в секунду, не больше capacity накопленных
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Попытка взять токен; возвращает 0, если токен взят, иначе сколько секунд ждать
+    def try_acquire(self) -> float:
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    # Сколько секунд ждать до следующего токена (0 — токен есть), без списания
+    def wait_time(self) -> float:
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    # Безусловное списание токена (может уйти в минус): следующие try_acquire подождут, пока долг не погасится
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    # Ожидание токена
+    async def acquire(self):
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+# Состояния автоматического выключателя
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+# Экспоненциальная задержка с полным джиттером: случайное значение от 0 до base * 2^attempt (не больше cap)
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# Разбор заголовка Retry-After (секунды или HTTP-дата); None, если заголовка нет или он некорректен
+def parse_retry_after(value: str):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Автоматический выключатель: после серии ошибок перестаёт пропускать запросы,
+# а по истечении паузы пропускает пробный запрос (half-open). Пробный запрос, не давший результата
+# за probe_timeout секунд, считается неудачным: выключатель снова размыкается.
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 60.0,
+                 max_reset_timeout: float = 600.0, probe_timeout: float = 120.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.probe_timeout = probe_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_until = 0.0
+        self._current_timeout = reset_timeout
+        self._probe_in_flight = False
+        self._probe_deadline = 0.0
+
+    # Можно ли сейчас выполнять запрос (без изменения состояния)
+    def available(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            return not self._probe_in_flight or time.monotonic() >= self._probe_deadline
+        return time.monotonic() >= self.opened_until
+
+    # Разрешение на запрос; в состоянии half-open пропускается только один пробный запрос
+    def allow(self) -> bool:
+        if self.state == OPEN and time.monotonic() >= self.opened_until:
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+            logging.info(f"Выключатель {self.name}: пробный запрос (half-open).")
+        if self.state == HALF_OPEN and self._probe_in_flight and time.monotonic() >= self._probe_deadline:
+            # Пробный запрос завис: считаем его неудачным
+            logging.warning(f"Выключатель {self.name}: пробный запрос не завершился за {self.probe_timeout:.0f} с.")
+            self.record_failure()
+            return False
+        if self.state == HALF_OPEN:
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            self._probe_deadline = time.monotonic() + self.probe_timeout
+            return True
+        return self.state == CLOSED
+
+    # Запрос прерван без результата (отмена задачи): слот пробного запроса освобождается
+    def abandon(self):
+        self._probe_in_flight = False
+
+    def record_success(self):
+        if self.state != CLOSED:
+            logging.info(f"Выключатель {self.name}: API снова доступно, выключатель закрыт.")
+        self.state = CLOSED
+        self.failures = 0
+        self._current_timeout = self.reset_timeout
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            # Пробный запрос не удался: открываемся снова с удвоенной паузой
+            self._current_timeout = min(self.max_reset_timeout, self._current_timeout * 2)
+            self.trip(self._current_timeout)
+        elif self.state == CLOSED and self.failures >= self.failure_threshold:
+            self.trip(self._current_timeout)
+
+    # Принудительное размыкание (например, по Retry-After)
+    def trip(self, timeout: float):
+        self.state = OPEN
+        self._probe_in_flight = False
+        self.opened_until = max(self.opened_until, time.monotonic() + timeout)
+        logging.warning(f"Выключатель {self.name} открыт на {timeout:.0f} с.")
+
+
+# Перезапуск компонента (опроса, приёма апдейтов и т. п.) после падения, не затрагивая остальные задачи процесса.
+# Задержка растёт экспоненциально, пока компонент падает сразу после запуска, и сбрасывается,
+# если он проработал stable_uptime секунд. Нормальное завершение и отмена не перезапускаются;
+# исключения из fatal пробрасываются наверх (например, потеря аренды опроса).
+async def supervise(name: str, factory, fatal: tuple = (), min_delay: float = 0.5, max_delay: float = 30.0,
+                    stable_uptime: float = 60.0, on_restart=None):
+    delay = min_delay
+    while True:
+        started_at = time.monotonic()
+        try:
+            return await factory()
+        except fatal:
+            raise
+        except Exception as e:
+            logging.exception(f"Компонент {name} упал: {e}")
+        if time.monotonic() - started_at >= stable_uptime:
+            delay = min_delay
+        logging.info(f"Перезапуск компонента {name} через {delay:.1f} с.")
+        await asyncio.sleep(delay)
+        delay = min(max_delay, delay * 2)
+        if on_restart is not None:
+            on_restart(name)
@@ -0,0 +1,176 @@
+from bisect import bisect_right, insort
+
+ANY_BOX_TYPE = -1  # Ключ корзины для правил без фильтра по типу поставки
+MAX_COEFFICIENT = 20  # Верхняя граница диапазона коэффициентов в правилах
+MAX_RULES_PER_CHAT = 20
+NO_LEAD_LIMIT = 1 << 30  # Верхняя граница срока, если в правиле она не задана
+
+
+# Правило уведомлений: склад и диапазоны коэффициента, срока до даты поставки (в днях) и типов поставки.
+# Границы диапазонов включаются; lead_max None — без ограничения сверху, box_types 0 — любой тип поставки.
+class AlertRule:
+    __slots__ = ('warehouse_id', 'coefficient_min', 'coefficient_max', 'lead_min', 'lead_max', 'box_types')
+
+    def __init__(self, warehouse_id: int, coefficient_min: int, coefficient_max: int, lead_min: int = 0,
+                 lead_max: int = None, box_types: int = 0):
+        self.warehouse_id = warehouse_id
+        self.coefficient_min = max(coefficient_min, 0)
+        self.coefficient_max = min(coefficient_max, MAX_COEFFICIENT)
+        self.lead_min = max(lead_min, 0)
+        self.lead_max = lead_max
+        self.box_types = box_types
+
+    # Кортеж для сохранения в базу и передачи между процессами
+    def to_row(self) -> tuple:
+        return (self.warehouse_id, self.coefficient_min, self.coefficient_max, self.lead_min, self.lead_max,
+                self.box_types)
+
+
+# Разбор диапазона вида "N", "A-B", "<=N" / "≤N" или ">=N" / "≥N"; ValueError, если формат не распознан
+def parse_range(text: str, upper: int = None) -> tuple:
+    text = text.replace("≤", "<=").replace("≥", ">=")
+    if text.startswith("<="):
+        return 0, int(text[2:])
+    if text.startswith(">="):
+        return int(text[2:]), upper
+    low, separator, high = text.partition("-")
+    low = int(low)
+    high = int(high) if separator else low
+    if high < low:
+        raise ValueError(f"Пустой диапазон: {text!r}")
+    return low, high
+
+
+# Скомпилированные правила всех пользователей. Правило раскладывается по корзинам
+# (склад, тип поставки или ANY_BOX_TYPE, коэффициент), внутри корзины чаты сгруппированы по интервалу срока,
+# а различные интервалы отсортированы по нижней границе. Строка опроса проверяет только корзины своего склада,
+# типа и коэффициента, отсекает бинарным поиском интервалы, начинающиеся позже её срока, и забирает чаты
+# подходящих интервалов целиком: цена зависит от числа различных интервалов, а не от числа правил.
+class RuleIndex:
+    def __init__(self):
+        # (warehouse_id, box_type_id, coefficient) ->
+        #     ([(lead_min, lead_max), ...], {(lead_min, lead_max): {chat_id: число правил чата}})
+        self._buckets = {}
+        self._warehouses = {}  # warehouse_id -> число правил
+        self._by_chat = {}  # chat_id -> [AlertRule, ...]
+        self._box_type_counts = {}  # ID типа поставки или ANY_BOX_TYPE -> число правил
+        self._box_type_ids = frozenset()  # Кэш результата box_type_ids()
+        self._box_type_ids_valid = True
+
+    def __len__(self):
+        return sum(len(rules) for rules in self._by_chat.values())
+
+    def rules(self, chat_id: int) -> list:
+        return self._by_chat.get(chat_id, [])
+
+    # Замена правил пользователя с перекомпиляцией только его записей
+    def set_rules(self, chat_id: int, rules: list):
+        for rule in self._by_chat.pop(chat_id, ()):
+            self._remove(chat_id, rule)
+        if rules:
+            self._by_chat[chat_id] = list(rules)
+            for rule in rules:
+                self._add(chat_id, rule)
+
+    def remove_chat(self, chat_id: int):
+        self.set_rules(chat_id, [])
+
+    def clear(self):
+        self._buckets.clear()
+        self._warehouses.clear()
+        self._by_chat.clear()
+        self._box_type_counts.clear()
+        self._box_type_ids_valid = False
+
+    # Пользователи, чьи правила подходят под ячейку снимка
+    def match(self, warehouse_id: int, coefficient: int, box_type_id: int, lead_days: int) -> set:
+        chat_ids = set()
+        for key in ((warehouse_id, ANY_BOX_TYPE, coefficient), (warehouse_id, box_type_id, coefficient)):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            intervals, chats = bucket
+            # Интервалы с lead_min > lead_days заведомо не подходят
+            for index in range(bisect_right(intervals, (lead_days, NO_LEAD_LIMIT))):
+                interval = intervals[index]
+                if lead_days <= interval[1]:
+                    chat_ids.update(chats[interval])
+        return chat_ids
+
+    def tracks(self, warehouse_id: int) -> bool:
+        return warehouse_id in self._warehouses
+
+    # Склады, для которых есть хотя бы одно правило
+    def warehouse_ids(self):
+        return list(self._warehouses)
+
+    # Типы поставки, которые нужны правилам; None, если хотя бы одно правило подходит для любого типа
+    # (счётчики правил по типам обновляются при добавлении и удалении, обхода правил нет)
+    def box_type_ids(self):
+        if not self._box_type_ids_valid:
+            counts = self._box_type_counts
+            self._box_type_ids = None if ANY_BOX_TYPE in counts else frozenset(counts)
+            self._box_type_ids_valid = True
+        return self._box_type_ids
+
+    @staticmethod
+    def _box_type_keys(rule: AlertRule) -> list:
+        if not rule.box_types:
+            return [ANY_BOX_TYPE]
+        return [box_type_id for box_type_id in range(rule.box_types.bit_length()) if rule.box_types >> box_type_id & 1]
+
+    @staticmethod
+    def _interval(rule: AlertRule) -> tuple:
+        return rule.lead_min, rule.lead_max if rule.lead_max is not None else NO_LEAD_LIMIT
+
+    def _keys(self, rule: AlertRule):
+        for box_type_id in self._box_type_keys(rule):
+            for coefficient in range(rule.coefficient_min, rule.coefficient_max + 1):
+                yield rule.warehouse_id, box_type_id, coefficient
+
+    def _count_box_types(self, rule: AlertRule, delta: int):
+        counts = self._box_type_counts
+        for box_type_id in self._box_type_keys(rule):
+            count = counts.get(box_type_id, 0) + delta
+            if count:
+                counts[box_type_id] = count
+            else:
+                del counts[box_type_id]
+        self._box_type_ids_valid = False
+
+    def _add(self, chat_id: int, rule: AlertRule):
+        interval = self._interval(rule)
+        for key in self._keys(rule):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = ([], {})
+            intervals, chats = bucket
+            counts = chats.get(interval)
+            if counts is None:
+                insort(intervals, interval)
+                counts = chats[interval] = {}
+            counts[chat_id] = counts.get(chat_id, 0) + 1
+        self._warehouses[rule.warehouse_id] = self._warehouses.get(rule.warehouse_id, 0) + 1
+        self._count_box_types(rule, 1)
+
+    def _remove(self, chat_id: int, rule: AlertRule):
+        interval = self._interval(rule)
+        for key in self._keys(rule):
+            intervals, chats = self._buckets[key]
+            counts = chats[interval]
+            count = counts[chat_id] - 1
+            if count:
+                counts[chat_id] = count
+                continue
+            del counts[chat_id]
+            if not counts:
+                del chats[interval]
+                intervals.remove(interval)
+                if not intervals:
+                    del self._buckets[key]
+        self._count_box_types(rule, -1)
+        count = self._warehouses[rule.warehouse_id] - 1
+        if count:
+            self._warehouses[rule.warehouse_id] = count
+        else:
+            del self._warehouses[rule.warehouse_id]
@@ -0,0 +1,93 @@
+import time
+
+from config import POLL_MIN_INTERVAL, POLL_MAX_INTERVAL
+
+SPEEDUP_FACTOR = 0.5  # Во сколько раз сокращать интервал после изменения
+BACKOFF_FACTOR = 1.5  # Во сколько раз увеличивать интервал, если ничего не изменилось
+BASELINE_INTERVAL = 10  # Фиксированный интервал прежнего опроса, для оценки сэкономленных запросов
+
+
+# Состояние опроса одного склада
+class WarehouseSchedule:
+    __slots__ = ('interval', 'next_due', 'last_change', 'polls')
+
+    def __init__(self, now: float, interval: float):
+        self.interval = interval
+        self.next_due = now
+        self.last_change = None
+        self.polls = 0
+
+
+# Адаптивный планировщик опроса: у каждого склада свой интервал, бюджет запросов — у пула ключей API
+class PollScheduler:
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL, max_interval: float = POLL_MAX_INTERVAL):
+        self.base_min_interval = min_interval  # Минимальный интервал для одного ключа API
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.warehouses = {}  # warehouse_id -> WarehouseSchedule
+        self.requests = 0
+        self.started_at = time.monotonic()
+
+    # Синхронизация с набором отслеживаемых складов
+    def sync(self, warehouse_ids):
+        now = time.monotonic()
+        warehouse_ids = set(warehouse_ids)
+        for warehouse_id in warehouse_ids - self.warehouses.keys():
+            # Новый склад опрашиваем сразу и с минимальным интервалом
+            self.warehouses[warehouse_id] = WarehouseSchedule(now, self.min_interval)
+        for warehouse_id in self.warehouses.keys() - warehouse_ids:
+            del self.warehouses[warehouse_id]
+
+    # Подстройка под число рабочих ключей API: с N ключами бюджет запросов в N раз больше,
+    # поэтому склады можно опрашивать в N раз чаще, а опрос дробится на меньшие группы
+    def scale(self, tokens: int):
+        self.min_interval = self.base_min_interval / max(1, tokens)
+
+    # Склады, которые пора опросить; склады, срок которых скоро наступит, присоединяются к тому же запросу
+    def due(self) -> list:
+        now = time.monotonic()
+        if not any(schedule.next_due <= now for schedule in self.warehouses.values()):
+            return []
+        horizon = now + self.min_interval / 2
+        return [warehouse_id for warehouse_id, schedule in self.warehouses.items() if schedule.next_due <= horizon]
+
+    # Учёт результата опроса: ускоряемся после изменений и замедляемся в периоды затишья
+    def report(self, warehouse_ids, changed_warehouse_ids):
+        now = time.monotonic()
+        self.requests += 1
+        for warehouse_id in warehouse_ids:
+            schedule = self.warehouses.get(warehouse_id)
+            if schedule is None:
+                continue
+            schedule.polls += 1
+            if warehouse_id in changed_warehouse_ids:
+                schedule.last_change = now
+                schedule.interval = max(self.min_interval, schedule.interval * SPEEDUP_FACTOR)
+            else:
+                schedule.interval = min(self.max_interval, schedule.interval * BACKOFF_FACTOR)
+            schedule.next_due = now + schedule.interval
+
+    # Опрос не выполнялся (например, выключатель открыт): срок откладывается не меньше чем на delay секунд,
+    # а счётчик запросов и интервалы не меняются — ответа API не было
+    def defer(self, warehouse_ids, delay: float):
+        next_due = time.monotonic() + max(1.0, delay)
+        for warehouse_id in warehouse_ids:
+            schedule = self.warehouses.get(warehouse_id)
+            if schedule is not None:
+                schedule.next_due = max(schedule.next_due, next_due)
+
+    # Сколько спать до ближайшего опроса
+    def sleep_time(self) -> float:
+        if not self.warehouses:
+            return self.min_interval
+        next_due = min(schedule.next_due for schedule in self.warehouses.values())
+        return min(self.max_interval, max(1.0, next_due - time.monotonic()))
+
+    # Текущие интервалы опроса по складам
+    def intervals(self) -> dict:
+        return {warehouse_id: schedule.interval for warehouse_id, schedule in self.warehouses.items()}
+
+    # Сколько запросов сэкономлено по сравнению с фиксированным опросом раз в BASELINE_INTERVAL секунд
+    def saved_requests(self) -> int:
+        baseline = int((time.monotonic() - self.started_at) / BASELINE_INTERVAL)
+        return max(0, baseline - self.requests)
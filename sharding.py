@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import sys
+import time
+from collections import deque
+
+from aiogram import BaseMiddleware
+
+from changes import Changeset
+from metrics import registry
+
+VIRTUAL_NODES = 64  # Точек на кольце на один воркер (сглаживает распределение чатов)
+IPC_LINE_LIMIT = 64 * 1024 * 1024  # Максимальная длина одного сообщения канала (снимок целиком), байт
+RESTART_DELAY = 1.0  # Пауза перед перезапуском упавшего воркера, секунды
+RESTART_MAX_DELAY = 30.0  # Предел паузы, если воркер падает сразу после запуска
+STABLE_UPTIME = 60.0  # Сколько воркер должен проработать, чтобы пауза перезапуска сбросилась
+SHARD_WORKER_FLAG = "--shard-worker"  # Аргумент командной строки, запускающий процесс в роли воркера
+REPLAY_LIMIT = 10000  # Сколько неподтверждённых наборов изменений хранить для повтора упавшему воркеру
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+# Консистентное хеширование чатов по воркерам: при изменении числа воркеров
+# переезжает только ~1/N чатов, а не все
+class HashRing:
+    def __init__(self, shards: int, virtual_nodes: int = VIRTUAL_NODES):
+        self.shards = shards
+        points = sorted((_hash(f"shard-{shard}-{node}"), shard)
+                        for shard in range(shards) for node in range(virtual_nodes))
+        self._points = [point for point, _ in points]
+        self._owners = [shard for _, shard in points]
+
+    # Номер воркера, которому принадлежит чат
+    def shard_for(self, chat_id: int) -> int:
+        index = bisect.bisect(self._points, _hash(str(chat_id)))
+        return self._owners[index % len(self._owners)]
+
+
+# Сообщения канала — JSON по одному на строку
+def encode_message(kind: str, **fields) -> bytes:
+    fields['kind'] = kind
+    return json.dumps(fields, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+def encode_changeset(changeset: Changeset, sequence: int) -> bytes:
+    return encode_message(
+        "changeset",
+        seq=sequence,
+        inserted=[(*key, coeff_value, box_type_name) for key, coeff_value, box_type_name in changeset.inserted],
+        changed=[(*key, previous, coeff_value, box_type_name)
+                 for key, previous, coeff_value, box_type_name in changeset.changed],
+        removed=[(*key, previous) for key, previous in changeset.removed],
+    )
+
+
+def decode_changeset(message: dict) -> Changeset:
+    changeset = Changeset()
+    changeset.inserted = [((wid, date, box_type_id), coeff_value, box_type_name)
+                          for wid, date, box_type_id, coeff_value, box_type_name in message['inserted']]
+    changeset.changed = [((wid, date, box_type_id), previous, coeff_value, box_type_name)
+                         for wid, date, box_type_id, previous, coeff_value, box_type_name in message['changed']]
+    changeset.removed = [((wid, date, box_type_id), previous)
+                         for wid, date, box_type_id, previous in message['removed']]
+    return changeset
+
+
+# base — последний набор изменений, подтверждённый воркером: следующие за ним, уже учтённые в снимке,
+# повторяются после снимка только для рассылки
+def encode_snapshot(cells: dict, sequence: int, base: int = None) -> bytes:
+    return encode_message("snapshot", seq=sequence, base=sequence if base is None else base,
+                          cells=[(*key, coeff_value, box_type_name)
+                                 for key, (coeff_value, box_type_name) in cells.items()])
+
+
+def decode_snapshot(message: dict) -> dict:
+    return {(wid, date, box_type_id): (coeff_value, box_type_name)
+            for wid, date, box_type_id, coeff_value, box_type_name in message['cells']}
+
+
+# Воркер шарда и его канал (stdin — сообщения от супервизора, stdout — ответы)
+class ShardProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        # Сообщения (номер набора изменений или None, строка), ожидающие отправки воркеру
+        # (копятся и во время перезапуска)
+        self.queue = asyncio.Queue()
+        self.unsent = None  # Сообщение, которое не удалось записать в канал упавшего воркера
+        self.acked = 0  # Последний набор изменений, который воркер подтвердил (разослал своим чатам)
+        self.replay = deque()  # Неподтверждённые наборы изменений (номер, строка) для повтора после перезапуска
+        self.warehouse_ids = set()  # Склады, на которые подписаны чаты шарда
+        self.restarts = 0
+
+
+# Супервизор: запускает N воркеров, рассылает им наборы изменений и апдейты их чатов,
+# перезапускает упавших. Состояние чатов воркер восстанавливает из общей базы SQLite,
+# снимок коэффициентов получает первым сообщением после запуска.
+class ShardSupervisor:
+    def __init__(self, command: list, ring: HashRing, snapshot):
+        self.command = command
+        self.ring = ring
+        self.snapshot = snapshot
+        self.sequence = 0  # Номер последнего разосланного набора изменений
+        self.status = None  # Последнее состояние опроса для /status в воркерах
+        self.workers = []
+        self._tasks = []
+        self._stopping = False
+
+    async def start(self):
+        self._stopping = False
+        self.workers = [ShardProcess(index) for index in range(self.ring.shards)]
+        self._tasks = [asyncio.create_task(self._supervise(worker)) for worker in self.workers]
+
+    async def stop(self):
+        self._stopping = True
+        for worker in self.workers:
+            if worker.process is not None and worker.process.returncode is None:
+                # Закрытие stdin — сигнал воркеру сохранить состояние и завершиться
+                worker.process.stdin.close()
+        for worker in self.workers:
+            if worker.process is not None:
+                try:
+                    await asyncio.wait_for(worker.process.wait(), timeout=10)
+                except asyncio.TimeoutError:
+                    worker.process.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Объединение складов всех шардов — их опрашивает единственный поллер
+    def warehouse_ids(self) -> set:
+        return set().union(*(worker.warehouse_ids for worker in self.workers))
+
+    # Набор изменений сериализуется один раз и уходит всем воркерам; до подтверждения он хранится для повтора
+    def publish(self, changeset: Changeset):
+        self.sequence += 1
+        line = encode_changeset(changeset, self.sequence)
+        for worker in self.workers:
+            if len(worker.replay) >= REPLAY_LIMIT:
+                logging.error(f"Воркер шарда {worker.index} не подтверждает изменения, "
+                              f"старейший набор {worker.replay[0][0]} не будет повторён.")
+                worker.replay.popleft()
+            worker.replay.append((self.sequence, line))
+            worker.queue.put_nowait((self.sequence, line))
+
+    def publish_status(self, status: dict):
+        self.status = status
+        line = encode_message("status", **status)
+        for worker in self.workers:
+            worker.queue.put_nowait((None, line))
+
+    # Апдейт Telegram уходит только воркеру, которому принадлежит чат
+    def forward_update(self, chat_id: int, update: dict):
+        self.workers[self.ring.shard_for(chat_id)].queue.put_nowait((None, encode_message("update", update=update)))
+
+    async def _supervise(self, worker: ShardProcess):
+        delay = RESTART_DELAY
+        while not self._stopping:
+            started_at = time.monotonic()
+            worker.process = await asyncio.create_subprocess_exec(
+                *self.command, str(worker.index), str(self.ring.shards),
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+            logging.info(f"Воркер шарда {worker.index} запущен (pid {worker.process.pid}).")
+
+            pump = asyncio.create_task(self._pump(worker))
+            try:
+                await self._read(worker)
+                await worker.process.wait()
+            finally:
+                pump.cancel()
+                await asyncio.gather(pump, return_exceptions=True)
+            if self._stopping:
+                return
+
+            worker.restarts += 1
+            registry.increment("bot_shard_restarts_total", shard=worker.index)
+            if time.monotonic() - started_at > STABLE_UPTIME:
+                delay = RESTART_DELAY
+            logging.error(f"Воркер шарда {worker.index} завершился с кодом {worker.process.returncode}, "
+                          f"перезапуск через {delay:.0f} с.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_MAX_DELAY)
+
+    # Запись в канал воркера: сначала актуальный снимок, затем неподтверждённые наборы изменений
+    # (в снимке они уже учтены, воркер только разошлёт их — в том числе попавшие в канал упавшего процесса),
+    # затем накопленные сообщения по порядку без уже повторённых наборов
+    async def _pump(self, worker: ShardProcess):
+        stdin = worker.process.stdin
+        try:
+            replayed_sequence = self.sequence
+            stdin.write(encode_snapshot(self.snapshot.cells, replayed_sequence, worker.acked))
+            if self.status is not None:
+                stdin.write(encode_message("status", **self.status))
+            for _, line in worker.replay:
+                stdin.write(line)
+            await stdin.drain()
+            while True:
+                if worker.unsent is None:
+                    worker.unsent = await worker.queue.get()
+                sequence, line = worker.unsent
+                if sequence is None or sequence > replayed_sequence:
+                    stdin.write(line)
+                    await stdin.drain()
+                worker.unsent = None
+        except (BrokenPipeError, ConnectionResetError):
+            # Воркер упал; неотправленное сообщение уйдёт новому процессу
+            pass
+
+    # Чтение ответов воркера до закрытия его stdout
+    async def _read(self, worker: ShardProcess):
+        async for message in read_messages(worker.process.stdout):
+            kind = message.get('kind')
+            if kind == "warehouses":
+                worker.warehouse_ids = set(message['ids'])
+            elif kind == "ack":
+                worker.acked = max(worker.acked, message['seq'])
+                while worker.replay and worker.replay[0][0] <= worker.acked:
+                    worker.replay.popleft()
+
+
+# Middleware супервизора: апдейт не обрабатывается локально, а пересылается воркеру шарда чата
+class ShardRouterMiddleware(BaseMiddleware):
+    def __init__(self, supervisor: ShardSupervisor):
+        self.supervisor = supervisor
+
+    async def __call__(self, handler, event, data):
+        chat = data.get('event_chat')
+        user = data.get('event_from_user')
+        chat_id = chat.id if chat is not None else user.id if user is not None else 0
+        self.supervisor.forward_update(chat_id, event.model_dump(mode="json", exclude_unset=True, by_alias=True))
+
+
+# Чтение сообщений канала построчно; битые строки пропускаются
+async def read_messages(reader: asyncio.StreamReader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        try:
+            yield json.loads(line)
+        except ValueError:
+            logging.error(f"Некорректное сообщение канала шардов: {line[:200]!r}")
+
+
+# Канал воркера к супервизору: stdin процесса как асинхронный поток
+async def connect_parent() -> asyncio.StreamReader:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=IPC_LINE_LIMIT)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    return reader
+
+
+# Короткие ответы супервизору пишутся в stdout синхронно (логи идут в stderr)
+def send_to_parent(kind: str, **fields):
+    sys.stdout.buffer.write(encode_message(kind, **fields))
+    sys.stdout.buffer.flush()
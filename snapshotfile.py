@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+from datetime import date as date_type
+
+from config import SNAPSHOT_FILE, SNAPSHOT_INTERVAL
+
+# Формат файла (little-endian):
+#   заголовок: магическое число, версия формата, версия снимка, время сохранения, первый день окна,
+#              число названий типов поставки, число ячеек;
+#   названия типов поставки: длина (u16) + UTF-8;
+#   ячейки: ID склада (i64), день (i32, порядковый номер), ID типа поставки (i32), коэффициент (i16),
+#           номер названия типа поставки (i16, -1 — нет названия);
+#   CRC32 всего предыдущего содержимого.
+MAGIC = b"WBCS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHQdiHI")
+NAME_LENGTH = struct.Struct("<H")
+CELL = struct.Struct("<qiihh")
+CHECKSUM = struct.Struct("<I")
+
+
+# Сериализация ячеек снимка в компактный двоичный вид
+def encode(cells: dict, window_start: str, version: int) -> bytes:
+    names = {}
+    days = {}
+    body = bytearray()
+    for (warehouse_id, date, box_type_id), (coeff_value, box_type_name) in cells.items():
+        day = days.get(date)
+        if day is None:
+            day = days[date] = date_type.fromisoformat(date).toordinal()
+        name_index = -1 if box_type_name is None else names.setdefault(box_type_name, len(names))
+        body += CELL.pack(warehouse_id, day, box_type_id, coeff_value, name_index)
+
+    first_day = date_type.fromisoformat(window_start).toordinal() if window_start else 0
+    data = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, version, time.time(), first_day, len(names), len(cells)))
+    for name in names:
+        encoded = name.encode()
+        data += NAME_LENGTH.pack(len(encoded)) + encoded
+    data += body
+    data += CHECKSUM.pack(zlib.crc32(data))
+    return bytes(data)
+
+
+# Разбор содержимого файла (bytes или mmap): (ячейки, первая дата окна, версия снимка); ValueError, если файл повреждён
+def decode(buffer) -> tuple:
+    view = memoryview(buffer)
+    try:
+        if len(view) < HEADER.size + CHECKSUM.size:
+            raise ValueError("файл снимка обрезан")
+        (checksum,) = CHECKSUM.unpack_from(view, len(view) - CHECKSUM.size)
+        if zlib.crc32(view[:len(view) - CHECKSUM.size]) != checksum:
+            raise ValueError("контрольная сумма файла снимка не совпадает")
+        magic, format_version, version, _, first_day, name_count, cell_count = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError("неизвестный формат файла снимка")
+
+        offset = HEADER.size
+        names = []
+        for _ in range(name_count):
+            (length,) = NAME_LENGTH.unpack_from(view, offset)
+            offset += NAME_LENGTH.size
+            names.append(bytes(view[offset:offset + length]).decode())
+            offset += length
+
+        dates = {}
+        cells = {}
+        for warehouse_id, day, box_type_id, coeff_value, name_index in CELL.iter_unpack(
+                view[offset:offset + cell_count * CELL.size]):
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = date_type.fromordinal(day).isoformat()
+            cells[(warehouse_id, date, box_type_id)] = (coeff_value, names[name_index] if name_index >= 0 else None)
+        window_start = date_type.fromordinal(first_day).isoformat() if first_day else ""
+        return cells, window_start, version
+    except struct.error as e:
+        raise ValueError(f"файл снимка обрезан: {e}") from e
+    finally:
+        view.release()
+
+
+# Атомарная запись: временный файл рядом с целевым, fsync и переименование поверх прежнего
+def write_atomic(path: str, data: bytes):
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+    # fsync каталога закрепляет само переименование; на Windows каталог так не открыть — файл уже на месте
+    if os.name != "nt":
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+# Файл снимка коэффициентов: сохраняется перед рассылкой изменений (после сбоя уже разосланное не повторится)
+# и по таймеру для изменений без рассылки (вытеснение прошедших дат)
+class SnapshotFile:
+    def __init__(self, path: str = SNAPSHOT_FILE, interval: float = SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.saved_version = None
+        self._lock = None
+
+    # Подготовка к работе в текущем event loop (блокировка привязывается к циклу, а main может запускаться заново)
+    def open(self):
+        self._lock = asyncio.Lock()
+
+    # Чтение через mmap; None, если файла нет или он повреждён (тогда снимок берётся из базы)
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    return decode(mapped)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.error(f"Файл снимка {self.path} не прочитан: {e}")
+            return None
+
+    # Сохранение, если снимок изменился с прошлой записи
+    async def save(self, snapshot):
+        async with self._lock:
+            version = snapshot.version
+            if version == self.saved_version:
+                return
+            # Копия словаря дешёвая, а сериализация и запись идут в потоке, не задерживая event loop
+            cells = dict(snapshot.cells)
+            try:
+                await asyncio.to_thread(self._write, cells, snapshot.window_start, version)
+            except Exception as e:
+                # Ошибка записи не должна прерывать рассылку. Устаревший файл хуже отсутствующего:
+                # без него снимок возьмётся из базы
+                logging.error(f"Ошибка при сохранении файла снимка: {e}")
+                self.discard()
+                return
+            self.saved_version = version
+
+    def _write(self, cells: dict, window_start: str, version: int):
+        write_atomic(self.path, encode(cells, window_start, version))
+
+    # Удаление файла, который мог остаться устаревшим
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.saved_version = None
+
+    # Периодическое сохранение изменений, которые не прошли через save перед рассылкой
+    async def run(self, snapshot):
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.save(snapshot)
+        finally:
+            await self.save(snapshot)
@@ -0,0 +1,365 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import date as date_type
+
+from config import DATABASE_URL
+from keyboards import mask_coefficients
+from rules import AlertRule
+
+FLUSH_INTERVAL = 1.0  # Как часто сбрасывать накопленные изменения на диск, секунды
+HISTORY_PAGE_SIZE = 200  # Сколько строк истории читать из базы за один запрос
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    chat_id INTEGER PRIMARY KEY,
+    setup_complete INTEGER NOT NULL DEFAULT 0,
+    current_warehouse_index INTEGER NOT NULL DEFAULT 0,
+    last_message_id INTEGER,
+    digest INTEGER NOT NULL DEFAULT 1,
+    box_types INTEGER NOT NULL DEFAULT 0  -- Битовая маска ID типов поставки, 0 — все типы
+);
+CREATE TABLE IF NOT EXISTS user_warehouses (
+    chat_id INTEGER NOT NULL REFERENCES users (chat_id) ON DELETE CASCADE,
+    warehouse_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, warehouse_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_coefficients (
+    chat_id INTEGER NOT NULL REFERENCES users (chat_id) ON DELETE CASCADE,
+    warehouse_id INTEGER NOT NULL,
+    coefficient INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, warehouse_id, coefficient)
+) WITHOUT ROWID;
+-- Правила уведомлений с диапазонами (lead_max NULL — без ограничения, box_types 0 — любой тип поставки)
+CREATE TABLE IF NOT EXISTS user_rules (
+    chat_id INTEGER NOT NULL REFERENCES users (chat_id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    warehouse_id INTEGER NOT NULL,
+    coefficient_min INTEGER NOT NULL,
+    coefficient_max INTEGER NOT NULL,
+    lead_min INTEGER NOT NULL,
+    lead_max INTEGER,
+    box_types INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_user_coefficients_match ON user_coefficients (warehouse_id, coefficient);
+CREATE TABLE IF NOT EXISTS snapshot (
+    warehouse_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    box_type_id INTEGER NOT NULL,
+    coefficient INTEGER NOT NULL,
+    box_type_name TEXT,
+    PRIMARY KEY (warehouse_id, date, box_type_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS box_types (
+    box_type_id INTEGER PRIMARY KEY,
+    name TEXT
+);
+-- Архив переходов коэффициентов: дата хранится как порядковый номер дня, время наблюдения — в секундах Unix
+CREATE TABLE IF NOT EXISTS coefficient_history (
+    warehouse_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    box_type_id INTEGER NOT NULL,
+    observed_at INTEGER NOT NULL,
+    coefficient INTEGER NOT NULL,
+    PRIMARY KEY (warehouse_id, day, box_type_id, observed_at)
+) WITHOUT ROWID;
+-- Каталог складов из /warehouses, чтобы запуск не ждал сети
+CREATE TABLE IF NOT EXISTS warehouses (
+    warehouse_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    address TEXT,
+    work_time TEXT,
+    accepts_qr INTEGER NOT NULL DEFAULT 0
+);
+-- ETag и хеш содержимого последнего ответа /warehouses, время последней проверки (секунды Unix)
+CREATE TABLE IF NOT EXISTS warehouse_catalog (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    etag TEXT,
+    content_hash BLOB NOT NULL,
+    refreshed_at REAL NOT NULL
+);
+"""
+
+
+# Хранилище состояния пользователей и снимка коэффициентов в SQLite с отложенной пакетной записью
+class StateStore:
+    def __init__(self, path: str = DATABASE_URL):
+        self.path = path
+        self._connection = None
+        self._dirty_users = set()
+        self._pending_cells = {}  # ключ ячейки -> (коэффициент, тип поставки) или None для удалённых
+        self._pending_history = []  # (склад, день, тип поставки, время наблюдения, коэффициент)
+        self._pending_box_types = {}  # ID типа поставки -> название
+        self._known_box_types = set()
+        self._lock = None
+        self._reader = None
+
+    # Открытие базы данных и создание схемы
+    def open(self):
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA foreign_keys=ON")
+        self._connection.executescript(SCHEMA)
+        self._migrate()
+        self._lock = asyncio.Lock()
+        # Отдельное соединение для чтения истории, не мешающее фоновой записи (WAL)
+        self._reader = sqlite3.connect(self.path, check_same_thread=False)
+        self._known_box_types = {box_type_id for box_type_id, in self._reader.execute(
+            "SELECT box_type_id FROM box_types")}
+
+    # Добавление столбцов, появившихся после создания базы
+    def _migrate(self):
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(users)")}
+        if 'digest' not in columns:
+            self._connection.execute("ALTER TABLE users ADD COLUMN digest INTEGER NOT NULL DEFAULT 1")
+        if 'box_types' not in columns:
+            self._connection.execute("ALTER TABLE users ADD COLUMN box_types INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    # Загрузка всех пользователей в формат user_data
+    def load_users(self) -> dict:
+        user_data = {}
+        for chat_id, setup_complete, current_warehouse_index, last_message_id, digest, box_types in \
+                self._connection.execute("SELECT chat_id, setup_complete, current_warehouse_index, last_message_id, "
+                                         "digest, box_types FROM users"):
+            user_data[chat_id] = {
+                'selected_warehouses': [],
+                'selected_coefficients': {},
+                'last_message_id': last_message_id,
+                'last_keyboard': None,
+                'last_text': None,
+                'warehouse_page': None,
+                'warehouse_query': None,
+                'current_warehouse_index': current_warehouse_index,
+                'setup_complete': bool(setup_complete),
+                'digest': bool(digest),
+                'selected_box_types': box_types,
+                'rules': []
+            }
+
+        for chat_id, warehouse_id in self._connection.execute(
+                "SELECT chat_id, warehouse_id FROM user_warehouses ORDER BY chat_id, position"):
+            user_data[chat_id]['selected_warehouses'].append(warehouse_id)
+
+        # Выбранные коэффициенты склада собираются в битовую маску
+        for chat_id, warehouse_id, coefficient in self._connection.execute(
+                "SELECT chat_id, warehouse_id, coefficient FROM user_coefficients"):
+            selected_coefficients = user_data[chat_id]['selected_coefficients']
+            selected_coefficients[warehouse_id] = selected_coefficients.get(warehouse_id, 0) | 1 << coefficient
+
+        for chat_id, *row in self._connection.execute(
+                "SELECT chat_id, warehouse_id, coefficient_min, coefficient_max, lead_min, lead_max, box_types "
+                "FROM user_rules ORDER BY chat_id, position"):
+            user_data[chat_id]['rules'].append(AlertRule(*row))
+
+        return user_data
+
+    # Загрузка снимка коэффициентов с последнего опроса
+    def load_snapshot(self) -> dict:
+        return {
+            (warehouse_id, date, box_type_id): (coefficient, box_type_name)
+            for warehouse_id, date, box_type_id, coefficient, box_type_name in self._connection.execute(
+                "SELECT warehouse_id, date, box_type_id, coefficient, box_type_name FROM snapshot")
+        }
+
+    # Сохранённый каталог складов: (склады, ETag, хеш содержимого, время проверки) или None, если его нет
+    def load_warehouse_catalog(self):
+        state = self._connection.execute(
+            "SELECT etag, content_hash, refreshed_at FROM warehouse_catalog WHERE id = 1").fetchone()
+        if state is None:
+            return None
+        warehouses = [
+            {"ID": warehouse_id, "name": name, "address": address, "workTime": work_time,
+             "acceptsQR": bool(accepts_qr)}
+            for warehouse_id, name, address, work_time, accepts_qr in self._connection.execute(
+                "SELECT warehouse_id, name, address, work_time, accepts_qr FROM warehouses")
+        ]
+        return (warehouses, *state)
+
+    # Время последней проверки каталога (по нему воркеры замечают обновление, сделанное другим процессом)
+    def warehouse_catalog_refreshed_at(self) -> float:
+        row = self._connection.execute("SELECT refreshed_at FROM warehouse_catalog WHERE id = 1").fetchone()
+        return row[0] if row is not None else 0.0
+
+    # Сохранение каталога складов; warehouses=None — каталог не изменился, обновляется только время проверки
+    async def save_warehouse_catalog(self, warehouses, etag, content_hash: bytes, refreshed_at: float):
+        async with self._lock:
+            await asyncio.to_thread(self._write_warehouse_catalog, warehouses, etag, content_hash, refreshed_at)
+
+    def _write_warehouse_catalog(self, warehouses, etag, content_hash: bytes, refreshed_at: float):
+        connection = self._connection
+        connection.execute("BEGIN")
+        try:
+            if warehouses is not None:
+                connection.execute("DELETE FROM warehouses")
+                connection.executemany(
+                    "INSERT INTO warehouses (warehouse_id, name, address, work_time, accepts_qr) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(warehouse['ID'], warehouse['name'], warehouse.get('address'), warehouse.get('workTime'),
+                      int(bool(warehouse.get('acceptsQR')))) for warehouse in warehouses])
+            connection.execute(
+                "INSERT OR REPLACE INTO warehouse_catalog (id, etag, content_hash, refreshed_at) VALUES (1, ?, ?, ?)",
+                (etag, content_hash, refreshed_at))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    # Пометка пользователя для записи при следующем сбросе
+    def mark_user(self, chat_id: int):
+        self._dirty_users.add(chat_id)
+
+    # Накопление изменений снимка (повторные изменения одной ячейки схлопываются) и переходов для архива
+    def record_changeset(self, changeset):
+        observed_at = int(time.time())
+        for key, coeff_value, box_type_name in changeset.inserted:
+            self._pending_cells[key] = (coeff_value, box_type_name)
+            self._append_history(key, observed_at, coeff_value, box_type_name)
+        for key, _, coeff_value, box_type_name in changeset.changed:
+            self._pending_cells[key] = (coeff_value, box_type_name)
+            self._append_history(key, observed_at, coeff_value, box_type_name)
+        for key, _ in changeset.removed:
+            self._pending_cells[key] = None
+
+    def _append_history(self, key: tuple, observed_at: int, coeff_value: int, box_type_name: str):
+        warehouse_id, date, box_type_id = key
+        self._pending_history.append(
+            (warehouse_id, date_type.fromisoformat(date).toordinal(), box_type_id, observed_at, coeff_value))
+        if box_type_id not in self._known_box_types:
+            self._known_box_types.add(box_type_id)
+            self._pending_box_types[box_type_id] = box_type_name
+
+    # Потоковое чтение архива страницами: (склад, дата, тип поставки, время наблюдения, коэффициент)
+    async def iter_history(self, warehouse_ids: list, date_from: str = None, date_to: str = None):
+        day_from = date_type.fromisoformat(date_from).toordinal() if date_from else 0
+        day_to = date_type.fromisoformat(date_to).toordinal() if date_to else date_type.max.toordinal()
+
+        for warehouse_id in warehouse_ids:
+            cursor = (day_from, -1, -1)
+            while True:
+                rows = await asyncio.to_thread(self._read_history_page, warehouse_id, cursor, day_to)
+                for _, day, box_type_id, observed_at, coeff_value, box_type_name in rows:
+                    yield (warehouse_id, date_type.fromordinal(day).isoformat(), box_type_name, observed_at,
+                           coeff_value)
+                if len(rows) < HISTORY_PAGE_SIZE:
+                    break
+                _, day, box_type_id, observed_at, _, _ = rows[-1]
+                cursor = (day, box_type_id, observed_at)
+
+    def _read_history_page(self, warehouse_id: int, cursor: tuple, day_to: int) -> list:
+        return self._reader.execute(
+            "SELECT h.warehouse_id, h.day, h.box_type_id, h.observed_at, h.coefficient, b.name "
+            "FROM coefficient_history h LEFT JOIN box_types b ON b.box_type_id = h.box_type_id "
+            "WHERE h.warehouse_id = ? AND (h.day, h.box_type_id, h.observed_at) > (?, ?, ?) AND h.day <= ? "
+            "ORDER BY h.day, h.box_type_id, h.observed_at LIMIT ?",
+            (warehouse_id, *cursor, day_to, HISTORY_PAGE_SIZE)).fetchall()
+
+    # Сброс накопленных изменений в базу (запись выполняется в отдельном потоке)
+    async def flush(self, user_data: dict):
+        async with self._lock:
+            if not self._dirty_users and not self._pending_cells and not self._pending_history:
+                return
+
+            # Снимаем копию состояния в event loop, чтобы поток не читал изменяемые словари
+            users = []
+            for chat_id in self._dirty_users:
+                data = user_data.get(chat_id)
+                if data is None:
+                    users.append((chat_id, None))
+                    continue
+                users.append((chat_id, (
+                    int(data.get('setup_complete', False)),
+                    data.get('current_warehouse_index', 0),
+                    data.get('last_message_id'),
+                    int(data.get('digest', True)),
+                    data.get('selected_box_types', 0),
+                    list(data.get('selected_warehouses', [])),
+                    [(warehouse_id, coefficient)
+                     for warehouse_id, mask in data.get('selected_coefficients', {}).items()
+                     for coefficient in mask_coefficients(mask)],
+                    [rule.to_row() for rule in data.get('rules', [])],
+                )))
+            cells = self._pending_cells
+            history = self._pending_history
+            box_types = self._pending_box_types
+            self._dirty_users = set()
+            self._pending_cells = {}
+            self._pending_history = []
+            self._pending_box_types = {}
+
+            try:
+                await asyncio.to_thread(self._write, users, cells, history, box_types)
+            except Exception as e:
+                logging.error(f"Ошибка при сохранении состояния в базу данных: {e}")
+                # Возвращаем несохранённые изменения, чтобы повторить запись позже
+                self._dirty_users.update(chat_id for chat_id, _ in users)
+                for key, cell in cells.items():
+                    self._pending_cells.setdefault(key, cell)
+                self._pending_history[:0] = history
+                self._pending_box_types.update(box_types)
+
+    def _write(self, users: list, cells: dict, history: list, box_types: dict):
+        connection = self._connection
+        connection.execute("BEGIN")
+        try:
+            for chat_id, row in users:
+                connection.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+                if row is None:
+                    continue
+                (setup_complete, current_warehouse_index, last_message_id, digest, selected_box_types,
+                 warehouses, coefficients, rules) = row
+                connection.execute(
+                    "INSERT INTO users (chat_id, setup_complete, current_warehouse_index, last_message_id, digest, "
+                    "box_types) VALUES (?, ?, ?, ?, ?, ?)",
+                    (chat_id, setup_complete, current_warehouse_index, last_message_id, digest, selected_box_types))
+                connection.executemany(
+                    "INSERT INTO user_warehouses (chat_id, warehouse_id, position) VALUES (?, ?, ?)",
+                    [(chat_id, warehouse_id, position) for position, warehouse_id in enumerate(warehouses)])
+                connection.executemany(
+                    "INSERT INTO user_coefficients (chat_id, warehouse_id, coefficient) VALUES (?, ?, ?)",
+                    [(chat_id, warehouse_id, coefficient) for warehouse_id, coefficient in coefficients])
+                connection.executemany(
+                    "INSERT INTO user_rules (chat_id, position, warehouse_id, coefficient_min, coefficient_max, "
+                    "lead_min, lead_max, box_types) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(chat_id, position, *rule) for position, rule in enumerate(rules)])
+
+            connection.executemany(
+                "INSERT OR REPLACE INTO snapshot (warehouse_id, date, box_type_id, coefficient, box_type_name) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(*key, *cell) for key, cell in cells.items() if cell is not None])
+            connection.executemany(
+                "DELETE FROM snapshot WHERE warehouse_id = ? AND date = ? AND box_type_id = ?",
+                [key for key, cell in cells.items() if cell is None])
+            connection.executemany(
+                "INSERT OR REPLACE INTO box_types (box_type_id, name) VALUES (?, ?)", box_types.items())
+            connection.executemany(
+                "INSERT OR IGNORE INTO coefficient_history (warehouse_id, day, box_type_id, observed_at, coefficient) "
+                "VALUES (?, ?, ?, ?, ?)", history)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+
+    # Фоновая задача периодического сброса изменений
+    async def run(self, user_data: dict):
+        try:
+            while True:
+                await asyncio.sleep(FLUSH_INTERVAL)
+                await self.flush(user_data)
+        finally:
+            # Сохраняем всё, что накопилось, перед остановкой
+            await self.flush(user_data)
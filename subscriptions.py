@@ -0,0 +1,153 @@
+# Ключ индекса для пользователей, которые отслеживают все типы поставки
+ANY_BOX_TYPE = -1
+
+
+# Инвертированный индекс подписок: (ID склада, коэффициент, ID типа поставки) -> множество chat_id.
+# Пользователи без фильтра по типам поставки лежат под ANY_BOX_TYPE, с фильтром — под каждым выбранным типом,
+# так что фильтр применяется при поиске в индексе, а не после формирования уведомлений.
+class SubscriptionIndex:
+    def __init__(self):
+        self._index = {}  # (warehouse_id, coefficient, box_type_id) -> {chat_id, ...}
+        self._warehouses = {}  # warehouse_id -> {chat_id, ...}
+        self._by_chat = {}  # chat_id -> {warehouse_id: битовая маска коэффициентов}
+        self._box_types = {}  # chat_id -> битовая маска типов поставки (нет записи — все типы)
+        # Ключ типа поставки (или ANY_BOX_TYPE) -> число пользователей со складами, которым он нужен;
+        # набор для опроса пересчитывается по счётчикам, а не обходом пользователей
+        self._box_type_counts = {}
+        self._box_type_ids = None  # Кэш результата box_type_ids()
+        self._box_type_ids_valid = False
+
+    # Добавление склада в отслеживаемые пользователем
+    def add_warehouse(self, chat_id: int, warehouse_id: int):
+        chat_warehouses = self._by_chat.get(chat_id)
+        if chat_warehouses is None:
+            chat_warehouses = self._by_chat[chat_id] = {}
+            self._count_box_types(chat_id, 1)
+        chat_warehouses.setdefault(warehouse_id, 0)
+        self._warehouses.setdefault(warehouse_id, set()).add(chat_id)
+
+    # Удаление склада вместе со всеми выбранными для него коэффициентами
+    def remove_warehouse(self, chat_id: int, warehouse_id: int):
+        chat_warehouses = self._by_chat.get(chat_id, {})
+        self._unindex(chat_id, warehouse_id, chat_warehouses.pop(warehouse_id, 0))
+        self._discard(self._warehouses, warehouse_id, chat_id)
+        if not chat_warehouses and self._by_chat.pop(chat_id, None) is not None:
+            self._count_box_types(chat_id, -1)
+
+    # Полная очистка индекса
+    def clear(self):
+        self._index.clear()
+        self._warehouses.clear()
+        self._by_chat.clear()
+        self._box_types.clear()
+        self._box_type_counts.clear()
+        self._box_type_ids_valid = False
+
+    # Подписка пользователя на коэффициент склада
+    def add_coefficient(self, chat_id: int, warehouse_id: int, coefficient: int):
+        self.add_warehouse(chat_id, warehouse_id)
+        self._by_chat[chat_id][warehouse_id] |= 1 << coefficient
+        for box_type_id in self._box_type_keys(chat_id):
+            self._index.setdefault((warehouse_id, coefficient, box_type_id), set()).add(chat_id)
+
+    # Отписка пользователя от коэффициента склада
+    def remove_coefficient(self, chat_id: int, warehouse_id: int, coefficient: int):
+        chat_warehouses = self._by_chat.get(chat_id)
+        if chat_warehouses is not None and warehouse_id in chat_warehouses:
+            chat_warehouses[warehouse_id] &= ~(1 << coefficient)
+        self._unindex(chat_id, warehouse_id, 1 << coefficient)
+
+    # Сброс всех коэффициентов пользователя с сохранением выбранных складов
+    def clear_coefficients(self, chat_id: int):
+        chat_warehouses = self._by_chat.get(chat_id, {})
+        for warehouse_id, mask in chat_warehouses.items():
+            self._unindex(chat_id, warehouse_id, mask)
+            chat_warehouses[warehouse_id] = 0
+
+    # Фильтр по типам поставки (битовая маска ID типов, 0 — все типы) с перестроением записей пользователя
+    def set_box_types(self, chat_id: int, mask: int):
+        chat_warehouses = self._by_chat.get(chat_id, {})
+        for warehouse_id, coefficients in chat_warehouses.items():
+            self._unindex(chat_id, warehouse_id, coefficients)
+        if chat_id in self._by_chat:
+            self._count_box_types(chat_id, -1)
+        if mask:
+            self._box_types[chat_id] = mask
+        else:
+            self._box_types.pop(chat_id, None)
+        if chat_id in self._by_chat:
+            self._count_box_types(chat_id, 1)
+        for warehouse_id, coefficients in chat_warehouses.items():
+            for coefficient in self._coefficients(coefficients):
+                for box_type_id in self._box_type_keys(chat_id):
+                    self._index.setdefault((warehouse_id, coefficient, box_type_id), set()).add(chat_id)
+
+    # Полное удаление пользователя из индекса
+    def remove_chat(self, chat_id: int):
+        for warehouse_id in list(self._by_chat.get(chat_id, {})):
+            self.remove_warehouse(chat_id, warehouse_id)
+        self._box_types.pop(chat_id, None)
+
+    # Пользователи, подписанные на данный коэффициент склада для данного типа поставки
+    def match(self, warehouse_id: int, coefficient: int, box_type_id: int):
+        any_box_type = self._index.get((warehouse_id, coefficient, ANY_BOX_TYPE))
+        box_type = self._index.get((warehouse_id, coefficient, box_type_id))
+        if not box_type:
+            return any_box_type or ()
+        if not any_box_type:
+            return box_type
+        return any_box_type | box_type
+
+    # Все склады, которые отслеживает хотя бы один пользователь
+    def warehouse_ids(self):
+        return list(self._warehouses)
+
+    # Типы поставки, которые кому-то нужны; None, если хотя бы один пользователь отслеживает все типы
+    def box_type_ids(self):
+        if not self._box_type_ids_valid:
+            counts = self._box_type_counts
+            self._box_type_ids = frozenset(counts) if counts and ANY_BOX_TYPE not in counts else None
+            self._box_type_ids_valid = True
+        return self._box_type_ids
+
+    # Учёт ключей типа поставки пользователя, который появился (delta=1) или пропал (delta=-1) среди подписчиков
+    def _count_box_types(self, chat_id: int, delta: int):
+        counts = self._box_type_counts
+        for box_type_id in self._box_type_keys(chat_id):
+            count = counts.get(box_type_id, 0) + delta
+            if count:
+                counts[box_type_id] = count
+            else:
+                del counts[box_type_id]
+        self._box_type_ids_valid = False
+
+    # Ключи типа поставки, под которыми пользователь лежит в индексе
+    def _box_type_keys(self, chat_id: int):
+        mask = self._box_types.get(chat_id)
+        return self._coefficients(mask) if mask else (ANY_BOX_TYPE,)
+
+    # Удаление пользователя из индекса для коэффициентов склада из маски
+    def _unindex(self, chat_id: int, warehouse_id: int, coefficients: int):
+        box_type_ids = list(self._box_type_keys(chat_id))
+        for coefficient in self._coefficients(coefficients):
+            for box_type_id in box_type_ids:
+                self._discard(self._index, (warehouse_id, coefficient, box_type_id), chat_id)
+
+    # Номера установленных битов маски (бит N — коэффициент или ID типа поставки N)
+    @staticmethod
+    def _coefficients(mask: int):
+        coefficient = 0
+        while mask:
+            if mask & 1:
+                yield coefficient
+            mask >>= 1
+            coefficient += 1
+
+    # Удаление chat_id из множества с очисткой пустых ключей
+    @staticmethod
+    def _discard(mapping: dict, key, chat_id: int):
+        chats = mapping.get(key)
+        if chats is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del mapping[key]
@@ -0,0 +1,170 @@
+import asyncio
+import json
+import logging
+from typing import NamedTuple, Optional
+
+import aiohttp
+
+from api_tokens import ApiToken, TokenPool
+from config import WILDBERRIES_API_URL, WILDBERRIES_API_KEYS
+from resilience import CircuitBreaker, backoff_delay, parse_retry_after
+
+# Параметры пула соединений и таймаутов
+CONNECTION_LIMIT = 10  # Максимум одновременных соединений в пуле
+DNS_CACHE_TTL = 300  # Время жизни DNS-кэша, секунды
+KEEPALIVE_TIMEOUT = 60  # Сколько держать простаивающее соединение открытым, секунды
+REQUEST_TIMEOUT = 15  # Общий таймаут запроса, секунды
+CONNECT_TIMEOUT = 5  # Таймаут установки соединения, секунды
+
+# Повторы при ошибках 429/5xx и сетевых сбоях
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0  # Базовая задержка экспоненциального отступа, секунды
+BACKOFF_CAP = 30.0  # Максимальная задержка между повторами, секунды
+
+
+# Результат условного запроса каталога складов: payload None означает «не изменился» (304)
+class CatalogFetch(NamedTuple):
+    payload: Optional[bytes]
+    etag: Optional[str]
+
+
+# Асинхронный клиент API Wildberries с одной долгоживущей сессией и пулом ключей
+class WildberriesClient:
+    def __init__(self, api_url: str = WILDBERRIES_API_URL, api_keys: list = WILDBERRIES_API_KEYS):
+        self.api_url = api_url
+        self.tokens = TokenPool(api_keys)
+        self.breaker = CircuitBreaker("Wildberries API")
+        self._session = None
+
+    # Ленивое создание сессии (должно происходить внутри работающего event loop)
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=CONNECTION_LIMIT,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT, sock_connect=CONNECT_TIMEOUT)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    # GET-запрос с повторами, экспоненциальным отступом и учётом Retry-After; возвращает тело ответа или None.
+    # Если передан response_info, в него записываются статус и ETag ответа (304 считается успехом с пустым телом).
+    # token — уже взятый из пула ключ (его бюджет списан); без него и для повторов ключ берётся из пула.
+    async def _get(self, path: str, params: dict = None, headers: dict = None,
+                   response_info: dict = None, token: ApiToken = None) -> Optional[bytes]:
+        if not self.breaker.allow():
+            if token is not None:
+                self.tokens.release(token)
+            logging.warning(f"Запрос {path} пропущен: выключатель открыт.")
+            return None
+        # Запрос всегда завершается отметкой в выключателе: иначе пробный запрос half-open,
+        # прерванный отменой или непредвиденной ошибкой, навсегда заблокировал бы опрос
+        try:
+            return await self._request(path, params, headers, response_info, token)
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+
+    # Запрос с повторами; результат записывается в выключатель, ключ API возвращается в пул
+    async def _request(self, path: str, params: dict, headers: dict, response_info: dict,
+                       token: ApiToken) -> Optional[bytes]:
+        session = self._get_session()
+        for attempt in range(MAX_RETRIES + 1):
+            retry_after = None
+            if token is None:
+                token = await self.tokens.acquire()
+            status = None
+            try:
+                async with session.get(f"{self.api_url}{path}", params=params,
+                                       headers={**(headers or {}), "Authorization": token.key}) as response:
+                    status = response.status
+                    if status == 200 or (status == 304 and response_info is not None):
+                        body = await response.read()
+                        self.breaker.record_success()
+                        if response_info is not None:
+                            response_info['status'] = status
+                            response_info['etag'] = response.headers.get("ETag")
+                        return body
+                    text = await response.text()
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    if status in (401, 429) and self.tokens.active() > 1:
+                        # Ключ выводится из пула, запрос сразу повторяется с другим ключом
+                        logging.warning(f"API {path} ответило {status} для ключа {token.label}, "
+                                        f"повтор с другим ключом: {text}")
+                        continue
+                    if status != 429 and status < 500:
+                        # Ошибка запроса (401, 400 и т.п.) повтором не исправится
+                        logging.error(f"Ошибка API {path}: {status} - {text}")
+                        self.breaker.record_failure()
+                        return None
+                    logging.warning(f"API {path} ответило {status} (попытка {attempt + 1}): {text}")
+            except (aiohttp.ClientError, TimeoutError) as e:
+                logging.warning(f"Ошибка при запросе {path} (попытка {attempt + 1}): {e!r}")
+            finally:
+                self.tokens.release(token, status, retry_after)
+                token = None
+
+            if retry_after is not None and retry_after > BACKOFF_CAP:
+                # Сервер просит подождать дольше, чем мы готовы ждать в цикле: размыкаем выключатель
+                self.breaker.trip(retry_after)
+                return None
+            if attempt < MAX_RETRIES:
+                await asyncio.sleep(retry_after if retry_after is not None
+                                    else backoff_delay(attempt, BACKOFF_BASE, BACKOFF_CAP))
+
+        logging.error(f"Не удалось выполнить запрос {path} после {MAX_RETRIES + 1} попыток.")
+        self.breaker.record_failure()
+        return None
+
+    # Функция для получения списка складов
+    async def get_warehouses(self):
+        # Используем тот же User-Agent, что и в Postman
+        body = await self._get("/warehouses", headers={"User-Agent": "Googlebot"})
+        if body is None:
+            return None
+        return json.loads(body)
+
+    # Список складов условным запросом: при совпадении ETag сервер отвечает 304 без тела
+    async def fetch_warehouses(self, etag: str = None) -> Optional[CatalogFetch]:
+        headers = {"User-Agent": "Googlebot"}
+        if etag:
+            headers["If-None-Match"] = etag
+        response_info = {}
+        body = await self._get("/warehouses", headers=headers, response_info=response_info)
+        if body is None:
+            return None
+        if response_info['status'] == 304:
+            return CatalogFetch(None, etag)
+        return CatalogFetch(body, response_info['etag'])
+
+    # Функция для получения сырого ответа с коэффициентами приемки (bytes)
+    async def get_acceptance_coefficients_payload(self, warehouse_ids, token: ApiToken = None):
+        params = {
+            "warehouseIDs": ",".join(map(str, warehouse_ids))
+        }
+        return await self._get("/acceptance/coefficients", params=params, token=token)
+
+    # Функция для получения коэффициентов приемки
+    async def get_acceptance_coefficients(self, warehouse_ids):
+        payload = await self.get_acceptance_coefficients_payload(warehouse_ids)
+        if payload is None:
+            return None
+        return json.loads(payload)
+
+    # Закрытие сессии при остановке бота
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Общий клиент для всего процесса
+wb_client = WildberriesClient()
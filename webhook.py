@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+from config import WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_WORKERS
+
+QUEUE_SIZE = 1000  # Сколько обновлений может ждать обработки; при переполнении отвечаем 503 и Telegram повторит
+DRAIN_TIMEOUT = 30  # Сколько ждать обработки принятых обновлений при остановке, секунды
+
+
+# Приём обновлений через webhook с ограниченным пулом обработчиков и плавной остановкой
+class WebhookServer:
+    def __init__(self, bot: Bot, dp: Dispatcher, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, workers: int = WEBHOOK_WORKERS):
+        self.bot = bot
+        self.dp = dp
+        self.host = host
+        self.port = port
+        self.path = path
+        self.workers = workers
+        self.queue = None
+        self._runner = None
+        self._tasks = []
+        self._accepting = False
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+
+    # Принимаем обновление и сразу отвечаем 200; обработка идёт в пуле
+    async def handle(self, request: web.Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if not self._accepting:
+            return web.Response(status=503)
+        try:
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except Exception as e:
+            logging.error(f"Некорректное обновление webhook: {e}")
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logging.warning("Очередь webhook переполнена, Telegram повторит доставку.")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._runner = web.AppRunner(self.create_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._accepting = True
+        logging.info(f"Webhook слушает http://{self.host}:{self.port}{self.path}")
+
+        if WEBHOOK_URL:
+            await self.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=self.dp.resolve_used_update_types(),
+                max_connections=self.workers,
+            )
+            logging.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+
+    # Плавная остановка: перестаём принимать обновления, дообрабатываем принятые, останавливаем пул
+    async def stop(self):
+        self._accepting = False
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logging.warning(f"Не все обновления обработаны за {DRAIN_TIMEOUT} с.: осталось {self.queue.qsize()}.")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None